@@ -1,5 +1,6 @@
 from seldonian.utils.RL_utils import *
-from math import factorial, pi
+from seldonian.utils.cache_utils import ArrayCache
+from math import comb, pi
 
 
 class Fourier(object):
@@ -40,6 +41,12 @@ class Fourier(object):
         )
         self.basis_matrix = self.construct_basis_matrix()
 
+        # Observations are fixed across optimizer steps, so the
+        # features of a batch of observations can optionally be memoized.
+        # The cache is created on first use
+        self.cache_features = hyperparam_and_setting_dict.get("cache_features", False)
+        self.feature_cache = None
+
     def calculate_num_features(self, order, max_coupled_vars, num_obs_dims):
         """Calculate the number of features in a Reinforcement Learning (RL) Fourier basis.
 
@@ -66,11 +73,8 @@ class Fourier(object):
         for mandatory_0_observation_variables in range(
             max_coupled_vars + 1, num_obs_dims + 1
         ):
-            num_features -= (
-                order ** mandatory_0_observation_variables
-                * factorial(num_obs_dims)
-                / factorial(num_obs_dims - mandatory_0_observation_variables)
-                / factorial(mandatory_0_observation_variables)
+            num_features -= order ** mandatory_0_observation_variables * comb(
+                num_obs_dims, mandatory_0_observation_variables
             )
         return num_features
 
@@ -84,29 +88,21 @@ class Fourier(object):
         is the number of dimensions in the observation space. Each entry in the matrix is an
         integer representing the frequency for that dimension in the Fourier basis.
         """
-        basis_matrix = np.zeros(
-            (self.num_features, self.num_observation_dims), dtype=int
-        )
-        row = 0  # row of the matrix corresponds to the features
-        fully_coupled_num_features = (self.order + 1) ** self.num_observation_dims
-        for fully_coupled_feature in range(fully_coupled_num_features):
-            num_in_row_non_zero = 0
-            for observation_dim in range(self.num_observation_dims):
-                rep_size = (self.order + 1) ** (
-                    self.num_observation_dims - observation_dim - 1
-                )  # representation size of count on this entry (e.g. if binary (meaning order = 1) then last column has rep_size 1, 2nd-to last has 2, 3rd to last has 4, etc.)
-                entry_value = (fully_coupled_feature / rep_size) % (self.order + 1)
-                if entry_value != 0:
-                    num_in_row_non_zero += 1
-                basis_matrix[
-                    row, observation_dim
-                ] = entry_value  # adding plus one for C++-to-Julia translation
-            if num_in_row_non_zero > self.max_coupled_vars:  # redo the row
-                row -= 1
-            row += 1
-            if row == self.num_features:
-                break  # don't want it to keep running invalid lines if it got all the good ones (they'll be out of range of the matrix)
-        if row != self.num_features:
+        base = self.order + 1
+        fully_coupled_num_features = base ** self.num_observation_dims
+        # Row i of the fully coupled basis holds the digits of i in base (order+1),
+        # e.g. if binary (meaning order = 1) then the last column has place value 1,
+        # the 2nd-to-last has 2, the 3rd-to-last has 4, etc.
+        place_values = base ** np.arange(self.num_observation_dims - 1, -1, -1)
+        fully_coupled_basis_matrix = (
+            np.arange(fully_coupled_num_features)[:, np.newaxis] // place_values
+        ) % base
+        # Drop the rows that couple too many variables
+        num_non_zero = np.count_nonzero(fully_coupled_basis_matrix, axis=1)
+        basis_matrix = fully_coupled_basis_matrix[
+            num_non_zero <= self.max_coupled_vars
+        ]
+        if len(basis_matrix) != self.num_features:
             error("row != num_features at this point, this should never happen")
         return basis_matrix
 
@@ -122,16 +118,50 @@ class Fourier(object):
         ret_matrix = np.cos(pi * ret_matrix)
         return ret_matrix
 
+    def get_features_batch(self, observations):
+        """Get the basis features of a batch of observations.
+        If cache_features was set in the hyperparameter and setting
+        dictionary, the features are memoized on the identity of the
+        observations array (see :py:class:`.ArrayCache`),
+        so the array must not be modified in place.
+
+        :param observations: unnormalized observations,
+            shape (N, num_observation_dims)
+        :type observations: numpy.ndarray
+
+        :return: A matrix of features, shape (N, num_features)
+        :rtype: numpy.ndarray
+        """
+        # Bases pickled before the cache existed won't have these
+        if not getattr(self, "cache_features", False):
+            return self._calculate_features_batch(observations)
+
+        if getattr(self, "feature_cache", None) is None:
+            self.feature_cache = ArrayCache()
+        return self.feature_cache.get(observations, self._calculate_features_batch)
+
+    def _calculate_features_batch(self, observations):
+        """Calculate the basis features of a batch of observations
+        with a single matrix product
+
+        :param observations: unnormalized observations,
+            shape (N, num_observation_dims)
+        :type observations: numpy.ndarray
+
+        :return: A matrix of features, shape (N, num_features)
+        :rtype: numpy.ndarray
+        """
+        normalized_obs = self.get_normalized_observation(
+            np.reshape(observations, (-1, self.num_observation_dims))
+        )
+        return np.cos(pi * np.dot(normalized_obs, self.basis_matrix.T))
+
     def get_normalized_observation(self, obs):
-        """Get the normalized observation given an observation
+        """Get the normalized observation given an observation.
+        Also works on a 2D array with one observation per row.
 
         :param obs: unnormalized observation
 
         :return norm_obs: normalized observation
         """
-        norm_obs = np.zeros(self.num_observation_dims)
-        for obs_dim in range(self.num_observation_dims):
-            norm_obs[obs_dim] = (obs[obs_dim] - self.mins[obs_dim]) / self.ranges[
-                obs_dim
-            ]
-        return norm_obs
+        return (np.asarray(obs, dtype=float) - self.mins) / self.ranges
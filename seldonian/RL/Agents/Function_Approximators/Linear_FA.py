@@ -28,8 +28,25 @@ class Linear_state_action_value_FA(Linear_FA):
     def get_action_values_given_state(self, state):
         return self.get_action_values_given_features(self.get_features(state))
 
+    def get_action_values_given_states(self, states):
+        """Get the action values of an array of states
+        with one matrix product
+
+        :param states: The states, one per row
+        :return: array of action values, one row per state
+        """
+        return self.get_action_values_given_features(self.get_features_batch(states))
+
     def get_action_values_given_features(self, features):
         return np.dot(features, self.weights)
 
     def get_features(self, state):
         return self.basis.get_features(state)
+
+    def get_features_batch(self, states):
+        """Get the features of an array of states
+
+        :param states: The states, one per row
+        :return: array of features, one row per state
+        """
+        return self.basis.get_features_batch(states)
@@ -55,6 +55,19 @@ class Q_Table(Table):
             zero_indexed_state_number
         )
 
+    def get_action_values_given_states(self, states_not_zero_indexed):
+        """Get possible Q-table values for an array of environmental
+        observations with a single gather from the table
+
+        :param states_not_zero_indexed: The environment-specific obs numbers
+        :type states_not_zero_indexed: numpy.ndarray(int)
+        :return: array of possible Q-table values, one row per obs
+        """
+        zero_indexed_state_numbers = self.from_environment_state_to_0_indexed_state(
+            np.asarray(states_not_zero_indexed, dtype=int)
+        )
+        return self.weights[zero_indexed_state_numbers, :]
+
     def get_action_values_given_zero_indexed_state(self, zero_indexed_state_number):
         """Get possible Q-table values given 0-indexed obs number in the table
 
@@ -34,6 +34,18 @@ class Policy(object):
         """Get probabilities for each observation and action in the input arrays"""
         raise NotImplementedError()
 
+    def get_log_probs_from_observations_and_actions(
+        self, observations, actions, behavior_action_probs
+    ):
+        """Get log probabilities for each observation and action in the input arrays.
+        Can be overridden to calculate them more stably than taking the log
+        of self.get_probs_from_observations_and_actions()"""
+        return np.log(
+            self.get_probs_from_observations_and_actions(
+                observations, actions, behavior_action_probs
+            )
+        )
+
 
 class Discrete_Action_Policy(Policy):
     def __init__(self, hyperparam_and_setting_dict, env_description):
@@ -119,6 +131,11 @@ class Discrete_Action_Policy(Policy):
         """Get all parameter weights possible in a given observation"""
         return self.FA.get_action_values_given_state(obs)
 
+    def get_action_values_given_states(self, observations):
+        """Get all parameter weights possible in each of an array of observations,
+        one row per observation"""
+        return self.FA.get_action_values_given_states(observations)
+
     def set_new_params(self, new_params):
         """Set the parameters of the agent
 
@@ -1,7 +1,8 @@
 from seldonian.RL.Agents.Policies.Policy import *
 import autograd.numpy as np
+from autograd.scipy.special import logsumexp
 from seldonian.utils.RL_utils import *
-from functools import lru_cache
+from seldonian.models.models import is_defined_with
 
 
 class Softmax(Discrete_Action_Policy):
@@ -91,87 +92,78 @@ class Softmax(Discrete_Action_Policy):
         this_action = self.from_environment_action_to_0_indexed_action(action)
         return action_probs[this_action]
 
-    def get_probs_from_observations_and_actions(
-        self, observations, actions, behavior_action_probs
-    ):
-        """Get the action probabilities of a selected actions and observations under
-        the new policy
+    def get_log_action_probs_from_action_values_batch(self, action_values):
+        """Get log action probabilities given a 2D array of action values,
+        one row per observation (a row-wise log-softmax)
 
-        :param observations: array of observations of the environment
-        :param actions: array of selected actions
-        :param behavior_action_probs: The probability of the selected actions under the behavior policy
+        :param action_values: Array of action values (param weights),
+            one row per observation
 
-        :return: array action probabilities of the observation,action pairs under the new policy
-        :rtype: numpy.ndarray(float)
+        :return: array of log action probabilites, one row per observation
         """
-        action_probs = np.array(
-            list(map(self.get_prob_this_action, observations, actions))
-        )
-        return action_probs
-
-
-class DiscreteSoftmax(Softmax):
-    def __init__(self, hyperparam_and_setting_dict, env_description):
-        """Softmax where both observations and actions are discrete.
-        Faster than just using Softmax class because
-        a cache is used for lookups to Q Table"""
-        super().__init__(hyperparam_and_setting_dict, env_description)
-
-    @lru_cache
-    def _denom(self, observation):
-        """Helper function to accelerate action probability calculation
+        return action_values - logsumexp(action_values, axis=1, keepdims=True)
 
-        :param observation: An observation of the environment
-        :type observation: int
-        """
-        return np.sum(np.exp(self.FA.weights[observation]))
+    def get_action_log_probs(self, observations, actions):
+        """Get the log probabilities of selected actions and observations
+        under the new policy, for all observations at once
 
-    @lru_cache
-    def _arg(self, observation, action):
-        """Helper function to accelerate action probability calculation
+        :param observations: array of observations of the environment
+        :param actions: array of selected actions
 
-        :param observation: A observation of the environment
-        :type observation: int
-        :param action: A possible action at the given observation
-        :type action: int
+        :return: array of log action probabilities of the observation,action pairs
+        :rtype: numpy.ndarray(float)
         """
-        return self.FA.weights[observation][action]
+        action_values = self.get_action_values_given_states(observations)
+        log_action_probs = self.get_log_action_probs_from_action_values_batch(
+            action_values
+        )
+        action_indices = self.from_environment_action_to_0_indexed_action(
+            np.asarray(actions, dtype=int)
+        )
+        return log_action_probs[np.arange(len(action_indices)), action_indices]
 
-    def get_prob_this_action(self, observation, action):
-        """Get the probability of a selected action in a given obsertavtion
+    def get_log_probs_from_observations_and_actions(
+        self, observations, actions, behavior_action_probs
+    ):
+        """Get the log action probabilities of selected actions and observations under
+        the new policy
 
-        :param observation: The current obseravation of the environment
-        :param action: The selected action
-        :param action_prob: The probability of the selected action
+        :param observations: array of observations of the environment
+        :param actions: array of selected actions
+        :param behavior_action_probs: The probability of the selected actions under the behavior policy
 
-        :return: probability of action
-        :rtype: float
+        :return: array of log action probabilities of the observation,action pairs under the new policy
+        :rtype: numpy.ndarray(float)
         """
-        return np.exp(self._arg(observation, action)) / self._denom(observation)
+        return self.get_action_log_probs(observations, actions)
 
     def get_probs_from_observations_and_actions(
         self, observations, actions, behavior_action_probs
     ):
-        """Get the action probabilities of selected actions and observations under
-        the new policy.
+        """Get the action probabilities of a selected actions and observations under
+        the new policy
 
         :param observations: array of observations of the environment
         :param actions: array of selected actions
         :param behavior_action_probs: The probability of the selected actions under the behavior policy
 
-        :return: action probabilities of the observation,action pairs under the new policy
+        :return: array action probabilities of the observation,action pairs under the new policy
         :rtype: numpy.ndarray(float)
         """
-        action_probs = np.array(
-            list(map(self.get_prob_this_action, observations, actions))
-        )
+        if not is_defined_with(
+            self, "get_probs_from_observations_and_actions", "get_prob_this_action"
+        ):
+            # A subclass overrode get_prob_this_action(), so use it
+            return np.array(list(map(self.get_prob_this_action, observations, actions)))
+        return np.exp(self.get_action_log_probs(observations, actions))
+
 
-        # Clear the cache
-        # This is necessary because cache is only correct
-        # for a given set of param weights
-        self._denom.cache_clear()
-        self._arg.cache_clear()
-        return action_probs
+class DiscreteSoftmax(Softmax):
+    def __init__(self, hyperparam_and_setting_dict, env_description):
+        """Softmax where both observations and actions are discrete.
+        The action values of all observations are looked up
+        in the Q Table with a single gather."""
+        super().__init__(hyperparam_and_setting_dict, env_description)
 
 
 class MixedSoftmax(Softmax):
@@ -210,3 +202,40 @@ class MixedSoftmax(Softmax):
         pi_new = action_probs[this_action]
         pi_mixed = self.alpha * pi_new + (1 - self.alpha) * pi_b
         return pi_mixed
+
+    def get_probs_from_observations_and_actions(
+        self, observations, actions, behavior_action_probs
+    ):
+        """Get the action probabilities of selected actions and observations under
+        the mixed policy
+
+        :param observations: array of observations of the environment
+        :param actions: array of selected actions
+        :param behavior_action_probs: The probability of the selected actions under the behavior policy
+
+        :return: array of action probabilities under the mixed policy
+        :rtype: numpy.ndarray(float)
+        """
+        pi_news = np.exp(self.get_action_log_probs(observations, actions))
+        return self.alpha * pi_news + (1 - self.alpha) * np.asarray(
+            behavior_action_probs
+        )
+
+    def get_log_probs_from_observations_and_actions(
+        self, observations, actions, behavior_action_probs
+    ):
+        """Get the log action probabilities of selected actions and observations
+        under the mixed policy
+
+        :param observations: array of observations of the environment
+        :param actions: array of selected actions
+        :param behavior_action_probs: The probability of the selected actions under the behavior policy
+
+        :return: array of log action probabilities under the mixed policy
+        :rtype: numpy.ndarray(float)
+        """
+        return np.log(
+            self.get_probs_from_observations_and_actions(
+                observations, actions, behavior_action_probs
+            )
+        )
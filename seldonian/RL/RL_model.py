@@ -3,7 +3,7 @@ from seldonian.models.models import SeldonianModel
 
 
 class RL_model(SeldonianModel):  # consist of agent, env
-    def __init__(self, policy, env_kwargs):
+    def __init__(self, policy, env_kwargs, importance_ratio_bounds=None):
         """Base class for all RL models.
 
         :param policy: A policy parameterization
@@ -11,9 +11,16 @@ class RL_model(SeldonianModel):  # consist of agent, env
         :param env_kwargs: Kwargs pertaining to environment
                 such as gamma, the discount factor
         :type env_kwargs: dict
+        :param importance_ratio_bounds: Optional (lower, upper) bounds that
+                the per-decision importance ratios pi_new/pi_b are clipped to
+                in the importance sampling estimators. Truncating the ratios
+                lowers the variance of the estimates at the cost of bias.
+                Either bound can be None.
+        :type importance_ratio_bounds: tuple
         """
         self.policy = policy
         self.env_kwargs = env_kwargs
+        self.importance_ratio_bounds = importance_ratio_bounds
 
         if "gamma" not in self.env_kwargs:
             self.env_kwargs["gamma"] = 1.0
@@ -43,3 +50,21 @@ class RL_model(SeldonianModel):  # consist of agent, env
         )
 
         return np.array(probs)
+
+    def get_log_probs_from_observations_and_actions(
+        self, new_params, observations, actions, action_probs,
+    ):
+        """Get log action probablities under policy with new parameters.
+        Just a wrapper to call policy method of same name.
+
+        :param new_params: New policy parameter weights to set
+        :param observations: Array of observations
+        :param actions: Array of actions
+        :param action_probs: Array of action probabilities from the behavior policy
+
+        :return: Array of log action probabilities under the new policy
+        """
+        self.policy.set_new_params(new_params)
+        return self.policy.get_log_probs_from_observations_and_actions(
+            observations, actions, action_probs
+        )
@@ -1,14 +1,26 @@
 """ Candidate selection module """
 
 import os, pickle
+import warnings
 import autograd.numpy as np  # Thinly-wrapped version of Numpy
+from autograd.tracer import getval
 import math
 import pandas as pd
 from functools import partial
 
 from seldonian.models import objectives
 from seldonian.dataset import SupervisedDataSet, RLDataSet, CustomDataSet
-from seldonian.optimizers.gradient_descent import gradient_descent_adam
+from seldonian.parse_tree.base_node_registry import BaseNodeRegistry
+from seldonian.models.prediction_cache import PredictionCache
+from seldonian.models.models import has_stacked_predict
+from seldonian.utils.array_utils import stack_values
+from seldonian.parse_tree.zhat_funcs import chunked_evaluator
+from seldonian.optimizers.gradient_descent import (
+    gradient_descent_adam,
+    multi_start_gradient_descent_adam,
+)
+from seldonian.candidate_selection.data_parallel import DataParallelEvaluator
+from seldonian.candidate_selection.population import PopulationEvaluator
 
 
 class CandidateSelection(object):
@@ -99,6 +111,20 @@ class CandidateSelection(object):
 
         self.additional_datasets = additional_datasets
 
+        # Shares zhats of identical base nodes across parse trees
+        self.base_node_registry = BaseNodeRegistry()
+        # Row range of the current batch dataset
+        self.batch_range = None
+        # Use closed-form gradients of the base node bounds
+        # where available instead of tracing them with autograd
+        self.use_analytic_gradients = True
+        # Maximum number of datapoints passed through the model at once
+        # when evaluating base nodes and built-in primary objectives
+        # (objectives.row_mean_objectives). None means all at once
+        self.batch_size_candidate_eval = None
+        # Evaluates base nodes on shards of the batch in worker processes
+        self.data_parallel_evaluator = None
+
     def calculate_batches(self, batch_index, batch_size, epoch, n_batches):
         """Create a batch dataset (for the primary dataset) to be used in gradient descent.
         Sets self.batch_dataset. See return logic.
@@ -120,17 +146,50 @@ class CandidateSelection(object):
         batch_start = batch_index * batch_size
         batch_end = batch_start + batch_size
 
+        # theta is updated in place between steps
+        self._reset_prediction_cache()
+
+        num_datapoints = self.candidate_dataset.num_datapoints
+        batch_end = min(batch_end, num_datapoints)
+        batch_num_datapoints = batch_end - batch_start
+
+        # Only rebuild the batch dataset if the batch has changed. Base nodes
+        # reuse their prepared data for as long as the dataset object is the same.
+        if (batch_start, batch_end) != self.batch_range:
+            self._make_batch_dataset(batch_start, batch_end)
+            self.batch_range = (batch_start, batch_end)
+
+        # Handle additional datasets
+        self.calculate_batches_addl_datasets(epoch, batch_index, n_batches)
+
+        # If current batch is smaller than the batch size and not the first batch
+        # then that means we shouldn't consider a candidate solution calculated from it
+        if batch_index > 0 and (batch_num_datapoints < batch_size):
+            return True
+        else:
+            return False
+
+    def _make_batch_dataset(self, batch_start, batch_end):
+        """Slice the rows [batch_start,batch_end) out of the
+        candidate dataset and set self.batch_dataset,
+        as well as the batch features, labels, sensitive attributes,
+        or data depending on the regime.
+
+        :param batch_start: First row of the batch
+        :type batch_start: int
+        :param batch_end: One past the last row of the batch
+        :type batch_end: int
+        """
         num_datapoints = self.candidate_dataset.num_datapoints
+        batch_size = batch_end - batch_start
         if self.regime == "supervised_learning":
             if batch_size < num_datapoints:
                 if type(self.features) == list:
                     self.batch_features = [
                         x[batch_start:batch_end] for x in self.features
                     ]
-                    batch_num_datapoints = len(self.batch_features[0])
                 else:
                     self.batch_features = self.features[batch_start:batch_end]
-                    batch_num_datapoints = len(self.batch_features)
 
                 self.batch_labels = self.labels[batch_start:batch_end]
                 self.batch_sensitive_attrs = self.candidate_dataset.sensitive_attrs[
@@ -141,39 +200,41 @@ class CandidateSelection(object):
                 self.batch_labels = self.labels
                 self.batch_sensitive_attrs = self.candidate_dataset.sensitive_attrs
                 self.batch_dataset = self.candidate_dataset
-                batch_num_datapoints = num_datapoints
 
             self.batch_dataset = SupervisedDataSet(
                 self.batch_features,
                 self.batch_labels,
                 self.batch_sensitive_attrs,
-                num_datapoints=batch_num_datapoints,
+                num_datapoints=batch_end - batch_start,
                 meta=self.candidate_dataset.meta,
             )
+            self.batch_dataset.set_batch_source(
+                self.candidate_dataset, batch_start, batch_end
+            )
 
         elif self.regime == "reinforcement_learning":
             if batch_size < num_datapoints:
                 batch_episodes = self.candidate_dataset.episodes[batch_start:batch_end]
-                batch_num_datapoints = len(batch_episodes)
                 self.batch_sensitive_attrs = self.candidate_dataset.sensitive_attrs[
                     batch_start:batch_end
                 ]
             else:
                 batch_episodes = self.candidate_dataset.episodes
-                batch_num_datapoints = num_datapoints
                 self.batch_sensitive_attrs = self.candidate_dataset.sensitive_attrs
 
             self.batch_dataset = RLDataSet(
                 episodes=batch_episodes,
                 sensitive_attrs=self.batch_sensitive_attrs,
-                num_datapoints=batch_num_datapoints,
+                num_datapoints=batch_end - batch_start,
                 meta=self.candidate_dataset.meta,
             )
+            self.batch_dataset.set_batch_source(
+                self.candidate_dataset, batch_start, batch_end
+            )
 
         elif self.regime == "custom":
             if batch_size < num_datapoints:
                 self.batch_data = self.candidate_dataset.data[batch_start:batch_end]
-                batch_num_datapoints = len(self.batch_data)
 
                 self.batch_sensitive_attrs = self.candidate_dataset.sensitive_attrs[
                     batch_start:batch_end
@@ -181,24 +242,16 @@ class CandidateSelection(object):
             else:
                 self.batch_data = self.candidate_dataset.data
                 self.batch_sensitive_attrs = self.candidate_dataset.sensitive_attrs
-                batch_num_datapoints = num_datapoints
 
             self.batch_dataset = CustomDataSet(
                 self.batch_data,
                 self.batch_sensitive_attrs,
-                num_datapoints=batch_num_datapoints,
+                num_datapoints=batch_end - batch_start,
                 meta=self.candidate_dataset.meta,
             )
-
-        # Handle additional datasets
-        self.calculate_batches_addl_datasets(epoch, batch_index, n_batches)
-
-        # If current batch is smaller than the batch size and not the first batch
-        # then that means we shouldn't consider a candidate solution calculated from it
-        if batch_index > 0 and (batch_num_datapoints < batch_size):
-            return True
-        else:
-            return False
+            self.batch_dataset.set_batch_source(
+                self.candidate_dataset, batch_start, batch_end
+            )
 
     def calculate_batches_addl_datasets(
         self, primary_epoch_index, primary_batch_index, n_batches
@@ -222,6 +275,14 @@ class CandidateSelection(object):
                 batch_index_list = this_dict["batch_index_list"]
                 lookup_index = primary_epoch_index * n_batches + primary_batch_index
                 batch_indices = batch_index_list[lookup_index]
+                # Keep the existing batch dataset (and the data prepared from it)
+                # if the batch has not changed
+                if (
+                    "batch_dataset" in this_dict
+                    and this_dict.get("batch_indices") == batch_indices
+                ):
+                    continue
+                this_dict["batch_indices"] = batch_indices
                 # could be 2 or 4 of these (if the batch wrapped back around to start)
                 wraps = False
                 if len(batch_indices) == 4:
@@ -266,7 +327,8 @@ class CandidateSelection(object):
                         wrapped_sensitive_attrs = cand_dataset.sensitive_attrs[
                             start2:end2
                         ]
-                        batch_episodes = np.vstack((batch_episodes, wrapped_episodes))
+                        # Works for lists of episodes and EpisodeColumns
+                        batch_episodes = batch_episodes + wrapped_episodes
                         batch_sensitive_attrs = np.vstack(
                             (batch_sensitive_attrs, wrapped_sensitive_attrs)
                         )
@@ -336,6 +398,8 @@ class CandidateSelection(object):
             for base_node in self.additional_datasets[pt]:
                 this_dict = self.additional_datasets[pt][base_node]
                 num_datapoints_addl = this_dict["candidate_dataset"].num_datapoints
+                # Force the batch datasets to be rebuilt on the first batch
+                this_dict.pop("batch_indices", None)
 
                 # rule iii
                 if n_batches == 1:
@@ -380,6 +444,33 @@ class CandidateSelection(object):
             during candidate selection.
         :rtype: array or str
         """
+        # Share model predictions between the primary objective
+        # and the base nodes within each optimizer step
+        self.model.prediction_cache = PredictionCache()
+        try:
+            return self._run_optimization(**kwargs)
+        finally:
+            self.model.prediction_cache = None
+
+    def _run_optimization(self, **kwargs):
+        """Run the optimizer of :py:meth:`run`
+
+        :return: candidate_solution, array of model weights or 'NSF'
+        :rtype: array or str
+        """
+        if "batch_size_candidate_eval" in kwargs:
+            self.batch_size_candidate_eval = kwargs["batch_size_candidate_eval"]
+            if self.batch_size_candidate_eval is not None and not (
+                self.regime == "supervised_learning"
+                and self.primary_objective in objectives.row_mean_objectives
+            ):
+                warnings.warn(
+                    "batch_size_candidate_eval only bounds the memory used by "
+                    "the base nodes. The primary objective is evaluated "
+                    "on the whole batch at once, because it is not one of "
+                    "the built-in supervised learning objectives that are "
+                    "a mean over the datapoints."
+                )
 
         if self.optimization_technique == "gradient_descent":
             if self.optimizer != "adam":
@@ -390,6 +481,9 @@ class CandidateSelection(object):
             if "clip_theta" not in kwargs:
                 kwargs["clip_theta"] = None
 
+            if "use_analytic_gradients" in kwargs:
+                self.use_analytic_gradients = kwargs["use_analytic_gradients"]
+
             # Figure out number of batches
             if "use_batches" not in kwargs:
                 raise KeyError(
@@ -437,6 +531,10 @@ class CandidateSelection(object):
                 verbose=kwargs["verbose"],
                 debug=kwargs["debug"],
             )
+            # Optional early stopping criteria
+            for key in ["tol_L", "tol_grad", "patience", "feasibility_patience"]:
+                if key in kwargs:
+                    gd_kwargs[key] = kwargs[key]
             # Option to use builtin primary gradient (could be faster than autograd)
             if "use_builtin_primary_gradient_fn" in kwargs:
                 if kwargs["use_builtin_primary_gradient_fn"] == True:
@@ -503,8 +601,76 @@ class CandidateSelection(object):
                         f"is not yet supported for regime='{self.regime}'."
                     )
 
-            # Run KKT optimization
-            res = gradient_descent_adam(**gd_kwargs)
+            # If user specified a function that returns the primary objective
+            # and its gradient together, then pass it here
+            if kwargs.get("custom_primary_value_and_gradient_fn") != None:
+                value_and_grad_primary_objective = kwargs[
+                    "custom_primary_value_and_gradient_fn"
+                ]
+                if self.regime == "supervised_learning":
+
+                    def value_and_grad_primary_objective_theta(theta):
+                        """ A wrapper that fixes the model, features, and labels
+                        so that the wrapper function is only a function of theta.
+                        """
+                        return value_and_grad_primary_objective(
+                            model=self.model,
+                            theta=theta,
+                            X=self.batch_features,
+                            Y=self.batch_labels,
+                        )
+
+                elif self.regime == "custom":
+
+                    def value_and_grad_primary_objective_theta(theta):
+                        """ A wrapper that fixes the model and data
+                        so that the wrapper function is only a function of theta.
+                        """
+                        return value_and_grad_primary_objective(
+                            model=self.model, theta=theta, data=self.batch_data
+                        )
+
+                else:
+                    raise NotImplementedError(
+                        "Using a provided primary objective value and gradient "
+                        f"function is not yet supported for regime='{self.regime}'."
+                    )
+                gd_kwargs[
+                    "primary_value_and_gradient"
+                ] = value_and_grad_primary_objective_theta
+
+            if kwargs["gradient_library"] == "torch":
+                self._check_torch_gradient_library(**kwargs)
+
+            # Optionally shard the base node evaluations across worker processes
+            n_workers = kwargs.get("n_data_parallel_workers", 1)
+            if n_workers > 1:
+                self.data_parallel_evaluator = DataParallelEvaluator(self, n_workers)
+
+            # Run KKT optimization, optionally from several starting points
+            # advanced in lockstep
+            n_starts = kwargs.get("n_starts", 1)
+            try:
+                if n_starts > 1:
+                    gd_kwargs.pop("theta_init")
+                    res = multi_start_gradient_descent_adam(
+                        theta_inits=self.get_multi_start_thetas(
+                            n_starts,
+                            start_scale=kwargs.get("start_scale", 1.0),
+                            seed=kwargs.get("seed"),
+                        ),
+                        # Only models with predict_stacked() are known
+                        # to be stateless
+                        stacked_trace=has_stacked_predict(self.model),
+                        prepare_thetas=self.prepare_stacked_predictions,
+                        **gd_kwargs,
+                    )
+                else:
+                    res = gradient_descent_adam(**gd_kwargs)
+            finally:
+                if self.data_parallel_evaluator is not None:
+                    self.data_parallel_evaluator.shutdown()
+                    self.data_parallel_evaluator = None
 
             # Store optimization result as an instance variable
             self.optimization_result = res
@@ -595,7 +761,25 @@ class CandidateSelection(object):
 
                 es = cma.CMAEvolutionStrategy(self.initial_solution, sigma0, opts)
 
-                es.optimize(self.objective_with_barrier, callback=logger)
+                # Evaluate each generation as a whole rather than
+                # one candidate solution at a time
+                population_evaluator = PopulationEvaluator(
+                    self, n_workers=kwargs.get("n_population_workers", 1)
+                )
+                try:
+                    while not es.stop():
+                        solutions = es.ask()
+                        es.tell(solutions, population_evaluator.evaluate(solutions))
+                        if logger is not None:
+                            logger(es)
+                        es.logger.add()
+                        es.disp()
+                finally:
+                    population_evaluator.shutdown()
+                # es.optimize() always logs the final generation
+                es._force_final_logging()
+                if es.opts["verb_disp"] > 0:
+                    es.result_pretty()
                 if kwargs["verbose"]:
                     es.disp()
                 if self.write_logfile and kwargs["verbose"]:
@@ -623,6 +807,84 @@ class CandidateSelection(object):
         # Return the candidate solution
         return candidate_solution
 
+    def _reset_prediction_cache(self):
+        """Drop any model predictions stored for the previous theta"""
+        prediction_cache = getattr(self.model, "prediction_cache", None)
+        if prediction_cache is not None:
+            prediction_cache.reset()
+
+    def _check_torch_gradient_library(self, **kwargs):
+        """Raise if gradient_library='torch' cannot be used
+        with this model or these hyperparameters. The torch gradient library
+        passes theta to the model as a tensor, which only the PyTorch
+        models in supervised learning support.
+        """
+        # Only import torch if it was asked for
+        from seldonian.models.pytorch_model import SupervisedPytorchBaseModel
+
+        if self.regime != "supervised_learning" or not isinstance(
+            self.model, SupervisedPytorchBaseModel
+        ):
+            raise NotImplementedError(
+                "gradient_library='torch' is only supported for "
+                "supervised learning with a SupervisedPytorchBaseModel"
+            )
+        if kwargs.get("n_data_parallel_workers", 1) > 1:
+            raise NotImplementedError(
+                "gradient_library='torch' is not supported "
+                "with n_data_parallel_workers > 1"
+            )
+
+    def get_multi_start_thetas(self, n_starts, start_scale=1.0, seed=None):
+        """Get the starting points for multi-start gradient descent:
+        the initial solution followed by n_starts-1 copies of it
+        perturbed with Gaussian noise
+
+        :param n_starts: The number of starting points
+        :type n_starts: int
+        :param start_scale: Standard deviation of the perturbations
+        :type start_scale: float
+        :param seed: Seed for the random perturbations
+        :type seed: int
+
+        :return: Starting points, shape (n_starts,) + initial_solution.shape
+        :rtype: numpy ndarray
+        """
+        rng = np.random.default_rng(seed)
+        theta_init = np.array(self.initial_solution, dtype=float)
+        perturbations = rng.normal(
+            scale=start_scale, size=(n_starts - 1,) + theta_init.shape
+        )
+        return np.concatenate([theta_init[None], theta_init + perturbations])
+
+    def prepare_stacked_predictions(self, thetas, theta_list):
+        """Predict the labels of the current batch for all thetas
+        of multi-start gradient descent in one forward pass and store the
+        predictions in the prediction cache, where the primary objective
+        and the base nodes evaluated on the batch features pick them up.
+        Only done for models whose predict_stacked() agrees with their predict().
+
+        :param thetas: model weights of all starting points, stacked
+        :type thetas: numpy ndarray
+        :param theta_list: thetas[k] for each starting point k,
+            the objects f and g will be evaluated with
+        :type theta_list: list(numpy ndarray)
+        """
+        prediction_cache = getattr(self.model, "prediction_cache", None)
+        if (
+            prediction_cache is None
+            or self.regime != "supervised_learning"
+            or type(self.batch_features) == list
+            or not has_stacked_predict(self.model)
+        ):
+            return
+        X = self.batch_features
+        predictions = self.model.predict_stacked(thetas, X)
+        for k, theta in enumerate(theta_list):
+            prediction_cache.store(theta, X, predictions[k])
+            # Analytic gradients predict with the untraced theta
+            prediction_cache.store(getval(theta), X, getval(predictions[k]))
+
     def objective_with_barrier(self, theta):
         """The objective function to be optimized if
         optimization_technique == 'barrier'. Adds in a
@@ -634,7 +896,20 @@ class CandidateSelection(object):
         :return: the value of the objective function
             evaluated at theta
         """
+        self._reset_prediction_cache()
+        return self.evaluate_barrier_objective(theta)
+
+    def evaluate_barrier_objective(self, theta):
+        """Evaluate :py:meth:`objective_with_barrier` without
+        first resetting the prediction cache, so that predictions
+        stored in it ahead of time for theta are used.
 
+        :param theta: model weights
+        :type theta: numpy.ndarray
+
+        :return: the value of the objective function
+            evaluated at theta
+        """
         if self.regime == "supervised_learning":
             result = self.primary_objective(
                 self.model,
@@ -646,7 +921,12 @@ class CandidateSelection(object):
 
         elif self.regime == "reinforcement_learning":
             result = -1.0 * self.primary_objective(
-                self.model, theta, self.candidate_dataset.episodes
+                self.model,
+                theta,
+                self.candidate_dataset.get_episode_columns(),
+                weighted_returns=self.candidate_dataset.get_discounted_returns(
+                    self.model.env_kwargs.get("gamma", 1.0)
+                ),
             )
 
         # Optionally adding regularization term
@@ -682,6 +962,7 @@ class CandidateSelection(object):
                 n_safety=self.n_safety,
                 regime=self.regime,
                 sub_regime=self.candidate_dataset.meta.sub_regime,
+                batch_size_candidate_eval=self.batch_size_candidate_eval,
             )
 
             pt.propagate_bounds(**bounds_kwargs)
@@ -719,13 +1000,25 @@ class CandidateSelection(object):
                 evaluated at theta.
         """
         if self.regime == "supervised_learning":
-            result = self.primary_objective(
-                self.model,
-                theta,
-                self.batch_features,
-                self.batch_labels,
-                sub_regime=self.candidate_dataset.meta.sub_regime,
-            )
+            primary_args = [self.model, theta, self.batch_features, self.batch_labels]
+            sub_regime = self.candidate_dataset.meta.sub_regime
+            N = len(self.batch_labels)
+            if (
+                self.batch_size_candidate_eval is not None
+                and self.batch_size_candidate_eval < N
+                and self.primary_objective in objectives.row_mean_objectives
+            ):
+                # Evaluate in the same chunks as the base nodes,
+                # so that the predictions of each chunk are shared
+                result = np.sum(
+                    chunked_evaluator(
+                        self._chunk_primary_objective,
+                        N=N,
+                        batch_size=self.batch_size_candidate_eval,
+                    )(*primary_args, regime=self.regime, sub_regime=sub_regime)
+                )
+            else:
+                result = self.primary_objective(*primary_args, sub_regime=sub_regime)
 
         elif self.regime == "reinforcement_learning":
             # Want to maximize the importance weight so minimize negative importance weight
@@ -734,8 +1027,10 @@ class CandidateSelection(object):
             result = -1.0 * self.primary_objective(
                 model=self.model,
                 theta=theta,
-                episodes=self.batch_dataset.episodes,
-                weighted_returns=None,
+                episodes=self.batch_dataset.get_episode_columns(),
+                weighted_returns=self.batch_dataset.get_discounted_returns(
+                    self.model.env_kwargs.get("gamma", 1.0)
+                ),
             )
         elif self.regime == "custom":
             result = self.primary_objective(self.model, theta, self.batch_data)
@@ -749,6 +1044,18 @@ class CandidateSelection(object):
         result += reg_term
         return result
 
+    def _chunk_primary_objective(self, model, theta, X, Y, **kwargs):
+        """The primary objective on a chunk of the batch, weighted by
+        the chunk's share of the batch, so that the weighted objectives
+        of the chunks sum to the objective on the whole batch.
+        Only valid for :py:data:`.objectives.row_mean_objectives`.
+
+        :return: Array of length 1
+        """
+        weight = len(Y) / len(self.batch_labels)
+        value = self.primary_objective(model, theta, X, Y, **kwargs)
+        return np.reshape(weight * value, (1,))
+
     def get_constraint_upper_bounds(self, theta):
         """The constraint functions used for KKT/gradient descent. 
         Obtains the upper bounds of the parse trees
@@ -762,9 +1069,13 @@ class CandidateSelection(object):
         """
 
         upper_bounds = []
+        self.base_node_registry.reset(theta)
+        if self.data_parallel_evaluator is not None:
+            self.data_parallel_evaluator.evaluate(theta, self.base_node_registry)
 
         for pt in self.parse_trees:
-            pt.reset_base_node_dict(reset_data=True)
+            # Prepared data is kept and only recalculated when the batch changes
+            pt.reset_base_node_dict()
             # Determine if there are additional datasets for base nodes in this parse tree
             cstr = pt.constraint_str
             if cstr in self.additional_datasets:
@@ -783,30 +1094,35 @@ class CandidateSelection(object):
                 n_safety=self.n_safety,
                 regime=self.regime,
                 sub_regime=self.candidate_dataset.meta.sub_regime,
+                base_node_registry=self.base_node_registry,
+                use_analytic_gradients=self.use_analytic_gradients,
+                batch_size_candidate_eval=self.batch_size_candidate_eval,
             )
 
             pt.propagate_bounds(**bounds_kwargs)
             upper_bounds.append(pt.root.upper)
 
-        return np.array(upper_bounds, dtype="float")
+        # Don't hold on to zhats (and their autograd traces) between steps
+        self.base_node_registry.reset()
+        return stack_values(upper_bounds, theta)
 
-    def get_importance_weights(self, theta):
+    def get_importance_weights(self, theta, log=False):
         """Get an array of importance weights evaluated on the candidate dataset
         given model weights, theta. Only applicable for RL.
 
         :param theta: model weights
         :type theta: numpy.ndarray
+        :param log: Whether to return the log of the importance weights,
+                which does not overflow for long episodes
+        :type log: bool
 
         :return: Array of upper bounds on the constraint
         :rtype: array
         """
         assert self.regime == "reinforcement_learning"
-        rho_is = []
-
-        for ii, ep in enumerate(self.candidate_dataset.episodes):
-            pi_news = self.model.get_probs_from_observations_and_actions(
-                theta, ep.observations, ep.actions, ep.action_probs
-            )
-            rho_is.append(np.prod(pi_news / ep.action_probs))
-
-        return np.array(rho_is)
+        log_rho_is = objectives.get_log_importance_weights(
+            self.model, theta, self.candidate_dataset.get_episode_columns()
+        )
+        if log:
+            return log_rho_is
+        return np.exp(log_rho_is)
@@ -0,0 +1,223 @@
+""" Module for evaluating the base nodes of the parse trees
+on shards of the candidate data in parallel worker processes """
+
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+
+import autograd.numpy as np  # Thinly-wrapped version of Numpy
+from autograd.tracer import getval
+
+from seldonian.dataset import SupervisedDataSet
+from seldonian.parse_tree.nodes import BaseNode
+from seldonian.parse_tree.analytic_gradients import attach_gradient
+from seldonian.models.prediction_cache import PredictionCache
+from seldonian.optimizers.gradient_descent import value_and_jacobian
+from seldonian.utils.stats_utils import merge_moments
+
+# The candidate selection object the worker processes evaluate
+# the base nodes with. Set before the workers are forked
+# so that they inherit the model, data and parse trees.
+_worker_cs = None
+# (shard_start, shard_end, shard dataset) of this worker. Each worker
+# is always given the same shard of a batch, so base nodes can reuse
+# the data they prepared from it while the batch does not change.
+_worker_shard = None
+
+
+def _evaluate_shard(shard_start, shard_end, theta, tasks):
+    """Evaluate the moments (mean, M2) of the zhat vector of each
+    base node on the rows [shard_start,shard_end) of the candidate data,
+    along with their Jacobians w.r.t. theta. Runs in a worker process.
+
+    :param shard_start: First row of the shard in the candidate dataset
+    :type shard_start: int
+    :param shard_end: One past the last row of the shard
+    :type shard_end: int
+    :param theta: model weights
+    :type theta: numpy ndarray
+    :param tasks: List of (parse tree index, base node name)
+    :type tasks: List(tuple)
+
+    :return: (counts, values, jacobian). counts holds the number of
+        zhat values of each base node on the shard. values holds
+        the mean and M2 of each base node in turn, and jacobian their
+        Jacobians, with shape (2*len(tasks),) + theta.shape
+    """
+    global _worker_shard
+    cs = _worker_cs
+    if _worker_shard is None or _worker_shard[:2] != (shard_start, shard_end):
+        _worker_shard = (
+            shard_start,
+            shard_end,
+            make_shard_dataset(cs.candidate_dataset, shard_start, shard_end),
+        )
+    shard_dataset = _worker_shard[2]
+    cs.model.prediction_cache = PredictionCache()
+
+    counts = []
+
+    def shard_moments(theta):
+        counts.clear()
+        moments = []
+        for tree_index, node_name in tasks:
+            pt = cs.parse_trees[tree_index]
+            node = pt.get_unique_base_node(node_name)
+            node_kwargs = pt.get_base_node_kwargs(
+                node,
+                theta=theta,
+                tree_dataset_dict={"all": shard_dataset},
+                model=cs.model,
+                branch="candidate_selection",
+                n_safety=cs.n_safety,
+                regime=cs.regime,
+                sub_regime=cs.candidate_dataset.meta.sub_regime,
+            )
+            zhat = node.zhat(**node_kwargs)
+            counts.append(len(zhat))
+            if len(zhat) == 0:
+                moments.extend([0.0, 0.0])
+                continue
+            mean = np.mean(zhat)
+            moments.extend([mean, np.sum((zhat - mean) ** 2)])
+        return np.array(moments)
+
+    values, jacobian = value_and_jacobian(shard_moments)(theta)
+    return counts, values, jacobian
+
+
+def make_shard_dataset(dataset, shard_start, shard_end):
+    """Slice the rows [shard_start,shard_end) out of a supervised dataset
+
+    :param dataset: The candidate dataset
+    :type dataset: :py:class:`.SupervisedDataSet`
+    :param shard_start: First row of the shard
+    :type shard_start: int
+    :param shard_end: One past the last row of the shard
+    :type shard_end: int
+
+    :return: The shard dataset
+    :rtype: :py:class:`.SupervisedDataSet`
+    """
+    if type(dataset.features) == list:
+        features = [x[shard_start:shard_end] for x in dataset.features]
+    else:
+        features = dataset.features[shard_start:shard_end]
+    shard_dataset = SupervisedDataSet(
+        features,
+        dataset.labels[shard_start:shard_end],
+        dataset.sensitive_attrs[shard_start:shard_end],
+        num_datapoints=shard_end - shard_start,
+        meta=dataset.meta,
+    )
+    shard_dataset.set_batch_source(dataset, shard_start, shard_end)
+    return shard_dataset
+
+
+class DataParallelEvaluator(object):
+    def __init__(self, candidate_selection, n_workers):
+        """Evaluates the base nodes of candidate selection data-parallel.
+        On each step, the current batch is split into n_workers shards.
+        Each shard is evaluated in its own forked worker process,
+        which returns the moments (n, mean, M2) of the zhat vector of every
+        base node together with their Jacobians w.r.t. theta.
+        The shard moments are merged in the parent with
+        :py:func:`.merge_moments`, with the Jacobians attached so
+        that autograd differentiates the merged t-test bounds exactly.
+        The merged moments are stored in the base node registry,
+        where :py:meth:`.BaseNode.calculate_bounds` picks them up.
+
+        Only base nodes with the built-in zhat and calculate_bounds methods,
+        bounded with the t-test in the supervised learning regime and
+        bounded on the primary dataset are evaluated this way.
+        All other base nodes are evaluated in the parent process as usual.
+
+        :param candidate_selection: The candidate selection object
+        :type candidate_selection: :py:class:`.CandidateSelection`
+        :param n_workers: The number of worker processes
+        :type n_workers: int
+        """
+        global _worker_cs
+        self.cs = candidate_selection
+        self.n_workers = n_workers
+        self.tasks = self.get_tasks()
+        _worker_cs = candidate_selection
+        # One single-process pool per shard, so that each worker
+        # always evaluates the same shard of the batch
+        self.pools = [
+            ProcessPoolExecutor(max_workers=1, mp_context=mp.get_context("fork"))
+            for _ in range(n_workers)
+        ]
+
+    def get_tasks(self):
+        """Get the base nodes that can be evaluated in the workers
+
+        :return: List of (parse tree index, base node name),
+            one for each unique base node name
+        :rtype: List(tuple)
+        """
+        tasks = []
+        node_names = set()
+        if self.cs.regime != "supervised_learning":
+            return tasks
+        for tree_index, pt in enumerate(self.cs.parse_trees):
+            if pt.constraint_str in self.cs.additional_datasets:
+                continue
+            for node in pt.get_unique_base_nodes():
+                if (
+                    type(node).zhat is not BaseNode.zhat
+                    or type(node).calculate_bounds is not BaseNode.calculate_bounds
+                    or pt.base_node_dict[node.name]["bound_method"] != "ttest"
+                    or node.name in node_names
+                ):
+                    continue
+                node_names.add(node.name)
+                tasks.append((tree_index, node.name))
+        return tasks
+
+    def evaluate(self, theta, base_node_registry):
+        """Evaluate the base nodes on the shards of the current batch
+        and store their merged moments in the base node registry
+
+        :param theta: model weights, which may be traced by autograd
+        :type theta: numpy ndarray
+        :param base_node_registry: The registry to store the moments in
+        :type base_node_registry: :py:class:`.BaseNodeRegistry`
+        """
+        if not self.tasks:
+            return
+        batch_start, batch_end = self.cs.batch_range
+        shard_bounds = np.linspace(batch_start, batch_end, self.n_workers + 1)
+        shard_bounds = [int(round(x)) for x in shard_bounds]
+        theta_val = getval(theta)
+        futures = [
+            pool.submit(
+                _evaluate_shard,
+                shard_bounds[k],
+                shard_bounds[k + 1],
+                theta_val,
+                self.tasks,
+            )
+            for k, pool in enumerate(self.pools)
+        ]
+        # All-reduce: merge the moments of the shards in order
+        results = [future.result() for future in futures]
+        for i, (tree_index, node_name) in enumerate(self.tasks):
+            moments = (0, 0.0, 0.0)
+            for counts, values, jacobian in results:
+                shard_moments = (
+                    counts[i],
+                    attach_gradient(theta, values[2 * i], jacobian[2 * i]),
+                    attach_gradient(theta, values[2 * i + 1], jacobian[2 * i + 1]),
+                )
+                moments = merge_moments(moments, shard_moments)
+            node = self.cs.parse_trees[tree_index].get_unique_base_node(node_name)
+            base_node_registry.set_zhat(
+                node, moments, moments=True, dataset=self.cs.batch_dataset
+            )
+
+    def shutdown(self):
+        """Stop the worker processes"""
+        global _worker_cs
+        for pool in self.pools:
+            pool.shutdown()
+        _worker_cs = None
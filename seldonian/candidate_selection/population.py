@@ -0,0 +1,124 @@
+""" Module for evaluating a whole population of candidate solutions
+of a black box optimizer, such as CMA-ES, at once """
+
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+
+import autograd.numpy as np  # Thinly-wrapped version of Numpy
+
+from seldonian.models.models import has_stacked_predict
+
+# The candidate selection object the worker processes evaluate
+# the population with. Set before the workers are forked
+# so that they inherit the model, data and parse trees.
+_worker_cs = None
+
+
+def _evaluate_population_chunk(thetas):
+    """Evaluate part of a population in a worker process
+
+    :param thetas: Candidate solutions
+    :type thetas: List(numpy ndarray)
+
+    :return: The barrier objective of each candidate solution
+    :rtype: List(float)
+    """
+    return evaluate_population(_worker_cs, thetas)
+
+
+def evaluate_population(candidate_selection, thetas):
+    """Evaluate the barrier objective of each candidate solution in turn.
+    For models whose predict_stacked() agrees with their predict(),
+    the labels of the candidate data are predicted for all candidate
+    solutions in a single forward pass up front and the predictions are
+    handed to the primary objective and base nodes via the prediction cache.
+
+    :param candidate_selection: The candidate selection object
+    :type candidate_selection: :py:class:`.CandidateSelection`
+    :param thetas: Candidate solutions
+    :type thetas: List(numpy ndarray)
+
+    :return: The barrier objective of each candidate solution
+    :rtype: List(float)
+    """
+    cs = candidate_selection
+    prediction_cache = getattr(cs.model, "prediction_cache", None)
+    if (
+        prediction_cache is None
+        or cs.regime != "supervised_learning"
+        or type(cs.features) == list
+        or not has_stacked_predict(cs.model)
+    ):
+        return [cs.objective_with_barrier(theta) for theta in thetas]
+
+    predictions = cs.model.predict_stacked(np.array(thetas), cs.features)
+    results = []
+    for theta, prediction in zip(thetas, predictions):
+        cs._reset_prediction_cache()
+        prediction_cache.store(theta, cs.features, prediction)
+        results.append(cs.evaluate_barrier_objective(theta))
+    return results
+
+
+class PopulationEvaluator(object):
+    def __init__(self, candidate_selection, n_workers=1):
+        """Evaluates the barrier objective of a whole population of
+        candidate solutions, e.g. one generation of CMA-ES, at once.
+        With a single worker, the population is evaluated in this process
+        with :py:func:`evaluate_population`. Otherwise it is split into
+        n_workers contiguous chunks, which are evaluated in forked
+        worker processes that persist between generations.
+
+        The base node data is prepared once in this process before
+        the workers are forked, so that the workers inherit it
+        rather than each preparing it again.
+
+        :param candidate_selection: The candidate selection object
+        :type candidate_selection: :py:class:`.CandidateSelection`
+        :param n_workers: The number of worker processes
+        :type n_workers: int
+        """
+        global _worker_cs
+        if n_workers < 1:
+            raise ValueError(f"n_workers must be at least 1, got {n_workers}")
+        self.cs = candidate_selection
+        self.n_workers = n_workers
+        self.pool = None
+        if n_workers > 1:
+            self.cs.objective_with_barrier(self.cs.initial_solution)
+            _worker_cs = candidate_selection
+            self.pool = ProcessPoolExecutor(
+                max_workers=n_workers, mp_context=mp.get_context("fork")
+            )
+
+    def evaluate(self, thetas):
+        """Evaluate the barrier objective of each candidate solution
+
+        :param thetas: Candidate solutions
+        :type thetas: List(numpy ndarray)
+
+        :return: The barrier objective of each candidate solution,
+            in the same order as thetas
+        :rtype: List(float)
+        """
+        if self.pool is None:
+            return evaluate_population(self.cs, thetas)
+        chunk_bounds = np.linspace(0, len(thetas), self.n_workers + 1)
+        chunk_bounds = [int(round(x)) for x in chunk_bounds]
+        chunks = [
+            thetas[chunk_bounds[k] : chunk_bounds[k + 1]]
+            for k in range(self.n_workers)
+            if chunk_bounds[k + 1] > chunk_bounds[k]
+        ]
+        results = []
+        for chunk_results in self.pool.map(_evaluate_population_chunk, chunks):
+            results.extend(chunk_results)
+        return results
+
+    def shutdown(self):
+        """Stop the worker processes"""
+        global _worker_cs
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+        _worker_cs = None
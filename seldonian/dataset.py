@@ -3,7 +3,8 @@
 import autograd.numpy as np
 import pandas as pd
 import pickle
-from seldonian.utils.io_utils import load_json, load_pickle
+from seldonian.utils.io_utils import load_json, load_pickle, save_pickle
+from seldonian.utils.stats_utils import discounted_returns
 
 
 class DataSetLoader:
@@ -56,7 +57,9 @@ class DataSetLoader:
             meta=meta,
         )
 
-    def load_RL_dataset_from_csv(self, filename, metadata_filename=None):
+    def load_RL_dataset_from_csv(
+        self, filename, metadata_filename=None, columnar=False
+    ):
         """Create RLDataSet object from file
         containing the episodes saved in a CSV file with format:
         episode_index,obs,action,reward,probability_of_action.
@@ -66,6 +69,9 @@ class DataSetLoader:
         :type filename: str
         :param metadata_filename: Name of metadata file
         :type metadata_filename: str
+        :param columnar: If True, store the episodes as
+            :py:class:`.EpisodeColumns` instead of a list of episodes
+        :type columnar: bool
 
         :return: :py:class:`.RLDataSet` object
         """
@@ -92,11 +98,32 @@ class DataSetLoader:
                     "Update the names of these columns, which represent the optional alternate rewards."
                 )
 
+        if columnar:
+            # Group the rows by episode, keeping the order in
+            # which the episodes first appear
+            episode_codes = pd.factorize(df.episode_index)[0]
+            df = df.iloc[np.argsort(episode_codes, kind="stable")]
+            episode_lengths = np.bincount(episode_codes)
+            if has_alt_rewards:
+                alt_reward_names = [f"R_alt_{ii}" for ii in range(1, n_alt_rewards + 1)]
+                alt_rewards = df.loc[:, alt_reward_names].values
+            else:
+                alt_rewards = []
+            episodes = EpisodeColumns(
+                observations=df.O.values,
+                actions=df.A.values,
+                rewards=df.R.values,
+                action_probs=df.pi_b.values,
+                episode_offsets=np.concatenate([[0], np.cumsum(episode_lengths)]),
+                alt_rewards=alt_rewards,
+            )
+            return RLDataSet(episodes=episodes, meta=meta)
+
         for episode_index in df.episode_index.unique():
             df_ep = df.loc[df.episode_index == episode_index]
             if has_alt_rewards:
                 alt_reward_names = [f"R_alt_{ii}" for ii in range(1, n_alt_rewards + 1)]
-                alt_rewards = df.loc[:, alt_reward_names].values
+                alt_rewards = df_ep.loc[:, alt_reward_names].values
             else:
                 alt_rewards = []
 
@@ -116,7 +143,9 @@ class DataSetLoader:
 
         return RLDataSet(episodes=episodes, meta=meta)
 
-    def load_RL_dataset_from_episode_file(self, filename, metadata_filename=None):
+    def load_RL_dataset_from_episode_file(
+        self, filename, metadata_filename=None, columnar=False
+    ):
         """Create RLDataSet object from pickle file containing list of episodes
 
         :param filename: The pickle file containing list of :py:class:`.Episode` objects
@@ -124,9 +153,15 @@ class DataSetLoader:
 
         :param metadata_filename: Optional metadata filepath.
         :type metadata_filename: str, defaults to None.
+
+        :param columnar: If True, store the episodes as
+            :py:class:`.EpisodeColumns` instead of a list of episodes
+        :type columnar: bool
         """
         required_col_names = ["episode_index", "O", "A", "R", "pi_b"]
         episodes = load_pickle(filename)
+        if columnar:
+            episodes = EpisodeColumns.from_episodes(episodes)
         meta = load_RL_metadata(metadata_filename, required_col_names)
         return RLDataSet(episodes=episodes, meta=meta)
 
@@ -146,6 +181,61 @@ class DataSet(object):
         self.num_datapoints = num_datapoints
         self.meta = meta
         self.regime = regime
+        self.mask_index = {}
+        self.batch_source = None
+
+    def get_mask_indices(self, conditional_columns):
+        """Get the (sorted) indices of the rows where each of
+        the conditional columns is 1. The index array for each
+        combination of conditional columns is computed once
+        and then reused. If this dataset is a batch of a larger
+        dataset (see :py:meth:`set_batch_source`), the indices are
+        sliced out of the larger dataset's index instead of being
+        recomputed from the sensitive attributes.
+
+        :param conditional_columns: List of sensitive column names
+        :type conditional_columns: List(str)
+
+        :return: Row indices of the joint AND mask
+        :rtype: numpy ndarray(int)
+        """
+        # Datasets pickled before the index existed won't have these
+        if not hasattr(self, "mask_index"):
+            self.mask_index = {}
+            self.batch_source = None
+
+        key = tuple(conditional_columns)
+        if key not in self.mask_index:
+            if self.batch_source is not None:
+                source_dataset, batch_start, batch_end = self.batch_source
+                source_indices = source_dataset.get_mask_indices(conditional_columns)
+                lo, hi = np.searchsorted(source_indices, [batch_start, batch_end])
+                indices = source_indices[lo:hi] - batch_start
+            else:
+                # Figure out indices of sensitive attributes from their column names
+                sensitive_col_indices = [
+                    self.sensitive_col_names.index(col) for col in conditional_columns
+                ]
+                indices = np.flatnonzero(
+                    np.all(self.sensitive_attrs[:, sensitive_col_indices] == 1, axis=1)
+                )
+            self.mask_index[key] = indices
+        return self.mask_index[key]
+
+    def set_batch_source(self, source_dataset, batch_start, batch_end):
+        """Declare that this dataset consists of the rows
+        [batch_start,batch_end) of source_dataset, so that
+        mask indices can be sliced from the source dataset
+
+        :param source_dataset: The dataset this batch was sliced from
+        :type source_dataset: :py:class:`.DataSet`
+        :param batch_start: First row of the batch in source_dataset
+        :type batch_start: int
+        :param batch_end: One past the last row of the batch in source_dataset
+        :type batch_end: int
+        """
+        self.batch_source = (source_dataset, batch_start, batch_end)
+        self.mask_index = {}
 
 
 class SupervisedDataSet(DataSet):
@@ -240,8 +330,9 @@ class RLDataSet(DataSet):
     ):
         """Class for holding reinforcement learning episodes and metadata
 
-        :param episodes: List of episodes
-        :type episodes: list(:py:class:`.Episode`)
+        :param episodes: List of episodes, or the episodes
+            in columnar storage
+        :type episodes: list(:py:class:`.Episode`) or :py:class:`.EpisodeColumns`
         :param meta: Metadata object
         :type meta: :py:class:`.RLMetaData`
         :param sensitive_attrs: Sensitive attribute array for each data point 
@@ -253,6 +344,131 @@ class RLDataSet(DataSet):
         self.episodes = episodes
         self.sensitive_attrs = sensitive_attrs
         self.sensitive_col_names = meta.sensitive_col_names
+        self.returns_cache = {}
+        self.episode_columns = None
+
+    def get_episode_columns(self):
+        """Get the episodes in columnar storage, which is what the
+        RL estimators work on. The conversion from a list of episodes
+        is done once and then reused, as are the per-timestep
+        quantities cached on the :py:class:`.EpisodeColumns` object.
+        If this dataset is a batch of a larger dataset
+        (see :py:meth:`.DataSet.set_batch_source`), the columns are
+        a view into the larger dataset's columns.
+
+        :return: :py:class:`.EpisodeColumns` object
+        """
+        # Datasets pickled before the cache existed won't have these
+        if not hasattr(self, "episode_columns"):
+            self.episode_columns = None
+        if not hasattr(self, "batch_source"):
+            self.batch_source = None
+
+        if self.episode_columns is None:
+            if self.batch_source is not None:
+                source_dataset, batch_start, batch_end = self.batch_source
+                self.episode_columns = source_dataset.get_episode_columns()[
+                    batch_start:batch_end
+                ]
+            else:
+                self.episode_columns = EpisodeColumns.from_episodes(self.episodes)
+        return self.episode_columns
+
+    def precompute(self, gamma):
+        """Calculate everything about the episodes that does not depend
+        on the policy parameters: the columnar episodes, the index of
+        each timestep within its episode, the per-timestep discounts
+        and the discounted returns of the primary and any alternate rewards.
+
+        :param gamma: The discount factor
+        :type gamma: float
+        """
+        episode_columns = self.get_episode_columns()
+        # The per-timestep indices are cached on first access
+        episode_columns.timesteps
+        episode_columns.episode_ids
+        episode_columns.get_discounts(gamma)
+        self.get_discounted_returns(gamma)
+        if episode_columns.n_alt_rewards > 0:
+            self.get_discounted_returns(gamma, alt_reward_number=1)
+
+    def save_precomputed(self, filename, verbose=False):
+        """Save the precomputed quantities (see :py:meth:`precompute`)
+        to a pickle file, so they can be loaded alongside the
+        dataset with :py:meth:`load_precomputed` instead of being
+        calculated again
+
+        :param filename: A filename for the saved pickle file
+        :type filename: str
+        :param verbose: Boolean verbosity flag
+        """
+        precomputed = {
+            "episode_columns": self.get_episode_columns(),
+            "returns_cache": self.returns_cache,
+        }
+        save_pickle(filename, precomputed, verbose=verbose)
+
+    def load_precomputed(self, filename):
+        """Load quantities saved with :py:meth:`save_precomputed`
+
+        :param filename: A filename pointing to the pickle file
+        :type filename: str
+        """
+        precomputed = load_pickle(filename)
+        episode_columns = precomputed["episode_columns"]
+        if len(episode_columns) != self.num_datapoints:
+            raise RuntimeError(
+                f"Precomputed quantities in {filename} are for "
+                f"{len(episode_columns)} episodes, but the dataset "
+                f"has {self.num_datapoints} episodes"
+            )
+        self.episode_columns = episode_columns
+        self.returns_cache = precomputed["returns_cache"]
+
+    def get_discounted_returns(self, gamma, alt_reward_number=None):
+        """Get the discounted return of every episode.
+        The returns are calculated once per discount factor
+        and reward function and then reused. When an alternate
+        reward is requested, the returns of all alternate rewards
+        are calculated together. If this dataset is a batch of
+        a larger dataset (see :py:meth:`.DataSet.set_batch_source`),
+        the returns are sliced out of the larger dataset's returns.
+
+        :param gamma: The discount factor
+        :type gamma: float
+        :param alt_reward_number: Which alternate reward to use
+            instead of the primary reward. 1-indexed.
+            If None, the primary reward is used.
+        :type alt_reward_number: int
+
+        :return: The discounted return of each episode
+        :rtype: numpy ndarray
+        """
+        # Datasets pickled before the cache existed won't have these
+        if not hasattr(self, "returns_cache"):
+            self.returns_cache = {}
+        if not hasattr(self, "batch_source"):
+            self.batch_source = None
+
+        key = (gamma, alt_reward_number is not None)
+        if key not in self.returns_cache:
+            if self.batch_source is not None:
+                source_dataset, batch_start, batch_end = self.batch_source
+                # Make sure the source has the returns cached
+                source_dataset.get_discounted_returns(gamma, alt_reward_number)
+                self.returns_cache[key] = source_dataset.returns_cache[key][
+                    batch_start:batch_end
+                ]
+            else:
+                self.returns_cache[key] = calculate_episode_returns(
+                    self.get_episode_columns(),
+                    gamma,
+                    alt_rewards=alt_reward_number is not None,
+                )
+        returns = self.returns_cache[key]
+        if alt_reward_number is not None:
+            return returns[:, alt_reward_number - 1]
+        return returns
 
 
 class CustomDataSet(DataSet):
@@ -302,11 +518,11 @@ class Episode(object):
             a new reward function other than the primary reward function.
         :type alt_rewards: numpy.ndarray
         """
-        self.observations = np.array(observations)
-        self.actions = np.array(actions)
-        self.rewards = np.array(rewards)
-        self.action_probs = np.array(action_probs)
-        self.alt_rewards = np.array(alt_rewards)
+        self.observations = np.asarray(observations)
+        self.actions = np.asarray(actions)
+        self.rewards = np.asarray(rewards)
+        self.action_probs = np.asarray(action_probs)
+        self.alt_rewards = np.asarray(alt_rewards)
         self.n_alt_rewards = (
             0 if self.alt_rewards.size == 0 else self.alt_rewards.shape[1]
         )
@@ -341,6 +557,260 @@ class Episode(object):
         return repr_s
 
 
+class EpisodeColumns(object):
+    def __init__(
+        self,
+        observations,
+        actions,
+        rewards,
+        action_probs,
+        episode_offsets,
+        alt_rewards=[],
+    ):
+        """Columnar storage for a collection of RL episodes.
+        The timesteps of all episodes are concatenated into one array
+        per quantity, and episode i consists of the timesteps
+        episode_offsets[i]:episode_offsets[i+1] (CSR style).
+
+        Can be used wherever a list of episodes is expected,
+        e.g. as the episodes of an :py:class:`.RLDataSet`: it supports
+        len(), iteration and indexing. Indexing with an int builds an
+        :py:class:`.Episode` whose arrays are views into the columns.
+        Indexing with a contiguous slice returns a new EpisodeColumns
+        that shares memory with this one. Indexing with an array of
+        indices or a boolean mask returns a copy.
+
+        :param observations: Observations of all timesteps
+        :type observations: numpy.ndarray
+        :param actions: Actions of all timesteps
+        :type actions: numpy.ndarray
+        :param rewards: Primary rewards of all timesteps
+        :type rewards: numpy.ndarray
+        :param action_probs: Action probabilities from the
+            behavior policy of all timesteps
+        :type action_probs: numpy.ndarray
+        :param episode_offsets: Index of the first timestep of each episode,
+            followed by the total number of timesteps.
+            Length is the number of episodes + 1.
+        :type episode_offsets: numpy.ndarray(int)
+        :param alt_rewards: A 2D array where each column contains
+            the alternate rewards of all timesteps
+        :type alt_rewards: numpy.ndarray
+        """
+        self.observations = np.asarray(observations)
+        self.actions = np.asarray(actions)
+        self.rewards = np.asarray(rewards)
+        self.action_probs = np.asarray(action_probs)
+        self.episode_offsets = np.asarray(episode_offsets, dtype=int)
+        self.alt_rewards = np.asarray(alt_rewards)
+        self.n_alt_rewards = (
+            0 if self.alt_rewards.size == 0 else self.alt_rewards.shape[1]
+        )
+        # Calculated on first use, as they don't depend on the policy
+        self._timesteps = None
+        self._episode_ids = None
+        self.discount_cache = {}
+
+    @classmethod
+    def from_episodes(cls, episodes):
+        """Create the columnar storage from a list of episodes.
+        If episodes is already an EpisodeColumns object,
+        it is returned as is.
+
+        :param episodes: List of episodes
+        :type episodes: list(:py:class:`.Episode`)
+
+        :return: :py:class:`.EpisodeColumns` object
+        """
+        if isinstance(episodes, EpisodeColumns):
+            return episodes
+        episode_lengths = [len(ep.rewards) for ep in episodes]
+        episode_offsets = np.concatenate([[0], np.cumsum(episode_lengths)])
+        # Episodes pickled by older versions may not have alt_rewards
+        if len(episodes) > 0 and np.size(getattr(episodes[0], "alt_rewards", [])) > 0:
+            alt_rewards = np.vstack([ep.alt_rewards for ep in episodes])
+        else:
+            alt_rewards = []
+        return cls(
+            observations=np.concatenate([ep.observations for ep in episodes]),
+            actions=np.concatenate([ep.actions for ep in episodes]),
+            rewards=np.concatenate([ep.rewards for ep in episodes]),
+            action_probs=np.concatenate([ep.action_probs for ep in episodes]),
+            episode_offsets=episode_offsets,
+            alt_rewards=alt_rewards,
+        )
+
+    @property
+    def episode_lengths(self):
+        """The number of timesteps in each episode"""
+        return np.diff(self.episode_offsets)
+
+    @property
+    def episode_ids(self):
+        """The index of the episode that each timestep belongs to"""
+        if self._episode_ids is None:
+            self._episode_ids = np.repeat(np.arange(len(self)), self.episode_lengths)
+        return self._episode_ids
+
+    @property
+    def timesteps(self):
+        """The index of each timestep within its own episode"""
+        if self._timesteps is None:
+            self._timesteps = np.arange(self.episode_offsets[-1]) - np.repeat(
+                self.episode_offsets[:-1], self.episode_lengths
+            )
+        return self._timesteps
+
+    def get_discounts(self, gamma):
+        """Get gamma**t for every timestep, where t is
+        the index of the timestep within its own episode
+
+        :param gamma: The discount factor
+        :type gamma: float
+
+        :return: The discount of each timestep
+        :rtype: numpy ndarray
+        """
+        if gamma not in self.discount_cache:
+            self.discount_cache[gamma] = np.power(gamma, self.timesteps)
+        return self.discount_cache[gamma]
+
+    def __len__(self):
+        return len(self.episode_offsets) - 1
+
+    def __iter__(self):
+        for ii in range(len(self)):
+            yield self.get_episode(ii)
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            if key < 0:
+                key += len(self)
+            if not 0 <= key < len(self):
+                raise IndexError("episode index out of range")
+            return self.get_episode(key)
+
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step == 1:
+                stop = max(start, stop)
+                lo, hi = self.episode_offsets[start], self.episode_offsets[stop]
+                return self._take_timesteps(
+                    slice(lo, hi), self.episode_offsets[start : stop + 1] - lo
+                )
+
+        episode_indices = np.arange(len(self))[key]
+        episode_lengths = self.episode_lengths[episode_indices]
+        new_offsets = np.concatenate([[0], np.cumsum(episode_lengths)])
+        # Gather the timesteps of each selected episode
+        timestep_indices = np.arange(new_offsets[-1]) + np.repeat(
+            self.episode_offsets[episode_indices] - new_offsets[:-1], episode_lengths
+        )
+        return self._take_timesteps(timestep_indices, new_offsets)
+
+    def __add__(self, other):
+        """Concatenate the episodes of two EpisodeColumns objects
+
+        :param other: A second EpisodeColumns object
+        :return: An EpisodeColumns object with the episodes
+            of self followed by the episodes of other
+        """
+        if not isinstance(other, EpisodeColumns):
+            raise ValueError(
+                "Can only add EpisodeColumns objects with other EpisodeColumns objects"
+            )
+        if self.n_alt_rewards > 0:
+            alt_rewards = np.vstack([self.alt_rewards, other.alt_rewards])
+        else:
+            alt_rewards = []
+        return EpisodeColumns(
+            observations=np.concatenate([self.observations, other.observations]),
+            actions=np.concatenate([self.actions, other.actions]),
+            rewards=np.concatenate([self.rewards, other.rewards]),
+            action_probs=np.concatenate([self.action_probs, other.action_probs]),
+            episode_offsets=np.concatenate(
+                [
+                    self.episode_offsets,
+                    other.episode_offsets[1:] + self.episode_offsets[-1],
+                ]
+            ),
+            alt_rewards=alt_rewards,
+        )
+
+    def get_episode(self, index):
+        """Build an :py:class:`.Episode` whose arrays are
+        views into the columns
+
+        :param index: The index of the episode
+        :type index: int
+
+        :return: :py:class:`.Episode` object
+        """
+        lo, hi = self.episode_offsets[index], self.episode_offsets[index + 1]
+        return Episode(
+            observations=self.observations[lo:hi],
+            actions=self.actions[lo:hi],
+            rewards=self.rewards[lo:hi],
+            action_probs=self.action_probs[lo:hi],
+            alt_rewards=self.alt_rewards[lo:hi] if self.n_alt_rewards > 0 else [],
+        )
+
+    def _take_timesteps(self, timestep_index, episode_offsets):
+        """Make a new EpisodeColumns from a subset of the timesteps,
+        which must consist of whole episodes. The cached timestep
+        indices and discounts carry over.
+
+        :param timestep_index: A slice or an index array into the timesteps
+        :param episode_offsets: The episode offsets of the new object
+        :type episode_offsets: numpy.ndarray(int)
+        """
+        episode_columns = EpisodeColumns(
+            observations=self.observations[timestep_index],
+            actions=self.actions[timestep_index],
+            rewards=self.rewards[timestep_index],
+            action_probs=self.action_probs[timestep_index],
+            episode_offsets=episode_offsets,
+            alt_rewards=(
+                self.alt_rewards[timestep_index] if self.n_alt_rewards > 0 else []
+            ),
+        )
+        if self._timesteps is not None:
+            episode_columns._timesteps = self._timesteps[timestep_index]
+        episode_columns.discount_cache = {
+            gamma: discounts[timestep_index]
+            for gamma, discounts in self.discount_cache.items()
+        }
+        return episode_columns
+
+
+def calculate_episode_returns(episodes, gamma, alt_rewards=False):
+    """Calculate the discounted return of each episode
+    in a single vectorized pass over all timesteps
+
+    :param episodes: List of episodes
+    :type episodes: list(:py:class:`.Episode`)
+    :param gamma: The discount factor
+    :type gamma: float
+    :param alt_rewards: If True, calculate the returns of the
+        alternate rewards instead of the primary reward
+    :type alt_rewards: bool
+
+    :return: The discounted returns, of shape (n_episodes,)
+        or (n_episodes, n_alt_rewards) if alt_rewards is True
+    :rtype: numpy ndarray
+    """
+    if isinstance(episodes, EpisodeColumns):
+        rewards = episodes.alt_rewards if alt_rewards else episodes.rewards
+        return discounted_returns(rewards, episodes.episode_lengths, gamma)
+
+    episode_lengths = [len(ep.rewards) for ep in episodes]
+    if alt_rewards:
+        rewards = np.vstack([ep.alt_rewards for ep in episodes])
+    else:
+        rewards = np.concatenate([ep.rewards for ep in episodes])
+    return discounted_returns(rewards, episode_lengths, gamma)
+
+
 class MetaData(object):
     def __init__(self, regime, sub_regime, all_col_names, sensitive_col_names=None):
         """Base class for holding dataset metadata
@@ -44,6 +44,19 @@ class LinearRegressionModel(RegressionModel):
         """
         return theta[0] + (X @ theta[1:])
 
+    def predict_stacked(self, thetas, X):
+        """Predict labels for K sets of weights at once
+        with a single (N x j) @ (j x K) product
+
+        :param thetas: The parameter weights, one row per theta
+        :type thetas: array of shape (K,j+1)
+        :param X: The features
+        :type X: array of shape (N,j)
+        :return: predicted labels for each theta
+        :rtype: array of shape (K,N)
+        """
+        return thetas[:, 0:1] + (X @ thetas[:, 1:].T).T
+
     def fit(self, X, Y):
         """Train the model using the feature,label pairs
 
@@ -188,6 +201,20 @@ class BinaryLogisticRegressionModel(BaseLogisticRegressionModel):
         Y_pred = 1 / (1 + np.exp(-Z))
         return Y_pred
 
+    def predict_stacked(self, thetas, X):
+        """Predict the probability of having the positive class label
+        for K sets of weights at once with a single (i,j) x (j,K) product
+
+        :param thetas: The parameter weights, one row per theta
+        :type thetas: array of shape (K,j)
+        :param X: The features
+        :type X: array of shape (i,j-1)
+        :return: predictions for each theta and each observation
+        :rtype: array of shape (K,i)
+        """
+        Z = thetas[:, 0:1] + (X @ thetas[:, 1:].T).T  # (K,i)
+        return 1 / (1 + np.exp(-Z))
+
 
 class MultiClassLogisticRegressionModel(BaseLogisticRegressionModel):
     def __init__(self):
@@ -216,6 +243,20 @@ class MultiClassLogisticRegressionModel(BaseLogisticRegressionModel):
 
         return Y_pred
 
+    def predict_stacked(self, thetas, X):
+        """Predict the probability of having each class label
+        for K sets of weights at once
+
+        :param thetas: The parameter weights, one (j,k) matrix per theta
+        :type thetas: array of shape (K,j,k)
+        :param X: The features
+        :type X: array of shape (i,j-1)
+        :return: predictions for each theta, observation and class
+        :rtype: array of shape (K,i,k)
+        """
+        Z = thetas[:, 0:1, :] + np.einsum("ij,Kjk->Kik", X, thetas[:, 1:, :])
+        return np.exp(Z) / np.sum(np.exp(Z), axis=-1, keepdims=True)
+
 
 class DummyClassifierModel(ClassificationModel):
     def __init__(self):
@@ -259,3 +300,46 @@ class RandomClassifierModel(ClassificationModel):
         :rtype: float
         """
         return 0.5 * np.ones(len(X))
+
+
+def has_stacked_predict(model):
+    """Check whether the model can predict for several thetas at once
+    with predict_stacked(), and whether that agrees with its predict(),
+    i.e. predict_stacked() is defined by the class that defines predict()
+    or by one of its subclasses. A subclass that overrides predict()
+    but not predict_stacked() does not qualify.
+
+    :param model: The Seldonian model object
+    :type model: :py:class:`.SeldonianModel` object
+    :rtype: bool
+    """
+    return is_defined_with(model, "predict_stacked", "predict")
+
+
+def is_defined_with(obj, method_name, *other_names):
+    """Check whether obj has the method method_name and whether it agrees
+    with the methods other_names, i.e. method_name is defined by each class
+    that defines one of other_names or by one of its subclasses.
+    A subclass that overrides one of other_names but not method_name
+    does not qualify.
+
+    :param obj: The object whose methods to check
+    :param method_name: The name of the method, e.g. a faster or
+        more stable variant of the methods other_names
+    :type method_name: str
+    :param other_names: The names of the methods it must agree with
+    :type other_names: str
+    :rtype: bool
+    """
+    defining_classes = {}
+    for cls in type(obj).__mro__:
+        for name in (method_name,) + other_names:
+            if name not in defining_classes and name in vars(cls):
+                defining_classes[name] = cls
+    method_class = defining_classes.get(method_name)
+    return method_class is not None and all(
+        issubclass(method_class, defining_classes[name])
+        for name in other_names
+        if name in defining_classes
+    )
+
@@ -1,14 +1,20 @@
 """ Objective functions """
 
 import autograd.numpy as np  # Thinly-wrapped version of Numpy
+from autograd.scipy.special import logsumexp
 import math
 
 from seldonian.utils.stats_utils import (
-    weighted_sum_gamma,
-    custom_cumprod,
     stability_const,
+    segment_sum,
+    segment_cumsum,
+    exp_weighted,
+    exp_weighted_mean,
 )
-from seldonian.models.models import BaseLogisticRegressionModel
+from seldonian.dataset import EpisodeColumns, calculate_episode_returns
+from seldonian.models.models import BaseLogisticRegressionModel, is_defined_with
+from seldonian.models.prediction_cache import cached_predict
+from seldonian.utils.array_utils import array_namespace, as_array_like
 
 """ Supervised learning objectives """
 
@@ -31,8 +37,9 @@ def Mean_Squared_Error(model, theta, X, Y, **kwargs):
     :rtype: float
     """
     n = len(Y)  # Y guaranteed to be a numpy array, X isn't.
-    prediction = model.predict(theta, X)  # vector of values
-    res = sum(pow(prediction - Y, 2)) / n
+    prediction = cached_predict(model, theta, X)  # vector of values
+    xp = array_namespace(prediction)
+    res = xp.sum(pow(prediction - as_array_like(Y, prediction), 2)) / n
 
     return res
 
@@ -58,7 +65,7 @@ def gradient_Mean_Squared_Error(model, theta, X, Y, **kwargs):
             " to get the gradient."
         )
     n = len(Y)
-    prediction = model.predict(theta, X)  # vector of values
+    prediction = cached_predict(model, theta, X)  # vector of values
     err = prediction - Y
     X_withintercept = np.hstack([np.ones((n, 1)), np.array(X)])
     return 2 / n * np.dot(err, X_withintercept)
@@ -80,7 +87,7 @@ def Mean_Error(model, theta, X, Y, **kwargs):
     :rtype: float
     """
     n = len(X)
-    prediction = model.predict(theta, X)  # vector of values
+    prediction = cached_predict(model, theta, X)  # vector of values
     res = sum(prediction - Y) / n
     return res
 
@@ -111,7 +118,7 @@ def gradient_Bounded_Squared_Error(model, theta, X, Y, **kwargs):
     c1 = y_hat_max - y_hat_min
     c2 = -y_hat_min
 
-    Y_hat = model.predict(theta, X)  # vector of values
+    Y_hat = cached_predict(model, theta, X)  # vector of values
     Y_hat_old = (Y_hat - y_hat_min) / (y_hat_max - y_hat_min)
     sig = model._sigmoid(Y_hat_old)
 
@@ -139,16 +146,18 @@ def binary_logistic_loss(model, theta, X, Y, **kwargs):
     :return: mean logistic loss
     :rtype: float
     """
-    Y_pred = model.predict(theta, X)
+    Y_pred = cached_predict(model, theta, X)
     # Add stability constant. This guards against
     # predictions that are 0 or 1, which cause log(Y_pred) or
     # log(1.0-Y_pred) to be nan. If Y==0 and Y_pred == 1,
     # cost will be np.log(1e-15) ~ -34.
     # Similarly if Y==1 and Y_pred == 0.
     # It's a ceiling in the cost function, essentially.
-    res = np.mean(
-        -Y * np.log(Y_pred + stability_const)
-        - (1.0 - Y) * np.log(1.0 - Y_pred + stability_const)
+    xp = array_namespace(Y_pred)
+    Y = as_array_like(Y, Y_pred)
+    res = xp.mean(
+        -Y * xp.log(Y_pred + stability_const)
+        - (1.0 - Y) * xp.log(1.0 - Y_pred + stability_const)
     )
     return res
 
@@ -172,7 +181,7 @@ def gradient_binary_logistic_loss(model, theta, X, Y, **kwargs):
     """
     assert isinstance(model, BaseLogisticRegressionModel)
 
-    h = model.predict(theta, X)
+    h = cached_predict(model, theta, X)
     X_withintercept = np.hstack([np.ones((len(X), 1)), np.array(X)])
     res = (1 / len(X)) * np.dot(X_withintercept.T, (h - Y))
     return res
@@ -199,10 +208,11 @@ def multiclass_logistic_loss(model, theta, X, Y, **kwargs):
     # for the ith sample. We need to get the probability of predicting
     # the true class for each sample and then take the sum of the
     # logs of that.
-    Y_pred = model.predict(theta, X)
+    Y_pred = cached_predict(model, theta, X)
     N = len(Y)
     probs_trueclasses = Y_pred[np.arange(N), Y.astype("int")]
-    return -1 / N * sum(np.log(probs_trueclasses))
+    xp = array_namespace(probs_trueclasses)
+    return -1 / N * xp.sum(xp.log(probs_trueclasses))
 
 
 def Positive_Rate(model, theta, X, Y, **kwargs):
@@ -247,7 +257,7 @@ def _Positive_Rate_binary(model, theta, X, Y, **kwargs):
     :return: Mean positive rate
     :rtype: float between 0 and 1
     """
-    prediction = model.predict(theta, X)
+    prediction = cached_predict(model, theta, X)
     return np.sum(prediction) / len(X)  # if all 1s then PR=1.
 
 
@@ -270,7 +280,7 @@ def _Positive_Rate_multiclass(model, theta, X, Y, class_index, **kwargs):
     :return: Mean positive rate
     :rtype: float between 0 and 1
     """
-    prediction = model.predict(theta, X)
+    prediction = cached_predict(model, theta, X)
     return np.sum(prediction[:, class_index]) / len(X)  # if all 1s then PR=1.
 
 
@@ -317,7 +327,7 @@ def _Negative_Rate_binary(model, theta, X, Y, **kwargs):
     :return: Mean negative rate
     :rtype: float between 0 and 1
     """
-    prediction = model.predict(theta, X)
+    prediction = cached_predict(model, theta, X)
     return np.sum(1.0 - prediction) / len(X)  # if all 1s then PR=1.
 
 
@@ -340,7 +350,7 @@ def _Negative_Rate_multiclass(model, theta, X, Y, class_index, **kwargs):
     :return: Mean negative rate
     :rtype: float between 0 and 1
     """
-    prediction = model.predict(theta, X)
+    prediction = cached_predict(model, theta, X)
     return np.sum(1.0 - prediction[:, class_index]) / len(X)
 
 
@@ -388,7 +398,7 @@ def _False_Positive_Rate_binary(model, theta, X, Y, **kwargs):
     :rtype: float between 0 and 1
     """
 
-    prediction = model.predict(theta, X)
+    prediction = cached_predict(model, theta, X)
     neg_mask = Y != 1.0
     return np.sum(prediction[neg_mask]) / len(X[neg_mask])
 
@@ -413,7 +423,7 @@ def _False_Positive_Rate_multiclass(model, theta, X, Y, class_index, **kwargs):
     :rtype: float between 0 and 1
     """
 
-    prediction = model.predict(theta, X)
+    prediction = cached_predict(model, theta, X)
 
     neg_mask = Y != class_index
     return np.sum(prediction[:, class_index][neg_mask]) / len(X[neg_mask])
@@ -462,7 +472,7 @@ def _False_Negative_Rate_binary(model, theta, X, Y, **kwargs):
     :rtype: float between 0 and 1
     """
 
-    prediction = model.predict(theta, X)
+    prediction = cached_predict(model, theta, X)
     pos_mask = Y == 1.0
     return np.sum(1.0 - prediction[pos_mask]) / len(X[pos_mask])
 
@@ -487,7 +497,7 @@ def _False_Negative_Rate_multiclass(model, theta, X, Y, class_index, **kwargs):
     :return: Mean false negative rate
     :rtype: float between 0 and 1
     """
-    prediction = model.predict(theta, X)
+    prediction = cached_predict(model, theta, X)
     pos_mask = Y == class_index
     return np.sum(1.0 - prediction[:, class_index][pos_mask]) / len(X[pos_mask])
 
@@ -535,7 +545,7 @@ def _True_Positive_Rate_binary(model, theta, X, Y, **kwargs):
     :rtype: float between 0 and 1
     """
 
-    prediction = model.predict(theta, X)
+    prediction = cached_predict(model, theta, X)
     pos_mask = Y == 1.0
     return np.sum(prediction[pos_mask]) / len(X[pos_mask])
 
@@ -559,7 +569,7 @@ def _True_Positive_Rate_multiclass(model, theta, X, Y, class_index, **kwargs):
     :return: Mean true positive rate
     :rtype: float between 0 and 1
     """
-    prediction = model.predict(theta, X)
+    prediction = cached_predict(model, theta, X)
     pos_mask = Y == class_index
     return np.sum(prediction[:, class_index][pos_mask]) / len(X[pos_mask])
 
@@ -606,7 +616,7 @@ def _True_Negative_Rate_binary(model, theta, X, Y, **kwargs):
     :return: Mean true negative rate
     :rtype: float between 0 and 1
     """
-    prediction = model.predict(theta, X)
+    prediction = cached_predict(model, theta, X)
     neg_mask = Y != 1.0
     return np.sum(1.0 - prediction[neg_mask]) / len(X[neg_mask])
 
@@ -630,7 +640,7 @@ def _True_Negative_Rate_multiclass(model, theta, X, Y, class_index, **kwargs):
     :return: Mean true negative rate
     :rtype: float between 0 and 1
     """
-    prediction = model.predict(theta, X)
+    prediction = cached_predict(model, theta, X)
     neg_mask = Y != class_index
     return np.sum(1.0 - prediction[:, class_index][neg_mask]) / len(X[neg_mask])
 
@@ -670,7 +680,7 @@ def _Error_Rate_binary(model, theta, X, Y, **kwargs):
     :rtype: float
     """
     n = len(X)
-    Y_pred_probs = model.predict(theta, X)
+    Y_pred_probs = cached_predict(model, theta, X)
     res = np.sum(Y * (1 - Y_pred_probs) + (1 - Y) * Y_pred_probs) / n
     return res
 
@@ -691,7 +701,7 @@ def _Error_Rate_multiclass(model, theta, X, Y, **kwargs):
     :rtype: float between 0 and 1
     """
     n = len(X)
-    Y_pred_probs = model.predict(theta, X)
+    Y_pred_probs = cached_predict(model, theta, X)
     res = np.sum(1.0 - Y_pred_probs[np.arange(n), Y]) / n
     return res
 
@@ -721,7 +731,7 @@ def confusion_matrix(model, theta, X, Y, l_i, l_k, **kwargs):
     :return: C[l_i,l_k]
     :rtype: float
     """
-    Y_pred = model.predict(theta, X)  # i x k
+    Y_pred = cached_predict(model, theta, X)  # i x k
     true_mask = Y == l_i  # length i
     N_mask = sum(true_mask)
 
@@ -729,40 +739,120 @@ def confusion_matrix(model, theta, X, Y, l_i, l_k, **kwargs):
     return res
 
 
+# Objectives that are the mean of a per-datapoint loss. These can be
+# evaluated on chunks of the data and the chunks combined by their weighted
+# mean, e.g. with the batch_size_candidate_eval hyperparameter
+row_mean_objectives = [
+    Mean_Squared_Error,
+    Mean_Error,
+    binary_logistic_loss,
+    multiclass_logistic_loss,
+]
+
+
 """ Reinforcement learning objectives """
 
 
-def IS_estimate(model, theta, episodes, **kwargs):
-    """Calculate the vanilla importance sampling estimate
-    using all episodes.
+def has_log_probs(model):
+    """Check whether the model's log action probabilities agree with
+    its action probabilities, i.e. neither the model nor its policy
+    overrides get_probs_from_observations_and_actions()
+    (or the policy's get_prob_this_action()) without also overriding
+    get_log_probs_from_observations_and_actions()
+
+    :param model: SeldonianModel instance
+    :rtype: bool
+    """
+    log_method = "get_log_probs_from_observations_and_actions"
+    probs_method = "get_probs_from_observations_and_actions"
+    if not is_defined_with(model, log_method, probs_method):
+        return False
+    policy = getattr(model, "policy", None)
+    return policy is None or is_defined_with(
+        policy, log_method, probs_method, "get_prob_this_action"
+    )
+
+
+def get_log_importance_ratios(model, theta, episode_columns):
+    """Calculate log(pi_new/pi_b) for every timestep of every episode,
+    getting the new policy's log action probabilities with a single call
+    to the model. If the model or its policy only overrides the action
+    probabilities (see :py:func:`has_log_probs`), their log is taken
+    instead. If the model has importance_ratio_bounds,
+    the ratios are clipped to them.
 
     :param model: SeldonianModel instance
     :param theta: The parameter weights
     :type theta: numpy ndarray
-    :param episodes: List of episodes
-    :return: The IS estimate 
-    :rtype: float
+    :param episode_columns: The episodes in columnar storage
+    :type episode_columns: :py:class:`.EpisodeColumns`
+    :return: The log importance ratio of each timestep
+    :rtype: numpy ndarray(float)
     """
-
-    if "gamma" in model.env_kwargs:
-        gamma = model.env_kwargs["gamma"]
+    args = (
+        theta,
+        episode_columns.observations,
+        episode_columns.actions,
+        episode_columns.action_probs,
+    )
+    if has_log_probs(model):
+        log_pi_news = model.get_log_probs_from_observations_and_actions(*args)
     else:
-        gamma = 1.0
-    # Calculate the expected returns of the primary reward under the behavior policy
-    weighted_returns = [weighted_sum_gamma(ep.rewards, gamma=gamma) for ep in episodes]
+        log_pi_news = np.log(model.get_probs_from_observations_and_actions(*args))
+    log_ratios = log_pi_news - np.log(episode_columns.action_probs)
+
+    importance_ratio_bounds = getattr(model, "importance_ratio_bounds", None)
+    if importance_ratio_bounds is not None:
+        lower, upper = importance_ratio_bounds
+        log_lower = -np.inf if not lower else np.log(lower)
+        log_upper = np.inf if upper is None else np.log(upper)
+        log_ratios = np.clip(log_ratios, log_lower, log_upper)
+    return log_ratios
 
-    IS_est = 0
-    for ii, ep in enumerate(episodes):
-        pi_news = model.get_probs_from_observations_and_actions(
-            theta, ep.observations, ep.actions, ep.action_probs
-        )
-        pi_ratios = pi_news / ep.action_probs
-        pi_ratio_prod = np.prod(pi_ratios)
 
-        IS_est += pi_ratio_prod * weighted_returns[ii]
+def get_log_importance_weights(model, theta, episode_columns):
+    """Calculate the log of the importance weight,
+    the product of the importance ratios over all timesteps,
+    of each episode.
+
+    :param model: SeldonianModel instance
+    :param theta: The parameter weights
+    :type theta: numpy ndarray
+    :param episode_columns: The episodes in columnar storage
+    :type episode_columns: :py:class:`.EpisodeColumns`
+    :return: The log importance weight of each episode
+    :rtype: numpy ndarray(float)
+    """
+    log_ratios = get_log_importance_ratios(model, theta, episode_columns)
+    return segment_sum(log_ratios, episode_columns.episode_ids, len(episode_columns))
 
-    IS_est /= len(episodes)
 
+def IS_estimate(model, theta, episodes, weighted_returns=None, **kwargs):
+    """Calculate the vanilla importance sampling estimate
+    using all episodes.
+
+    :param model: SeldonianModel instance
+    :param theta: The parameter weights
+    :type theta: numpy ndarray
+    :param episodes: List of episodes
+    :param weighted_returns: A pre-calculated array of the discounted
+        primary returns of the episodes. Calculated from the
+        episodes if None.
+    :return: The IS estimate 
+    :rtype: float
+    """
+    episode_columns = EpisodeColumns.from_episodes(episodes)
+    if weighted_returns is None:
+        if "gamma" in model.env_kwargs:
+            gamma = model.env_kwargs["gamma"]
+        else:
+            gamma = 1.0
+        # Calculate the expected returns of the primary reward under the behavior policy
+        weighted_returns = calculate_episode_returns(episode_columns, gamma)
+
+    # mean(rho_i * G_i), calculated in log space so the products don't overflow
+    log_rhos = get_log_importance_weights(model, theta, episode_columns)
+    IS_est = exp_weighted_mean(log_rhos, weighted_returns)
     return IS_est
 
 
@@ -779,25 +869,26 @@ def PDIS_estimate(model, theta, episodes, **kwargs):
     """
 
     gamma = model.env_kwargs["gamma"] if "gamma" in model.env_kwargs else 1.0
-    PDIS_est = 0.0
-    for ep in episodes:
-        discount = np.power(gamma, range(len(ep.rewards)))
-        pi_news = model.get_probs_from_observations_and_actions(
-            theta, ep.observations, ep.actions, ep.action_probs
-        )
-        pi_ratios = pi_news / ep.action_probs
-
-        # autograd doesn't support np.cumprod
-        pi_ratio_prods = custom_cumprod(pi_ratios)
-
-        PDIS_est += np.sum(pi_ratio_prods * discount * ep.rewards)
-
-    PDIS_est /= len(episodes)
+    episode_columns = EpisodeColumns.from_episodes(episodes)
+    timesteps = episode_columns.timesteps
+    discount = episode_columns.get_discounts(gamma)
+    log_ratios = get_log_importance_ratios(model, theta, episode_columns)
+    # Importance weight of each timestep is the product of the
+    # importance ratios up to and including that timestep
+    log_pi_ratio_prods = segment_cumsum(log_ratios, timesteps)
+
+    # Sum over all timesteps of the weighted, discounted rewards,
+    # calculated in log space so the products don't overflow
+    discounted_rewards = discount * episode_columns.rewards
+    PDIS_est = exp_weighted_mean(log_pi_ratio_prods, discounted_rewards) * len(
+        discounted_rewards
+    )
+    PDIS_est /= len(episode_columns)
 
     return PDIS_est
 
 
-def WIS_estimate(model, theta, episodes, **kwargs):
+def WIS_estimate(model, theta, episodes, weighted_returns=None, **kwargs):
     """Calculate the weighted importance sampling (WIS) estimate
     using all episodes. This is: sum(i=0 to n) { rho_i/rhosum} * G_i,
     where rhosum is sum(j=0 to n) {rho_j} and G_i is the discounted expected primary return.
@@ -806,30 +897,25 @@ def WIS_estimate(model, theta, episodes, **kwargs):
     :param theta: The parameter weights
     :type theta: numpy ndarray
     :param episodes: List of episodes
+    :param weighted_returns: A pre-calculated array of the discounted
+        primary returns of the episodes. Calculated from the
+        episodes if None.
     :return: The WIS estimate 
     :rtype: float
     """
-
-    if "gamma" in model.env_kwargs:
-        gamma = model.env_kwargs["gamma"]
-    else:
-        gamma = 1.0
-    # Calculate the expected returns of the primary reward under the behavior policy
-    weighted_returns = np.array(
-        [weighted_sum_gamma(ep.rewards, gamma=gamma) for ep in episodes]
-    )
-    # Calculate array of rho_j, which are the episode-wise importance weight products
-
-    n = len(episodes)
-    rho_array = []
-    for ii, ep in enumerate(episodes):
-        # Get pi_new for each timestep in this ep
-        pi_news = model.get_probs_from_observations_and_actions(
-            theta, ep.observations, ep.actions, ep.action_probs
-        )
-        rho_array.append(np.prod(pi_news / ep.action_probs))
-    rho_array = np.array(rho_array)
-    WIS_est = np.sum(rho_array * weighted_returns) / np.sum(rho_array)
+    episode_columns = EpisodeColumns.from_episodes(episodes)
+    if weighted_returns is None:
+        if "gamma" in model.env_kwargs:
+            gamma = model.env_kwargs["gamma"]
+        else:
+            gamma = 1.0
+        # Calculate the expected returns of the primary reward under the behavior policy
+        weighted_returns = calculate_episode_returns(episode_columns, gamma)
+
+    # rho_i/rhosum, calculated in log space so the products don't overflow
+    log_rhos = get_log_importance_weights(model, theta, episode_columns)
+    normalized_rhos = np.exp(log_rhos - logsumexp(log_rhos))
+    WIS_est = np.sum(normalized_rhos * weighted_returns)
     return WIS_est
 
 
@@ -0,0 +1,131 @@
+""" Module for sharing model predictions between the
+primary objective and the measure functions """
+
+from autograd.tracer import getval
+
+
+class PredictionCache(object):
+    def __init__(self):
+        """Stores the output of model.predict() for the current
+        model weights so that the primary objective and every
+        base node evaluated on the same features share a
+        single forward pass (and a single node in the autograd graph).
+        Predictions are keyed on the identity of the features array,
+        and all are dropped when a new theta object is seen.
+        The exception is the untraced value of the current theta
+        (autograd.tracer.getval(theta)), e.g. as passed to analytic gradients
+        or a user-provided primary gradient inside the same trace,
+        which is given the forward values of the traced predictions
+        rather than a second forward pass.
+
+        Because theta can be updated in place, the owner of the cache
+        must call :py:meth:`reset` whenever theta changes,
+        e.g. at the start of each optimizer step.
+
+        :ivar theta: The model weights the stored predictions were made with
+        :vartype theta: numpy ndarray
+        :ivar predictions: Maps id(X) to a tuple of (X, prediction).
+                X is kept so that its id cannot be reused
+                while the entry is alive.
+        :vartype predictions: dict
+        :ivar stored_predictions: Maps (id(theta),id(X)) to a tuple
+                of (theta, X, prediction) for predictions that were made
+                ahead of time, e.g. for several thetas at once
+                with a model's predict_stacked().
+                These are kept until the next :py:meth:`reset`.
+        :vartype stored_predictions: dict
+        :ivar chunks: Maps the ids of data arrays and a chunk size to
+                a tuple of (data arrays, chunks of the data arrays),
+                so that everything evaluated in chunks on the same data
+                gets the same chunk objects, and so shares their predictions.
+                These are kept until the next :py:meth:`reset`.
+        :vartype chunks: dict
+        """
+        self.theta = None
+        self.predictions = {}
+        self.stored_predictions = {}
+        self.chunks = {}
+
+    def reset(self):
+        """Remove all stored predictions"""
+        self.theta = None
+        self.predictions = {}
+        self.stored_predictions = {}
+        self.chunks = {}
+
+    def get_chunks(self, data, chunk_size, make_chunks):
+        """Get make_chunks(), the chunks of the data arrays,
+        only calling make_chunks if the same data arrays
+        have not already been chunked with chunk_size
+
+        :param data: The data arrays, e.g. (features, labels)
+        :type data: list
+        :param chunk_size: The number of rows in each chunk
+        :type chunk_size: int
+        :param make_chunks: Function returning the chunks
+
+        :return: make_chunks()
+        """
+        key = tuple(id(x) for x in data) + (chunk_size,)
+        if key not in self.chunks:
+            self.chunks[key] = (data, make_chunks())
+        return self.chunks[key][1]
+
+    def store(self, theta, X, prediction):
+        """Store a prediction made elsewhere for theta and X,
+        so that predict() returns it instead of calling the model.
+
+        :param theta: The parameter weights
+        :type theta: numpy ndarray
+        :param X: The features
+        :type X: numpy ndarray
+        :param prediction: model.predict(theta,X)
+        """
+        self.stored_predictions[(id(theta), id(X))] = (theta, X, prediction)
+
+    def predict(self, model, theta, X):
+        """Get model.predict(theta,X), only calling the model
+        if X has not already been seen for this theta.
+
+        :param model: The Seldonian model object
+        :type model: :py:class:`.SeldonianModel` object
+        :param theta: The parameter weights
+        :type theta: numpy ndarray
+        :param X: The features
+        :type X: numpy ndarray
+
+        :return: predictions for each observation
+        """
+        stored = self.stored_predictions.get((id(theta), id(X)))
+        if stored is not None:
+            return stored[2]
+        key = id(X)
+        if theta is not self.theta:
+            if self.theta is not None and theta is getval(self.theta):
+                if key in self.predictions:
+                    return getval(self.predictions[key][1])
+                return model.predict(theta, X)
+            self.theta = theta
+            self.predictions = {}
+        if key not in self.predictions:
+            self.predictions[key] = (X, model.predict(theta, X))
+        return self.predictions[key][1]
+
+
+def cached_predict(model, theta, X):
+    """Call model.predict(theta,X), going through
+    the model's prediction cache if one is attached.
+
+    :param model: The Seldonian model object
+    :type model: :py:class:`.SeldonianModel` object
+    :param theta: The parameter weights
+    :type theta: numpy ndarray
+    :param X: The features
+    :type X: numpy ndarray
+
+    :return: predictions for each observation
+    """
+    prediction_cache = getattr(model, "prediction_cache", None)
+    if prediction_cache is None:
+        return model.predict(theta, X)
+    return prediction_cache.predict(model, theta, X)
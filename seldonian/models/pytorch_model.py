@@ -1,6 +1,7 @@
 import autograd.numpy as np  # Thinly-wrapped version of Numpy
 from autograd.extend import primitive, defvjp
 from seldonian.models.models import SupervisedModel
+from seldonian.utils.cache_utils import ArrayCache
 
 import torch
 import torch.nn as nn
@@ -65,7 +66,7 @@ def pytorch_predict_vjp(ans, theta, X, model):
         :return: a 1D array [dF_i/dtheta[0],dF_i/dtheta[1],dF_i/dtheta[2]],
             where i is the data row index
         """
-        external_grad = torch.from_numpy(v).float().to(model.device)
+        external_grad = torch.as_tensor(v, dtype=torch.float32, device=model.device)
         dpred_dtheta = model.backward_pass(local_predictions, external_grad)
         model.params_updated = False  # resets for the
         return np.array(dpred_dtheta)
@@ -79,7 +80,7 @@ defvjp(pytorch_predict, pytorch_predict_vjp)
 
 
 class SupervisedPytorchBaseModel(SupervisedModel):
-    def __init__(self, device, **kwargs):
+    def __init__(self, device, flat_params=False, **kwargs):
         """Base class for Supervised learning Seldonian
         models implemented in Pytorch
 
@@ -87,6 +88,14 @@ class SupervisedPytorchBaseModel(SupervisedModel):
                 hardware on which to run the model,
                 e.g. "cpu", "cuda", "mps".
         :type device: str
+        :param flat_params: Whether to store all trainable parameters
+                and their gradients in single flat tensors.
+                See :py:meth:`setup_flat_params`. The layers' parameters
+                are then views into one buffer, so writing to one
+                layer's weights changes flat_param_buffer and vice versa.
+                :py:meth:`get_model_params` still returns a copy, so updating
+                theta in place never changes the model.
+        :type flat_params: bool, defaults to False
         """
         super().__init__()
         self.device = device
@@ -94,23 +103,91 @@ class SupervisedPytorchBaseModel(SupervisedModel):
         self.pytorch_model.to(self.device)
         self.param_sizes = self.get_param_sizes()
         self.params_updated = False
+        self.flat_param_buffer = None
+        self.flat_grad_buffer = None
+        if flat_params:
+            self.setup_flat_params()
+        # Features already copied to the device
+        self.feature_tensor_cache = ArrayCache()
 
     def predict(self, theta, X, **kwargs):
         """Do a forward pass through the PyTorch model.
-        Must convert back to numpy array before returning
+        Must convert back to numpy array before returning,
+        unless theta is a tensor (see :py:meth:`functional_forward_pass`)
 
         :param theta: model weights
-        :type theta: numpy ndarray
+        :type theta: numpy ndarray or torch.Tensor
         :param X: model features
         :type X: numpy ndarray
 
         :return pred_numpy: model predictions
         :rtype pred_numpy: numpy ndarray same shape as labels
         """
+        if isinstance(theta, torch.Tensor):
+            return self.functional_forward_pass(theta, X)
         return pytorch_predict(theta, X, self)
 
+    def functional_forward_pass(self, theta, X):
+        """Do a forward pass through the PyTorch model with
+        the weights in theta instead of the model's own parameters,
+        which are left untouched. Used by gradient_library="torch",
+        which differentiates the predictions w.r.t. theta with
+        torch.autograd directly, so nothing is copied to numpy.
+
+        :param theta: model weights as a flattened tensor
+        :type theta: torch.Tensor
+        :param X: model features
+        :type X: numpy ndarray
+
+        :return: predictions, attached to theta's graph
+        :rtype: torch.Tensor
+        """
+        theta = theta.to(device=self.device)
+        params = {}
+        startindex = 0
+        for name, param in self.pytorch_model.named_parameters():
+            if param.requires_grad:
+                endindex = startindex + param.numel()
+                params[name] = theta[startindex:endindex].view_as(param).to(param.dtype)
+                startindex = endindex
+        return torch.func.functional_call(
+            self.pytorch_model, params, (self.get_features_tensor(X),)
+        )
+
+    def setup_flat_params(self):
+        """Move all trainable parameters into one flat tensor,
+        flat_param_buffer, and make each layer's parameter a view
+        into it. Gradients are accumulated into flat_grad_buffer
+        in the same way. Updating the weights is then a single
+        in-place copy and reading the gradient needs no concatenation.
+        Can be called from the __init__ of a child class that
+        does not pass flat_params through.
+        """
+        params = [
+            param for param in self.pytorch_model.parameters() if param.requires_grad
+        ]
+        n_params = sum(self.param_sizes)
+        self.flat_param_buffer = torch.empty(
+            n_params, dtype=params[0].dtype, device=self.device
+        )
+        self.flat_grad_buffer = torch.zeros_like(self.flat_param_buffer)
+        startindex = 0
+        with torch.no_grad():
+            for param, nparams in zip(params, self.param_sizes):
+                endindex = startindex + nparams
+                param_view = self.flat_param_buffer[startindex:endindex].view_as(param)
+                param_view.copy_(param)
+                param.data = param_view
+                param.grad = self.flat_grad_buffer[startindex:endindex].view_as(param)
+                startindex = endindex
+        return
+
     def get_model_params(self, *args):
-        """Return weights of the model as a flattened 1D array"""
+        """Return weights of the model as a flattened 1D array.
+        This is always a copy, never a view of the model's parameters,
+        because gradient descent updates theta in place."""
+        if self.flat_param_buffer is not None:
+            return self.flat_param_buffer.detach().cpu().numpy().copy()
         layer_params_list = []
         for param in self.pytorch_model.parameters():
             if param.requires_grad:
@@ -133,6 +210,13 @@ class SupervisedPytorchBaseModel(SupervisedModel):
         :param theta: model weights as a flattened array
         :type theta: numpy ndarray
         """
+        if self.flat_param_buffer is not None:
+            theta_torch = torch.as_tensor(theta)
+            # Nothing to do if theta already shares memory with the model
+            if theta_torch.data_ptr() != self.flat_param_buffer.data_ptr():
+                with torch.no_grad():
+                    self.flat_param_buffer.copy_(theta_torch)
+            return
         # Update model parameters using flattened array
         i = 0
         startindex = 0
@@ -150,12 +234,33 @@ class SupervisedPytorchBaseModel(SupervisedModel):
 
     def zero_gradients(self):
         """Zero out gradients of all trainable model parameters"""
+        if self.flat_grad_buffer is not None:
+            self.flat_grad_buffer.zero_()
+            return
         for param in self.pytorch_model.parameters():
             if param.requires_grad:
                 if param.grad is not None:
                     param.grad.zero_()
         return
 
+    def get_features_tensor(self, X):
+        """Get the features as a float tensor on the model's device.
+        The same features are passed in on every step of gradient descent
+        while the batch does not change, so recently used tensors
+        are kept in feature_tensor_cache (see :py:class:`.ArrayCache`)
+        instead of copying X to the device on every forward pass.
+        Set feature_tensor_cache.max_bytes to 0 to disable this.
+
+        :param X: model features
+        :type X: numpy ndarray
+
+        :return: features
+        :rtype: torch.Tensor
+        """
+        return self.feature_tensor_cache.get(
+            X, lambda X: torch.as_tensor(X, dtype=torch.float32, device=self.device)
+        )
+
     def forward_pass(self, X, **kwargs):
         """Do a forward pass through the PyTorch model and return the
         model outputs (predicted labels). The outputs should be the same shape
@@ -167,7 +272,7 @@ class SupervisedPytorchBaseModel(SupervisedModel):
         :return: predictions
         :rtype: torch.Tensor
         """
-        X_torch = torch.tensor(X).float().to(self.device)
+        X_torch = self.get_features_tensor(X)
         return self.pytorch_model(X_torch)
 
     def backward_pass(self, predictions, external_grad):
@@ -191,6 +296,11 @@ class SupervisedPytorchBaseModel(SupervisedModel):
         # once for primary objective
         # and once for each constraint function.
         predictions.backward(gradient=external_grad, retain_graph=True)
+        if self.flat_grad_buffer is not None:
+            # Gradients were accumulated in place into the flat buffer.
+            # This shares memory with the buffer on the CPU,
+            # so it is copied by the caller before the next backward pass.
+            return self.flat_grad_buffer.detach().cpu().numpy()
         grad_params_list = []
         for param in self.pytorch_model.parameters():
             if param.requires_grad:
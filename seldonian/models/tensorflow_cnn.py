@@ -8,8 +8,10 @@ import tensorflow as tf
 class TensorFlowCNN(SupervisedTensorFlowBaseModel):
     def __init__(self, **kwargs):
         """Example Seldonian CNN implemented in TensorFlow.
+        Keyword arguments (e.g. use_tf_function, batch_size_predict)
+        are passed to :py:class:`.SupervisedTensorFlowBaseModel`
         """
-        super().__init__()
+        super().__init__(**kwargs)
 
     def create_model(self, **kwargs):
         """Create the TensorFlow model and return it"""
@@ -59,7 +59,12 @@ def tf_predict_vjp(ans, theta, X, model):
         # print("v:")
         # print(v)
         # input("next")
-        dpred_dtheta = model.backward_pass(v)
+        if model.use_tf_function or model.batch_size_predict is not None:
+            # The backward pass recomputes the forward pass, so it must
+            # use the weights of this theta, not whichever theta
+            # was most recently passed through the model
+            model.update_model_params(theta)
+        dpred_dtheta = model.backward_pass(v, X=X)
         return dpred_dtheta
 
     return fn
@@ -71,19 +76,44 @@ defvjp(tf_predict, tf_predict_vjp)
 
 
 class SupervisedTensorFlowBaseModel(SupervisedModel):
-    def __init__(self, **kwargs):
+    def __init__(self, use_tf_function=False, batch_size_predict=None, **kwargs):
         """Base class for Supervised learning Seldonian
         models implemented in TensorFlow
 
-        :param device: The PyTorch device string indicating the
-                hardware on which to run the model,
-                e.g. "cpu", "cuda", "mps".
-        :type device: str
+        :param use_tf_function: Whether to compile the weight update,
+                forward pass and vector Jacobian product with tf.function.
+                Theta is then copied into a single persistent flat
+                variable and sliced into the model weights in one graph call.
+                The backward pass recomputes the forward pass inside the
+                compiled function instead of keeping an eager tape.
+        :type use_tf_function: bool, defaults to False
+        :param batch_size_predict: If not None, the maximum number of
+                samples passed through the model at once. Larger feature
+                arrays (e.g. the safety dataset) are split into chunks
+                and the predictions and gradients combined.
+        :type batch_size_predict: int, defaults to None
         """
         super().__init__()
         self.tensorflow_model = self.create_model(**kwargs)
         self.param_sizes = self.get_param_sizes()
         self.weights_updated = False
+        self.use_tf_function = use_tf_function
+        self.batch_size_predict = batch_size_predict
+        self.flat_params = None
+        if use_tf_function:
+            weights = self.tensorflow_model.trainable_weights
+            self.flat_params = tf.Variable(
+                tf.zeros(sum(self.param_sizes), dtype=weights[0].dtype),
+                trainable=False,
+            )
+            self._assign_flat_params = tf.function(
+                self._assign_flat_params_eager, reduce_retracing=True
+            )
+            self._forward = tf.function(self._forward_eager, reduce_retracing=True)
+            self._vjp = tf.function(self._vjp_eager, reduce_retracing=True)
+        else:
+            self._forward = self._forward_eager
+            self._vjp = self._vjp_eager
 
     def predict(self, theta, X, **kwargs):
         """Do a forward pass through the PyTorch model.
@@ -122,6 +152,12 @@ class SupervisedTensorFlowBaseModel(SupervisedModel):
         :param theta: model weights
         :type theta: numpy ndarray
         """
+        if self.flat_params is not None:
+            # One transfer into the flat variable, then slice it
+            # into the model weights inside a single graph call
+            self.flat_params.assign(tf.cast(theta, self.flat_params.dtype))
+            self._assign_flat_params()
+            return
         # Update model parameters using flattened array
         i = 0
         startindex = 0
@@ -136,6 +172,47 @@ class SupervisedTensorFlowBaseModel(SupervisedModel):
             startindex += nparams
         return
 
+    def _assign_flat_params_eager(self):
+        """Assign slices of the flat parameter variable
+        to each of the trainable model weights"""
+        weights = self.tensorflow_model.trainable_weights
+        flat_slices = tf.split(self.flat_params, self.param_sizes)
+        for param, flat_slice in zip(weights, flat_slices):
+            param.assign(tf.reshape(flat_slice, param.shape))
+
+    def _forward_eager(self, X_tf):
+        """Run the model on a tensor of features"""
+        return self.tensorflow_model(X_tf)
+
+    def _vjp_eager(self, X_tf, v_tf):
+        """Get the vector Jacobian product of the model outputs
+        on X_tf with respect to the model weights as a flat tensor"""
+        weights = self.tensorflow_model.trainable_weights
+        with tf.GradientTape() as tape:
+            predictions = self.tensorflow_model(X_tf)
+        grads = tape.gradient(
+            predictions,
+            weights,
+            output_gradients=tf.cast(v_tf, predictions.dtype),
+        )
+        return tf.concat([tf.reshape(grad, [-1]) for grad in grads], axis=0)
+
+    def get_chunk_slices(self, n_samples):
+        """Get the slices of the samples that are passed
+        through the model together
+
+        :param n_samples: The total number of samples
+        :type n_samples: int
+
+        :return: List of slice objects
+        """
+        # A single (possibly empty) chunk if not batching
+        batch_size = self.batch_size_predict or max(n_samples, 1)
+        return [
+            slice(start, start + batch_size)
+            for start in range(0, max(n_samples, 1), batch_size)
+        ]
+
     def forward_pass(self, X, **kwargs):
         """Do a forward pass through the TensorFlow model and return the
         model outputs (predicted labels). The outputs should be the same shape
@@ -145,28 +222,47 @@ class SupervisedTensorFlowBaseModel(SupervisedModel):
         :type X: numpy ndarray
 
         :return: predictions
-        :rtype: torch.Tensor
+        :rtype: tf.Tensor
         """
+        if self.use_tf_function or self.batch_size_predict is not None:
+            predictions = [
+                self._forward(tf.convert_to_tensor(X[chunk]))
+                for chunk in self.get_chunk_slices(len(X))
+            ]
+            return tf.concat(predictions, axis=0)
+
         with tf.GradientTape(persistent=True) as tape:
             X_tf = tf.convert_to_tensor(X)
             predictions = self.tensorflow_model(X_tf)
         self.tape = tape
         return predictions
 
-    def backward_pass(self, v):
+    def backward_pass(self, v, X=None):
         """Do a backward pass through the TensorFlow model and return the
         (vector) gradient of the model with respect to theta as a numpy ndarray
 
-        :param external_grad: The gradient of the model with respect to itself
-                see: https://pytorch.org/tutorials/beginner/blitz/autograd_tutorial.html#differentiation-in-autograd
-                for more details
-        :type external_grad: torch.Tensor
+        :param v: The gradient of the downstream function with respect
+                to the model outputs, the same shape as the predictions
+        :type v: numpy ndarray
+        :param X: model features. Required when use_tf_function is True
+                or batch_size_predict is set, in which case the forward pass
+                is recomputed chunk by chunk with the currently loaded weights,
+                so the model weights must be updated first
+        :type X: numpy ndarray
         """
+        if self.use_tf_function or self.batch_size_predict is not None:
+            dpred_dtheta = 0
+            for chunk in self.get_chunk_slices(len(X)):
+                dpred_dtheta += self._vjp(
+                    tf.convert_to_tensor(X[chunk]), tf.convert_to_tensor(v[chunk])
+                )
+            return dpred_dtheta.numpy()
+
         grad_params_list = []
         grads = self.tape.gradient(
             self.predictions,
             self.tensorflow_model.trainable_weights,
-            output_gradients=v,
+            output_gradients=tf.cast(v, self.predictions.dtype),
         )
         for grad in grads:
             grad_numpy = grad.numpy()
@@ -1,31 +1,196 @@
 import copy
 import autograd.numpy as np  # Thinly-wrapped version of Numpy
-from autograd import grad, jacobian, elementwise_grad as egrad
+from autograd import grad, jacobian, value_and_grad, elementwise_grad as egrad
+from autograd.core import make_vjp, vspace
+from autograd.tracer import getval
+from autograd.wrap_util import unary_to_nary
 
 import warnings
+from seldonian.parse_tree.analytic_gradients import attach_gradient
 from seldonian.warnings.custom_warnings import *
 
 
+@unary_to_nary
+def value_and_jacobian(fun, x):
+    """Get the value of a vector-valued function and its Jacobian
+    w.r.t. x from a single forward trace. The trace is recorded once
+    and one vector-Jacobian product is taken against it per output,
+    so the function is not evaluated again to get its value.
+
+    :param fun: The function to differentiate
+    :param x: The point at which to evaluate fun and its Jacobian
+
+    :return: (fun(x), Jacobian of fun at x),
+        where the Jacobian has shape fun(x).shape + x.shape
+    """
+    vjp, ans = make_vjp(fun, x)
+    ans_vspace = vspace(ans)
+    jacobian_shape = ans_vspace.shape + vspace(x).shape
+    grads = map(vjp, ans_vspace.standard_basis())
+    return ans, np.reshape(np.stack(grads), jacobian_shape)
+
+
+def setup_autograd_gradients(primary_objective, upper_bounds_function):
+    """Obtain a function returning the primary objective, the upper bounds
+    and their gradients using autograd. Both are evaluated in a single
+    forward trace, so that model predictions shared between them through
+    the prediction cache (see :py:class:`.PredictionCache`)
+    are made, and differentiated, once per step.
+    The upper bounds are evaluated first, so that a primary objective
+    evaluated with the untraced theta can reuse their predictions.
+
+    :param primary_objective: Primary objective function
+    :param upper_bounds_function: Function for computing upper bounds
+        on the constraints
+
+    :return: A function of theta returning
+        (primary objective, its gradient, upper bounds, their Jacobian)
+    """
+
+    def lagrangian_terms(theta):
+        upper_bounds = upper_bounds_function(theta)
+        primary_val = primary_objective(theta)
+        return np.concatenate([np.reshape(primary_val, (1,)), upper_bounds])
+
+    lagrangian_terms_and_jacobian = value_and_jacobian(lagrangian_terms, argnum=0)
+
+    def lagrangian_terms_and_gradients(theta):
+        values, jac = lagrangian_terms_and_jacobian(theta)
+        return values[0], jac[0], values[1:], jac[1:]
+
+    return lagrangian_terms_and_gradients
+
+
+def setup_torch_gradients(primary_objective, upper_bounds_function):
+    """Obtain a function returning the primary objective, the upper bounds
+    and their gradients using PyTorch's autograd. theta is passed to both
+    as a tensor, so the model predictions, zhat vectors and bounds are
+    computed as tensors (see :py:mod:`seldonian.utils.array_utils`)
+    rather than being copied between numpy and torch on every forward
+    and backward pass of the model. Only the results are converted back
+    to numpy arrays. Requires a model that accepts tensor weights,
+    e.g. :py:class:`.SupervisedPytorchBaseModel`.
+
+    :param primary_objective: Primary objective function
+    :param upper_bounds_function: Function for computing upper bounds
+        on the constraints
+
+    :return: A function of theta returning
+        (primary objective, its gradient, upper bounds, their Jacobian)
+    """
+    import torch
+
+    def lagrangian_terms_and_gradients(theta):
+        theta_tensor = torch.tensor(theta, requires_grad=True)
+        upper_bounds = upper_bounds_function(theta_tensor)
+        primary_val = primary_objective(theta_tensor)
+        values = torch.cat(
+            [
+                torch.reshape(primary_val, (1,)).to(theta_tensor.dtype),
+                upper_bounds.to(theta_tensor.dtype),
+            ]
+        )
+        if values.requires_grad:
+            # All rows of the Jacobian from one batched backward pass
+            (jac,) = torch.autograd.grad(
+                values,
+                theta_tensor,
+                grad_outputs=torch.eye(len(values), dtype=values.dtype),
+                is_grads_batched=True,
+                allow_unused=True,
+            )
+        else:
+            jac = None
+        if jac is None:
+            # None of the outputs depend on theta
+            jac = torch.zeros((len(values),) + theta_tensor.shape)
+        values = values.detach().cpu().numpy()
+        jac = jac.detach().cpu().numpy()
+        return values[0], jac[0], values[1:], jac[1:]
+
+    return lagrangian_terms_and_gradients
+
+
+gradient_library_dict = {
+    "autograd": setup_autograd_gradients,
+    "torch": setup_torch_gradients,
+}
+
+
+def register_gradient_library(gradient_library, setup_function):
+    """Make a gradient library available to gradient descent under a name.
+    setup_function takes the primary objective and the upper bounds function
+    and must return a function of theta returning
+    (primary objective, its gradient, upper bounds, their Jacobian),
+    all as numpy arrays.
+
+    :param gradient_library: The name used for the gradient_library
+        optimization hyperparameter
+    :type gradient_library: str
+    :param setup_function: Function that builds the gradient function
+    """
+    gradient_library_dict[gradient_library] = setup_function
+
+
 def setup_gradients(gradient_library, primary_objective, upper_bounds_function):
-    """Wrapper to obtain the gradient functions
-    of the primary objective and upper bounds function
-    given a gradient library
+    """Wrapper to obtain the function computing the primary objective,
+    the upper bounds and their gradients given a gradient library
 
     :param gradient_library: The name of the library to use for computing
-        automatic gradients.
+        automatic gradients. Must be a key of :py:data:`gradient_library_dict`
     :type gradient_library: str, defaults to "autograd"
     :param primary_objective: Primary objective function
     :param upper_bounds_function: Function for computing upper bounds
         on the constraints
+
+    :return: A function of theta returning
+        (primary objective, its gradient, upper bounds, their Jacobian)
     """
-    if gradient_library == "autograd":
-        grad_primary_theta = grad(primary_objective, argnum=0)
-        grad_upper_bound_theta = jacobian(upper_bounds_function, argnum=0)
-    else:
+    if gradient_library not in gradient_library_dict:
         raise NotImplementedError(
             f"gradient library: {gradient_library}" " not supported"
         )
-    return grad_primary_theta, grad_upper_bound_theta
+    return gradient_library_dict[gradient_library](
+        primary_objective, upper_bounds_function
+    )
+
+
+def make_primary_function(primary_objective, **kwargs):
+    """Get the primary objective to differentiate with autograd.
+    If the user provided the gradient of the primary objective,
+    which can often be faster than autograd, it is attached to the
+    value of the objective so that autograd uses it instead.
+
+    :param primary_objective: Primary objective function
+    :param primary_gradient: Optional, a function of theta returning
+        the gradient of the primary objective
+    :type primary_gradient: function
+    :param primary_value_and_gradient: Optional, a function of theta returning
+        (primary objective, gradient) from a single evaluation.
+        Takes precedence over primary_gradient.
+    :type primary_value_and_gradient: function
+
+    :return: The primary objective as a function of theta
+    """
+    if "primary_value_and_gradient" in kwargs:
+        primary_value_and_gradient = kwargs["primary_value_and_gradient"]
+
+        def primary_function(theta):
+            value, gradient = primary_value_and_gradient(getval(theta))
+            return attach_gradient(theta, value, gradient)
+
+    elif "primary_gradient" in kwargs:
+        primary_gradient = kwargs["primary_gradient"]
+
+        def primary_function(theta):
+            theta_val = getval(theta)
+            return attach_gradient(
+                theta, primary_objective(theta_val), primary_gradient(theta_val)
+            )
+
+    else:
+        primary_function = primary_objective
+    return primary_function
 
 
 def gradient_descent_adam(
@@ -44,6 +209,10 @@ def gradient_descent_adam(
     beta_rmsprop=0.9,
     gradient_library="autograd",
     clip_theta=None,
+    tol_L=None,
+    tol_grad=None,
+    patience=1,
+    feasibility_patience=None,
     verbose=False,
     debug=False,
     **kwargs,
@@ -60,6 +229,8 @@ def gradient_descent_adam(
     If a nan or inf occurs during the optimization, NSF is returned. 
     The optimal solution is defined as the feasible solution (i.e.
     all constraints satisfied), that has the smallest primary objective value. 
+    Optionally, the optimization stops before all iterations are run
+    once it has converged, see tol_L, tol_grad and feasibility_patience.
 
     :param primary_objective: The objective function that would
         be solely optimized in the absence of behavioral constraints,
@@ -91,16 +262,40 @@ def gradient_descent_adam(
     :param num_iters: The number of iterations of gradient descent to run
     :type num_iters: int
     :param gradient_library: The name of the library to use for computing
-        automatic gradients.
+        automatic gradients, e.g. "autograd" or "torch"
+        (see :py:data:`gradient_library_dict`)
     :type gradient_library: str, defaults to "autograd"
     :param clip_theta: Optional, the min and max values 
         between which to clip all values in the theta vector
     :type clip_theta: tuple, list or numpy.ndarray, defaults to None
+    :param tol_L: Optional, stop once the relative change in the Lagrangian
+        between consecutive steps has been below tol_L for patience steps
+    :type tol_L: float, defaults to None
+    :param tol_grad: Optional, stop once the 2-norm of the gradient
+        of the Lagrangian w.r.t. theta has been below tol_grad for patience steps
+    :type tol_grad: float, defaults to None
+    :param patience: The number of consecutive steps a convergence
+        criterion must hold before stopping
+    :type patience: int, defaults to 1
+    :param feasibility_patience: Optional, stop once all constraints have
+        been satisfied for this many consecutive steps
+    :type feasibility_patience: int, defaults to None
     :param verbose: Boolean flag to control verbosity
     :param debug: Boolean flag to print out info useful for debugging
 
+    :param primary_gradient: Optional, a function of theta returning
+        the gradient of the primary objective, used instead of autograd
+    :type primary_gradient: function
+    :param primary_value_and_gradient: Optional, a function of theta returning
+        (primary objective, gradient) from a single evaluation.
+        Takes precedence over primary_gradient.
+    :type primary_value_and_gradient: function
+
     :return: solution, a dictionary containing the candidate solution and values of 
-        the parameters of the KKT optimization at each step.
+        the parameters of the KKT optimization at each step,
+        the number of steps run ("n_iters") and why the optimization stopped
+        ("stop_reason"): one of "max_iterations", "nan_or_inf",
+        "L_converged", "gradient_converged" or "feasibility_stable".
     :rtype: dict
     """
 
@@ -142,16 +337,27 @@ def gradient_descent_adam(
     best_g_norm = np.inf
     best_index_g_norm = 0
 
-    # Get df/dtheta and dg/dtheta automatic gradients
-    (grad_primary_theta, grad_upper_bound_theta) = setup_gradients(
-        gradient_library, primary_objective, upper_bounds_function
-    )
+    # Number of consecutive steps each stopping criterion has held for
+    n_steps_L_converged = 0
+    n_steps_grad_converged = 0
+    n_steps_feasible = 0
+    stop_reason = "max_iterations"
 
     # It is possible that the user provided the function df/dtheta,
     # which can often speed up computing the gradients.
-    # In that case, override the automatic gradient function
-    if "primary_gradient" in kwargs:
-        grad_primary_theta = kwargs["primary_gradient"]
+    # In that case, attach it to the primary objective
+    if "primary_value_and_gradient" in kwargs or "primary_gradient" in kwargs:
+        if gradient_library != "autograd":
+            raise NotImplementedError(
+                "A provided primary objective gradient is only supported "
+                "with gradient_library='autograd'"
+            )
+        primary_objective = make_primary_function(primary_objective, **kwargs)
+
+    # Get f, df/dtheta, g and dg/dtheta from one pass
+    lagrangian_terms_and_gradients = setup_gradients(
+        gradient_library, primary_objective, upper_bounds_function
+    )
 
     # Start gradient descent
     gd_index = 0
@@ -168,8 +374,13 @@ def gradient_descent_adam(
                 if batch_index % 10 == 0:
                     print(f"Epoch: {epoch}, batch iteration {batch_index}")
             is_small_batch = batch_calculator(batch_index, batch_size, epoch, n_batches)
-            primary_val = primary_objective(theta)
-            g_vec = upper_bounds_function(theta)
+            # f, g and their gradients come out of the same forward trace
+            (
+                primary_val,
+                grad_primary_theta_val,
+                g_vec,
+                gu_theta_vec,
+            ) = lagrangian_terms_and_gradients(theta)
             # Check if the 2-norm is smallest so far.
             # We will use the smallest overall as a backup
             # candidate solution in case we don't find a feasible solution
@@ -195,11 +406,8 @@ def gradient_descent_adam(
                 print()
 
             # Check if this is best feasible value so far
-            if (
-                (not is_small_batch)
-                and all([g <= 0 for g in g_vec])
-                and primary_val < best_primary
-            ):
+            is_feasible = (not is_small_batch) and all([g <= 0 for g in g_vec])
+            if is_feasible and primary_val < best_primary:
                 found_feasible_solution = True
                 best_index = gd_index
                 best_primary = primary_val
@@ -234,13 +442,11 @@ def gradient_descent_adam(
                 )
                 warnings.warn(warning_msg)
                 candidate_solution = "NSF"
+                stop_reason = "nan_or_inf"
                 break
 
-            # Obtain gradients of both terms in Lagrangian
+            # Combine gradients of both terms in Lagrangian
             # at current values of theta and lambda
-            grad_primary_theta_val = grad_primary_theta(theta)
-            gu_theta_vec = grad_upper_bound_theta(theta)
-
             grad_secondary_theta_val_vec = (
                 gu_theta_vec * lamb[:, None]
             )  ## to multiply each row of gu_theta_vec by elements of lamb
@@ -248,6 +454,30 @@ def gradient_descent_adam(
                 grad_secondary_theta_val_vec, axis=0
             )
 
+            # Stop early if converged
+            if tol_L is not None and gd_index > 0:
+                L_change = abs(L_val - L_vals[-2]) / max(abs(L_vals[-2]), 1e-12)
+                n_steps_L_converged = (
+                    n_steps_L_converged + 1 if L_change < tol_L else 0
+                )
+                if n_steps_L_converged >= patience:
+                    stop_reason = "L_converged"
+            if tol_grad is not None:
+                grad_converged = np.linalg.norm(gradient_theta) < tol_grad
+                n_steps_grad_converged = (
+                    n_steps_grad_converged + 1 if grad_converged else 0
+                )
+                if n_steps_grad_converged >= patience:
+                    stop_reason = "gradient_converged"
+            if feasibility_patience is not None:
+                n_steps_feasible = n_steps_feasible + 1 if is_feasible else 0
+                if n_steps_feasible >= feasibility_patience:
+                    stop_reason = "feasibility_stable"
+            if stop_reason != "max_iterations":
+                if verbose:
+                    print(f"Stopping at iteration {gd_index}: {stop_reason}")
+                break
+
             # gradient w.r.t. to lambda is just g
             gradient_lamb_vec = g_vec
 
@@ -316,6 +546,8 @@ def gradient_descent_adam(
     solution["best_lamb"] = best_lamb
     solution["best_L"] = best_L
     solution["found_feasible_solution"] = found_feasible_solution
+    solution["n_iters"] = len(f_vals)
+    solution["stop_reason"] = stop_reason
     # solution["theta_vals"] = np.array(theta_vals) # takes up too much disk
     solution["f_vals"] = np.array(f_vals)
     solution["lamb_vals"] = np.array(lamb_vals)
@@ -323,3 +555,440 @@ def gradient_descent_adam(
     solution["L_vals"] = np.array(L_vals)
 
     return solution
+
+
+def multi_start_gradient_descent_adam(
+    primary_objective,
+    n_constraints,
+    upper_bounds_function,
+    theta_inits,
+    lambda_init,
+    batch_calculator,
+    n_batches,
+    batch_size=100,
+    n_epochs=1,
+    alpha_theta=0.05,
+    alpha_lamb=0.05,
+    beta_velocity=0.9,
+    beta_rmsprop=0.9,
+    gradient_library="autograd",
+    clip_theta=None,
+    tol_L=None,
+    tol_grad=None,
+    patience=1,
+    feasibility_patience=None,
+    stacked_trace=False,
+    prepare_thetas=None,
+    verbose=False,
+    debug=False,
+    **kwargs,
+):
+    """Runs the KKT optimization of :py:func:`gradient_descent_adam`
+    from K starting points at once. The K Adam trajectories,
+    each with its own theta, Lagrange multipliers and Adam state,
+    are advanced in lockstep on the same batches. If stacked_trace is True,
+    f and g of all K thetas are evaluated in one autograd trace on each step
+    and their gradients are obtained from n_constraints+1 vector-Jacobian
+    products of that trace, rather than from K separate traces.
+    The thetas are then handed to prepare_thetas before they are evaluated,
+    which can use this to make the predictions of all K thetas
+    in a single forward pass. f and g are still evaluated for
+    one theta at a time within the trace.
+
+    A trajectory in which a nan or inf appears is dropped, the others continue.
+    A trajectory that meets one of the early stopping criteria of
+    :py:func:`gradient_descent_adam` (tol_L, tol_grad or feasibility_patience)
+    stops there but remains a candidate; the others continue.
+    The candidate solution is the feasible solution with the smallest primary
+    objective over all trajectories. If no trajectory ever enters
+    the feasible set, the solution with the smallest norm of g is returned.
+    If every trajectory was dropped, NSF is returned.
+
+    :param primary_objective: The objective function that would
+        be solely optimized in the absence of behavioral constraints,
+        i.e., the loss function
+    :type primary_objective: function or class method
+    :param n_constraints: The number of constraints
+    :param upper_bounds_function: The function that calculates
+        the upper bounds on the constraints
+    :type upper_bounds_function: function or class method
+    :param theta_inits: Initial model weights, one per starting point
+    :type theta_inits: numpy ndarray of shape (K,) + theta.shape
+    :param lambda_init: Initial values for Lagrange multiplier terms,
+        shared by all starting points
+    :type lambda_init: float
+    :param batch_calculator: A function/class method that sets the current batch
+        and returns whether the batch is viable for generating
+        a candidate solution
+    :param n_batches: The number of batches per epoch
+    :type n_batches: int
+    :param batch_size: The size of each batch
+    :type batch_size: int
+    :param n_epochs: The number of epochs to run
+    :type n_epochs: int
+    :param alpha_theta: Initial learning rate for theta
+    :type alpha_theta: float
+    :param alpha_lamb: Initial learning rate for lambda
+    :type alpha_lamb: float
+    :param beta_velocity: Exponential decay rate for velocity term
+    :type beta_velocity: float
+    :param beta_rmsprop: Exponential decay rate for rmsprop term
+    :type beta_rmsprop: float
+    :param gradient_library: The name of the library to use for computing
+        automatic gradients. Only "autograd" is supported.
+    :type gradient_library: str, defaults to "autograd"
+    :param clip_theta: Optional, the min and max values
+        between which to clip all values in the theta vectors
+    :type clip_theta: tuple, list or numpy.ndarray, defaults to None
+    :param tol_L: Optional, stop a trajectory once the relative change in its
+        Lagrangian between consecutive steps has been below tol_L
+        for patience steps
+    :type tol_L: float, defaults to None
+    :param tol_grad: Optional, stop a trajectory once the 2-norm of the
+        gradient of its Lagrangian w.r.t. theta has been below tol_grad
+        for patience steps
+    :type tol_grad: float, defaults to None
+    :param patience: The number of consecutive steps a convergence
+        criterion must hold before stopping
+    :type patience: int, defaults to 1
+    :param feasibility_patience: Optional, stop a trajectory once all
+        constraints have been satisfied for this many consecutive steps
+    :type feasibility_patience: int, defaults to None
+    :param stacked_trace: Whether to evaluate all K thetas in one trace.
+        Only valid if the model is stateless, i.e. its predictions and
+        their gradients depend only on the theta passed in. Models that keep
+        the weights or the forward pass of the most recent theta, e.g.
+        scikit-learn, PyTorch and TensorFlow models, would otherwise be
+        differentiated with the wrong weights. If False, each theta
+        is evaluated and differentiated in its own trace.
+    :type stacked_trace: bool, defaults to False
+    :param prepare_thetas: Optional, a function called with
+        (thetas, theta_list) on each step before f and g are evaluated,
+        where theta_list holds the K (traced) thetas that
+        f and g will be called with. Only called if stacked_trace is True.
+    :type prepare_thetas: function
+    :param verbose: Boolean flag to control verbosity
+    :param debug: Boolean flag to print out info useful for debugging
+
+    :param primary_gradient: Optional, a function of theta returning
+        the gradient of the primary objective, used instead of autograd
+    :type primary_gradient: function
+    :param primary_value_and_gradient: Optional, a function of theta returning
+        (primary objective, gradient) from a single evaluation.
+        Takes precedence over primary_gradient.
+    :type primary_value_and_gradient: function
+
+    :return: solution, a dictionary with the same keys as that of
+        :py:func:`gradient_descent_adam`, where the values at each step
+        are those of the trajectory the candidate solution came from,
+        plus "best_start", the index of that trajectory
+        and "n_starts", the number of trajectories. "n_iters" and "stop_reason"
+        are also those of the trajectory the candidate solution came from.
+    :rtype: dict
+    """
+    if gradient_library != "autograd":
+        raise NotImplementedError(
+            f"gradient library: {gradient_library}"
+            " not supported for multi-start gradient descent"
+        )
+
+    # initialize thetas, lambdas. Copy so that theta_inits is not updated
+    thetas = np.array(theta_inits, dtype=float)
+    n_starts = len(thetas)
+    if type(lambda_init) == float:
+        lamb = np.repeat(lambda_init, n_constraints)
+    else:
+        lamb = np.array(lambda_init, dtype=float)
+
+    if len(lamb) != n_constraints:
+        raise RuntimeError(
+            "lambda has wrong shape. Shape must be (n_constraints,), "
+            f"but shape is {lamb.shape}"
+        )
+    lamb = np.tile(lamb, (n_starts, 1))
+    # Shape for broadcasting one value per trajectory and constraint
+    # against the per-constraint gradients w.r.t. theta
+    lamb_theta_shape = lamb.shape + (1,) * (thetas.ndim - 1)
+    start_theta_shape = (n_starts,) + (1,) * (thetas.ndim - 1)
+
+    # initialize Adam parameters
+    velocity_theta, velocity_lamb = np.zeros_like(thetas), 0.0
+    s_theta, s_lamb = np.zeros_like(thetas), 0.0
+    rms_offset = 1e-6  # small offset to make sure we don't take 1/sqrt(very small) in weight update
+
+    # Track the best solution of each trajectory
+    active = np.ones(n_starts, dtype=bool)
+    found_feasible_solution = np.zeros(n_starts, dtype=bool)
+    best_primary = np.repeat(np.inf, n_starts)
+    best_index = np.zeros(n_starts, dtype=int)
+    candidate_solutions = [None] * n_starts
+    best_g_norm = np.repeat(np.inf, n_starts)
+    best_index_g_norm = np.zeros(n_starts, dtype=int)
+    candidate_solutions_best_g_norm = [None] * n_starts
+
+    # Trajectories that met an early stopping criterion, and
+    # the number of consecutive steps each criterion has held for
+    stopped = np.zeros(n_starts, dtype=bool)
+    n_steps_L_converged = np.zeros(n_starts, dtype=int)
+    n_steps_grad_converged = np.zeros(n_starts, dtype=int)
+    n_steps_feasible = np.zeros(n_starts, dtype=int)
+    stop_reasons = ["max_iterations"] * n_starts
+    n_iters = np.zeros(n_starts, dtype=int)
+
+    # Values of all trajectories at each step
+    lamb_vals = []
+    L_vals = []
+    f_vals = []  # primary
+    g_vals = []  # constraint upper bound values
+
+    primary_value = make_primary_function(primary_objective, **kwargs)
+
+    def stacked_f_and_g(thetas):
+        """f and g of every active trajectory, stacked into
+        shape (n_starts, n_constraints+1). Row k depends only on thetas[k]."""
+        theta_list = [thetas[k] for k in range(n_starts)]
+        if prepare_thetas is not None:
+            prepare_thetas(thetas, theta_list)
+        rows = []
+        for k, theta in enumerate(theta_list):
+            if not running[k]:
+                rows.append(np.zeros(n_constraints + 1))
+                continue
+            primary_val = np.reshape(primary_value(theta), (1,))
+            rows.append(np.concatenate([primary_val, upper_bounds_function(theta)]))
+        return np.stack(rows)
+
+    # Evaluates one theta per trace when the thetas cannot share one
+    f_and_g_and_gradients = setup_autograd_gradients(
+        primary_value, upper_bounds_function
+    )
+
+    # Start gradient descent
+    gd_index = 0
+    if verbose:
+        n_iters_tot = n_epochs * n_batches
+        print(
+            f"Have {n_epochs} epochs and {n_batches} batches of size {batch_size} "
+            f"for a total of {n_iters_tot} iterations from {n_starts} starting points"
+        )
+
+    for epoch in range(n_epochs):
+        for batch_index in range(n_batches):
+            if verbose:
+                if batch_index % 10 == 0:
+                    print(f"Epoch: {epoch}, batch iteration {batch_index}")
+            is_small_batch = batch_calculator(batch_index, batch_size, epoch, n_batches)
+            # Trajectories that have neither been dropped nor stopped
+            running = active & ~stopped
+            n_iters += running
+            if stacked_trace:
+                vjp, values = make_vjp(stacked_f_and_g, thetas)
+                # The rows are independent, so one vector-Jacobian product per
+                # column gives that column's gradient for every trajectory at once
+                grads = []
+                for i in range(n_constraints + 1):
+                    cotangent = np.zeros(values.shape)
+                    cotangent[:, i] = 1.0
+                    grads.append(vjp(cotangent))
+                grad_primary_theta_val = grads[0]
+                gu_theta_vec = np.stack(grads[1:], axis=1)
+            else:
+                values = np.zeros((n_starts, n_constraints + 1))
+                grad_primary_theta_val = np.zeros_like(thetas)
+                gu_theta_vec = np.zeros((n_starts, n_constraints) + thetas.shape[1:])
+                for k in np.flatnonzero(running):
+                    (
+                        values[k, 0],
+                        grad_primary_theta_val[k],
+                        values[k, 1:],
+                        gu_theta_vec[k],
+                    ) = f_and_g_and_gradients(thetas[k])
+            primary_vals = values[:, 0]
+            g_vecs = values[:, 1:]
+
+            g_norms = np.linalg.norm(g_vecs, axis=1)
+            L_vals_step = primary_vals + np.sum(lamb * g_vecs, axis=1)
+
+            if debug:
+                print(
+                    "epoch,batch_i,overall_i,f,g,lambda:",
+                    epoch,
+                    batch_index,
+                    gd_index,
+                    primary_vals,
+                    g_vecs,
+                    lamb,
+                )
+                print()
+
+            is_feasible = (not is_small_batch) & np.all(g_vecs <= 0, axis=1)
+            for k in np.flatnonzero(running):
+                if g_norms[k] < best_g_norm[k]:
+                    best_g_norm[k] = g_norms[k]
+                    best_index_g_norm[k] = gd_index
+                    candidate_solutions_best_g_norm[k] = np.copy(thetas[k])
+                if is_feasible[k] and primary_vals[k] < best_primary[k]:
+                    found_feasible_solution[k] = True
+                    best_index[k] = gd_index
+                    best_primary[k] = primary_vals[k]
+                    candidate_solutions[k] = np.copy(thetas[k])
+
+            # store values
+            lamb_vals.append(np.copy(lamb))
+            f_vals.append(primary_vals)
+            g_vals.append(g_vecs)
+            L_vals.append(L_vals_step)
+
+            # Drop trajectories in which nans or infs appear
+            for k in np.flatnonzero(running):
+                if not (
+                    np.isfinite(primary_vals[k])
+                    and np.isfinite(lamb[k]).all()
+                    and np.isfinite(thetas[k]).all()
+                    and np.isfinite(g_vecs[k]).all()
+                ):
+                    warnings.warn(
+                        "Warning: a nan or inf was found during "
+                        f"gradient descent from starting point {k}. "
+                        "Dropping this starting point."
+                    )
+                    active[k] = False
+                    running[k] = False
+                    stop_reasons[k] = "nan_or_inf"
+
+            # Combine gradients of both terms in Lagrangian
+            # at current values of theta and lambda
+            gradient_theta = grad_primary_theta_val + np.sum(
+                gu_theta_vec * np.reshape(lamb, lamb_theta_shape), axis=1
+            )
+
+            # Stop trajectories early once they have converged
+            for k in np.flatnonzero(running):
+                stop_reason = None
+                if tol_L is not None and gd_index > 0:
+                    L_change = abs(L_vals[-1][k] - L_vals[-2][k]) / max(
+                        abs(L_vals[-2][k]), 1e-12
+                    )
+                    n_steps_L_converged[k] = (
+                        n_steps_L_converged[k] + 1 if L_change < tol_L else 0
+                    )
+                    if n_steps_L_converged[k] >= patience:
+                        stop_reason = "L_converged"
+                if tol_grad is not None:
+                    grad_converged = np.linalg.norm(gradient_theta[k]) < tol_grad
+                    n_steps_grad_converged[k] = (
+                        n_steps_grad_converged[k] + 1 if grad_converged else 0
+                    )
+                    if n_steps_grad_converged[k] >= patience:
+                        stop_reason = "gradient_converged"
+                if feasibility_patience is not None:
+                    n_steps_feasible[k] = (
+                        n_steps_feasible[k] + 1 if is_feasible[k] else 0
+                    )
+                    if n_steps_feasible[k] >= feasibility_patience:
+                        stop_reason = "feasibility_stable"
+                if stop_reason is not None:
+                    if verbose:
+                        print(
+                            f"Stopping starting point {k} "
+                            f"at iteration {gd_index}: {stop_reason}"
+                        )
+                    stopped[k] = True
+                    running[k] = False
+                    stop_reasons[k] = stop_reason
+            if not running.any():
+                break
+
+            # gradient w.r.t. to lambda is just g
+            gradient_lamb_vec = g_vecs
+
+            # Momementum term
+            velocity_theta = (
+                beta_velocity * velocity_theta + (1.0 - beta_velocity) * gradient_theta
+            )
+
+            # RMS prop term
+            s_theta = beta_rmsprop * s_theta + (1.0 - beta_rmsprop) * pow(
+                gradient_theta, 2
+            )
+
+            # bias-correction
+            velocity_theta /= 1 - pow(beta_velocity, gd_index + 1)
+            s_theta /= 1 - pow(beta_rmsprop, gd_index + 1)
+
+            # update the weights of the running trajectories only
+            step_theta = alpha_theta * velocity_theta / (np.sqrt(s_theta) + rms_offset)
+            thetas = thetas - np.where(
+                np.reshape(running, start_theta_shape), step_theta, 0.0
+            )  # gradient descent
+            lamb = lamb + alpha_lamb * gradient_lamb_vec * running[:, None]
+
+            # Clip theta if specified
+            if clip_theta:
+                th_min, th_max = clip_theta
+                thetas = np.clip(thetas, th_min, th_max)
+            # If any values in lambda vector dip below 0, force them to be zero
+            lamb[lamb < 0] = 0
+
+            gd_index += 1
+        else:  # only executed if inner loop did not break
+            continue
+        break  # only executed if inner loop broke
+
+    f_vals = np.array(f_vals)
+    lamb_vals = np.array(lamb_vals)
+    g_vals = np.array(g_vals)
+    L_vals = np.array(L_vals)
+
+    # Pick the trajectory to take the candidate solution from
+    feasible = active & found_feasible_solution
+    if feasible.any():
+        best_start = int(np.argmin(np.where(feasible, best_primary, np.inf)))
+        solution_index = best_index[best_start]
+        candidate_solution = candidate_solutions[best_start]
+    elif active.any():
+        if debug:
+            print(
+                "Never found feasible solution. "
+                "Returning solution with lowest sqrt(|g|**2)"
+            )
+        best_start = int(np.argmin(np.where(active, best_g_norm, np.inf)))
+        solution_index = best_index_g_norm[best_start]
+        candidate_solution = candidate_solutions_best_g_norm[best_start]
+    else:
+        if debug:
+            print("NaN or Inf appeared in gradient descent terms " "Returning NSF")
+        best_start = None
+        candidate_solution = "NSF"
+
+    solution = {}
+    solution["candidate_solution"] = candidate_solution
+    solution["found_feasible_solution"] = bool(feasible.any())
+    solution["best_start"] = best_start
+    solution["n_starts"] = n_starts
+    if best_start is None:
+        solution["best_index"] = None
+        solution["best_f"] = None
+        solution["best_g"] = None
+        solution["best_lamb"] = None
+        solution["best_L"] = None
+        solution["n_iters"] = int(n_iters.max())
+        solution["stop_reason"] = "nan_or_inf"
+        trajectory = 0
+    else:
+        solution["best_index"] = solution_index
+        solution["best_f"] = f_vals[solution_index, best_start]
+        solution["best_g"] = g_vals[solution_index, best_start]
+        solution["best_lamb"] = lamb_vals[solution_index, best_start]
+        solution["best_L"] = L_vals[solution_index, best_start]
+        solution["n_iters"] = int(n_iters[best_start])
+        solution["stop_reason"] = stop_reasons[best_start]
+        trajectory = best_start
+    # Steps after the trajectory stopped are not part of it
+    n_iters_trajectory = solution["n_iters"]
+    solution["f_vals"] = f_vals[:n_iters_trajectory, trajectory]
+    solution["lamb_vals"] = lamb_vals[:n_iters_trajectory, trajectory]
+    solution["g_vals"] = g_vals[:n_iters_trajectory, trajectory]
+    solution["L_vals"] = L_vals[:n_iters_trajectory, trajectory]
+
+    return solution
@@ -0,0 +1,374 @@
+""" Module containing closed-form gradients of the confidence
+bounds on base nodes. During candidate selection, these replace
+automatic differentiation through the model, the measure function
+and the confidence bound for the built-in models and measure functions.
+Base nodes without an analytic gradient fall back to autograd.
+
+.. data:: zhat_vjp_dict
+    :type: dict
+
+    Maps (model class, measure function name) to a function that
+    returns the zhat vector and a function computing
+    vector-Jacobian products of zhat w.r.t. theta.
+
+.. data:: bound_gradient_dict
+    :type: dict
+
+    Maps the bound method, e.g. "ttest", to a function that
+    returns the predicted confidence bounds and their gradients w.r.t. theta
+    given a zhat vector and its vector-Jacobian product function.
+"""
+
+from functools import partial
+
+import autograd.numpy as np  # Thinly-wrapped version of Numpy
+from autograd.extend import primitive, defvjp
+from autograd.tracer import Box, getval
+
+from seldonian.models.models import (
+    LinearRegressionModel,
+    BinaryLogisticRegressionModel,
+    MultiClassLogisticRegressionModel,
+)
+from seldonian.models.prediction_cache import cached_predict
+from seldonian.utils.stats_utils import stddev, tinv
+
+
+@primitive
+def attach_gradient(theta, value, gradient):
+    """Return value unchanged, but make autograd
+    treat it as a function of theta whose gradient is
+    the precomputed gradient. This lets autograd propagate
+    through the parse tree without tracing how value was computed.
+
+    :param theta: model weights
+    :type theta: numpy ndarray
+    :param value: The value of the function at theta
+    :type value: float
+    :param gradient: The gradient of the function w.r.t. theta
+    :type gradient: numpy ndarray, same shape as theta
+
+    :return: value
+    """
+    return value
+
+
+defvjp(
+    attach_gradient,
+    lambda ans, theta, value, gradient: lambda g: g * gradient,
+)
+
+
+""" Vector-Jacobian products of the zhat vectors """
+
+
+def _design_matrix_vjp(u, X):
+    """Calculate u @ [1,X], i.e. the product
+    with the features including the intercept column,
+    without building the design matrix.
+
+    :param u: vector of length len(X) or matrix of shape (len(X),k)
+    :param X: The features
+    :type X: numpy ndarray
+
+    :return: Array of shape (1+X.shape[1],) or (1+X.shape[1],k)
+    """
+    return np.concatenate([np.sum(u, axis=0, keepdims=True), X.T @ u])
+
+
+def _regression_zhat_vjp(model, theta, X, Y, measure_function_name, **kwargs):
+    """Calculate the zhat vector of a linear regression model
+    and a function for its vector-Jacobian products w.r.t. theta
+
+    :param model: SeldonianModel instance
+    :param theta: The model weights
+    :type theta: numpy ndarray
+    :param X: The features
+    :type X: numpy ndarray
+    :param Y: The labels
+    :type Y: numpy ndarray
+    :param measure_function_name: "Mean_Squared_Error" or "Mean_Error"
+    :type measure_function_name: str
+
+    :return: (zhat, vjp), where vjp(v) = v @ d(zhat)/d(theta)
+    """
+    err = cached_predict(model, theta, X) - Y
+    if measure_function_name == "Mean_Squared_Error":
+        return err ** 2, lambda v: _design_matrix_vjp(2 * err * v, X)
+    return err, lambda v: _design_matrix_vjp(v, X)
+
+
+def _binary_measure_terms(measure_function_name, Y):
+    """Express a binary classification measure function as
+    zhat = offset + sign*prediction[rows], where prediction is the
+    probability of the positive class
+
+    :return: (rows, sign, offset)
+    """
+    if measure_function_name == "ACC":
+        return slice(None), 2.0 * Y - 1.0, 1.0 - Y
+
+    positive = Y == 1.0
+    rows = {
+        "PR": slice(None),
+        "NR": slice(None),
+        "FPR": ~positive,
+        "FNR": positive,
+        "TPR": positive,
+        "TNR": ~positive,
+    }[measure_function_name]
+    n_rows = len(Y[rows])
+    if measure_function_name in ["PR", "FPR", "TPR"]:
+        return rows, np.ones(n_rows), np.zeros(n_rows)
+    return rows, -np.ones(n_rows), np.ones(n_rows)
+
+
+def _binary_logistic_zhat_vjp(model, theta, X, Y, measure_function_name, **kwargs):
+    """Calculate the zhat vector of a binary logistic regression model
+    and a function for its vector-Jacobian products w.r.t. theta
+
+    :param model: SeldonianModel instance
+    :param theta: The model weights
+    :type theta: numpy ndarray
+    :param X: The features
+    :type X: numpy ndarray
+    :param Y: The labels
+    :type Y: numpy ndarray
+    :param measure_function_name: The name of the measure function, e.g. "FPR"
+    :type measure_function_name: str
+
+    :return: (zhat, vjp), where vjp(v) = v @ d(zhat)/d(theta),
+        or None for a multi-class base node
+    """
+    if kwargs.get("class_index") is not None:
+        return None
+    rows, sign, offset = _binary_measure_terms(measure_function_name, Y)
+    prediction = cached_predict(model, theta, X)[rows]
+    dzhat_dz = sign * prediction * (1.0 - prediction)
+    zhat = offset + sign * prediction
+    return zhat, lambda v: _design_matrix_vjp(v * dzhat_dz, X[rows])
+
+
+def _multiclass_measure_terms(
+    measure_function_name, Y, class_index=None, cm_true_index=None, cm_pred_index=None
+):
+    """Express a multi-class classification measure function as
+    zhat = offset + sign*prediction[rows,cols], where prediction[i,k]
+    is the probability of class k for observation i
+
+    :return: (rows, cols, sign, offset)
+    """
+    if measure_function_name == "ACC":
+        return slice(None), Y.astype(int), np.ones(len(Y)), np.zeros(len(Y))
+
+    if measure_function_name == "CM":
+        rows = Y == cm_true_index
+        n_rows = len(Y[rows])
+        return rows, np.full(n_rows, cm_pred_index), np.ones(n_rows), np.zeros(n_rows)
+
+    is_class = Y == class_index
+    rows = {
+        "PR": slice(None),
+        "NR": slice(None),
+        "FPR": ~is_class,
+        "FNR": is_class,
+        "TPR": is_class,
+        "TNR": ~is_class,
+    }[measure_function_name]
+    n_rows = len(Y[rows])
+    cols = np.full(n_rows, class_index)
+    if measure_function_name in ["PR", "FPR", "TPR"]:
+        return rows, cols, np.ones(n_rows), np.zeros(n_rows)
+    return rows, cols, -np.ones(n_rows), np.ones(n_rows)
+
+
+def _multiclass_logistic_zhat_vjp(
+    model, theta, X, Y, measure_function_name, **kwargs
+):
+    """Calculate the zhat vector of a multi-class logistic regression model
+    and a function for its vector-Jacobian products w.r.t. theta
+
+    :param model: SeldonianModel instance
+    :param theta: The model weights
+    :type theta: numpy ndarray
+    :param X: The features
+    :type X: numpy ndarray
+    :param Y: The labels
+    :type Y: numpy ndarray
+    :param measure_function_name: The name of the measure function, e.g. "FPR"
+    :type measure_function_name: str
+
+    :return: (zhat, vjp), where vjp(v) = v @ d(zhat)/d(theta),
+        or None if the measure function needs a class index that was not given
+    """
+    class_index = kwargs.get("class_index")
+    if measure_function_name == "CM":
+        if kwargs.get("cm_true_index") is None:
+            return None
+    elif class_index is None and measure_function_name != "ACC":
+        return None
+    rows, cols, sign, offset = _multiclass_measure_terms(
+        measure_function_name,
+        Y,
+        class_index,
+        cm_true_index=kwargs.get("cm_true_index"),
+        cm_pred_index=kwargs.get("cm_pred_index"),
+    )
+    prediction = cached_predict(model, theta, X)[rows]  # (m,k)
+    m = len(prediction)
+    selected = prediction[np.arange(m), cols]
+    # d softmax_c / d z_k = p_c*(1[c==k] - p_k)
+    dzhat_dz = -selected[:, None] * prediction
+    dzhat_dz[np.arange(m), cols] += selected
+    dzhat_dz *= sign[:, None]
+    zhat = offset + sign * selected
+    return zhat, lambda v: _design_matrix_vjp(v[:, None] * dzhat_dz, X[rows])
+
+
+zhat_vjp_dict = {}
+
+for measure_function_name in ["Mean_Squared_Error", "Mean_Error"]:
+    zhat_vjp_dict[(LinearRegressionModel, measure_function_name)] = partial(
+        _regression_zhat_vjp, measure_function_name=measure_function_name
+    )
+
+for measure_function_name in ["PR", "NR", "FPR", "FNR", "TPR", "TNR", "ACC"]:
+    zhat_vjp_dict[(BinaryLogisticRegressionModel, measure_function_name)] = partial(
+        _binary_logistic_zhat_vjp, measure_function_name=measure_function_name
+    )
+    zhat_vjp_dict[(MultiClassLogisticRegressionModel, measure_function_name)] = partial(
+        _multiclass_logistic_zhat_vjp, measure_function_name=measure_function_name
+    )
+
+zhat_vjp_dict[(MultiClassLogisticRegressionModel, "CM")] = partial(
+    _multiclass_logistic_zhat_vjp, measure_function_name="CM"
+)
+
+
+""" Gradients of the confidence bounds """
+
+
+def ttest_bound_gradients(node, zhat, zhat_vjp, datasize):
+    """Calculate the predicted Student's t-test bounds
+    that a base node needs and their gradients w.r.t. theta.
+    Matches :py:meth:`.BaseNode.predict_HC_lowerbound` and
+    :py:meth:`.BaseNode.predict_HC_upperbound`.
+
+    :param node: The base node
+    :type node: :py:class:`.BaseNode` object
+    :param zhat: The zhat vector
+    :type zhat: numpy ndarray
+    :param zhat_vjp: Function computing v @ d(zhat)/d(theta)
+    :param datasize: The predicted number of observations in the safety dataset
+    :type datasize: int
+
+    :return: Maps "lower" and/or "upper" to a (bound, gradient) tuple
+    :rtype: dict
+    """
+    n = len(zhat)
+    mean = np.mean(zhat)
+    std = stddev(zhat)
+    # d(mean)/d(zhat) and d(std)/d(zhat)
+    dmean = np.ones(n) / n
+    if std > 0:
+        dstd = (zhat - mean) / ((n - 1) * std)
+    else:
+        dstd = np.zeros(n)
+
+    bounds = {}
+    if node.will_lower_bound:
+        scale = node.infl_factor_lower * tinv(1.0 - node.delta_lower, datasize - 1)
+        scale /= np.sqrt(datasize)
+        bounds["lower"] = (mean - scale * std, zhat_vjp(dmean - scale * dstd))
+    if node.will_upper_bound:
+        scale = node.infl_factor_upper * tinv(1.0 - node.delta_upper, datasize - 1)
+        scale /= np.sqrt(datasize)
+        bounds["upper"] = (mean + scale * std, zhat_vjp(dmean + scale * dstd))
+    return bounds
+
+
+bound_gradient_dict = {"ttest": ttest_bound_gradients}
+
+
+def get_zhat_vjp_function(model, measure_function_name, bound_method):
+    """Look up the analytic gradient of the zhat vector
+    for a (model, measure function, bound method) triple. Only exact
+    model classes are matched, because subclasses may override predict().
+
+    :param model: SeldonianModel instance
+    :param measure_function_name: The name of the measure function, e.g. "FPR"
+    :type measure_function_name: str
+    :param bound_method: The bound method, e.g. "ttest"
+    :type bound_method: str
+
+    :return: The function from :py:data:`zhat_vjp_dict`
+        or None if the triple is not supported
+    """
+    if bound_method not in bound_gradient_dict:
+        return None
+    return zhat_vjp_dict.get((type(model), measure_function_name))
+
+
+def calculate_bounds_analytic(node, bound_method, **kwargs):
+    """Calculate the predicted confidence bounds on a base node
+    during candidate selection such that autograd uses the analytic
+    gradients of the bounds instead of tracing their computation.
+    Only applies when theta is being traced by autograd, i.e.
+    when gradients are being computed.
+
+    :param node: The base node
+    :type node: :py:class:`.BaseNode` object
+    :param bound_method: The bound method, e.g. "ttest"
+    :type bound_method: str
+
+    :return: A dictionary mapping the bound name to its value,
+        or None if there is no analytic gradient for this node
+    :rtype: dict
+    """
+    theta = kwargs["theta"]
+    if (
+        not isinstance(theta, Box)
+        or kwargs["branch"] != "candidate_selection"
+        or kwargs["regime"] != "supervised_learning"
+    ):
+        return None
+
+    zhat_vjp_function = get_zhat_vjp_function(
+        kwargs["model"], node.measure_function_name, bound_method
+    )
+    data_dict = kwargs["data_dict"]
+    X = data_dict["features"]
+    if zhat_vjp_function is None or not isinstance(X, np.ndarray):
+        return None
+
+    # The raw theta is the object the prediction cache
+    # was filled with when the constraints were evaluated
+    result = zhat_vjp_function(
+        kwargs["model"],
+        getval(theta),
+        X,
+        data_dict["labels"],
+        class_index=kwargs.get("class_index"),
+        cm_true_index=kwargs.get("cm_true_index"),
+        cm_pred_index=kwargs.get("cm_pred_index"),
+    )
+    if result is None:
+        return None
+    zhat, zhat_vjp = result
+
+    if len(zhat) < 5:
+        bounds_dict = {}
+        if node.will_lower_bound:
+            bounds_dict["lower"] = -np.inf
+        if node.will_upper_bound:
+            bounds_dict["upper"] = np.inf
+        return bounds_dict
+
+    n_candidate = kwargs["dataset"].num_datapoints
+    datasize = int(round((len(zhat) / n_candidate) * kwargs["n_safety"]))
+
+    bounds = bound_gradient_dict[bound_method](node, zhat, zhat_vjp, datasize)
+    return {
+        bound_name: attach_gradient(theta, value, np.reshape(gradient, np.shape(theta)))
+        for bound_name, (value, gradient) in bounds.items()
+    }
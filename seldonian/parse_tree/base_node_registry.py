@@ -0,0 +1,122 @@
+""" Module for sharing base node evaluations
+across all parse trees of a specification """
+
+
+class BaseNodeRegistry(object):
+    def __init__(self):
+        """Keeps track of the zhat vectors (unbiased estimates of the
+        base variables) that have already been computed for the
+        current model weights, so that a base node appearing in more
+        than one parse tree, e.g. "FPR | [M]", is only evaluated once
+        per theta. Entries are de-duplicated on the base node name
+        (which encodes the measure function, any subscript and
+        the conditional columns) and the dataset used for bounding.
+
+        Call :py:meth:`reset` whenever theta changes.
+
+        :ivar theta: The model weights for which the
+                stored zhats are valid
+        :vartype theta: numpy ndarray
+        :ivar zhat_dict: Maps (node name, dataset id) to a tuple of
+                (dataset, zhat). The dataset is kept so that its id
+                cannot be reused while the entry is alive.
+        :vartype zhat_dict: dict
+        """
+        self.theta = None
+        self.zhat_dict = {}
+
+    def reset(self, theta=None):
+        """Remove all stored zhats.
+
+        :param theta: The model weights for which new
+                zhats will be registered
+        :type theta: numpy ndarray
+        """
+        self.theta = theta
+        self.zhat_dict = {}
+
+    def get_key(self, node, moments=False, **kwargs):
+        """Get the key under which the zhat (or its moments)
+        of a base node is stored, along with the dataset
+        that must be kept alive with it.
+
+        :param node: The base node
+        :type node: :py:class:`.BaseNode` object
+        :param moments: Whether the key is for the sufficient
+            statistics of zhat instead of zhat itself
+        :type moments: bool
+
+        :return: (key, dataset)
+        """
+        if "dataset" in kwargs:
+            dataset = kwargs["dataset"]
+        else:
+            dataset = kwargs["data_dict"]
+        key = (node.name, id(dataset))
+        if moments:
+            key = ("moments",) + key
+        return key, dataset
+
+    def set_zhat(self, node, zhat, moments=False, **kwargs):
+        """Store a zhat (or its moments) computed elsewhere,
+        e.g. by a worker of the parallel safety test
+
+        :param node: The base node
+        :type node: :py:class:`.BaseNode` object
+        :param zhat: The zhat vector, or (n, mean, M2) if moments is True
+        :param moments: Whether zhat is the sufficient statistics
+        :type moments: bool
+        """
+        key, dataset = self.get_key(node, moments=moments, **kwargs)
+        self.zhat_dict[key] = (dataset, zhat)
+
+    def get_stored_zhat(self, node, moments=False, **kwargs):
+        """Get a zhat (or its moments) if one has been stored
+        for the base node since the last reset, without computing it
+
+        :param node: The base node
+        :type node: :py:class:`.BaseNode` object
+        :param moments: Whether to look for the sufficient statistics
+        :type moments: bool
+
+        :return: The stored zhat or moments, or None
+        """
+        key, _ = self.get_key(node, moments=moments, **kwargs)
+        if key not in self.zhat_dict:
+            return None
+        return self.zhat_dict[key][1]
+
+    def get_zhat(self, node, **kwargs):
+        """Get the zhat vector for a base node, computing it
+        with :py:meth:`.BaseNode.zhat` if no base node
+        with the same name has been evaluated on the same
+        dataset since the last reset.
+
+        :param node: The base node to evaluate
+        :type node: :py:class:`.BaseNode` object
+
+        :return: A vector of unbiased estimates of the measure function
+        :rtype: numpy ndarray
+        """
+        key, dataset = self.get_key(node, **kwargs)
+        if key not in self.zhat_dict:
+            self.zhat_dict[key] = (dataset, node.zhat(**kwargs))
+        return self.zhat_dict[key][1]
+
+    def get_zhat_moments(self, node, **kwargs):
+        """Get the sufficient statistics (n, mean, M2) of the zhat
+        vector for a base node, computing them with
+        :py:meth:`.BaseNode.zhat_moments` if no base node
+        with the same name has been evaluated on the same
+        dataset since the last reset.
+
+        :param node: The base node to evaluate
+        :type node: :py:class:`.BaseNode` object
+
+        :return: (n, mean, M2)
+        :rtype: tuple
+        """
+        key, dataset = self.get_key(node, moments=True, **kwargs)
+        if key not in self.zhat_dict:
+            self.zhat_dict[key] = (dataset, node.zhat_moments(**kwargs))
+        return self.zhat_dict[key][1]
@@ -3,8 +3,9 @@ from functools import reduce, partial
 import pandas as pd
 import autograd.numpy as np
 
-from . import zhat_funcs
+from . import zhat_funcs, analytic_gradients
 from seldonian.utils.stats_utils import *
+from seldonian.dataset import calculate_episode_returns
 
 """
 
@@ -229,18 +230,9 @@ class BaseNode(Node):
         :return: The masked dataframe
         :rtype: numpy ndarray
         """
-        # Figure out indices of sensitive attributes from their column names
-        sensitive_col_indices = [
-            dataset.sensitive_col_names.index(col) for col in conditional_columns
-        ]
-
-        joint_mask = reduce(
-            np.logical_and,
-            (
-                dataset.sensitive_attrs[:, col_index] == 1
-                for col_index in sensitive_col_indices
-            ),
-        )
+        # Row indices are precomputed once per dataset
+        # and combination of conditional columns
+        joint_mask = dataset.get_mask_indices(conditional_columns)
         if dataset.regime == "supervised_learning":
             if type(dataset.features) == list:
                 masked_features = [x[joint_mask] for x in dataset.features]
@@ -261,7 +253,7 @@ class BaseNode(Node):
             return masked_features, masked_labels
 
         elif dataset.regime == "reinforcement_learning":
-            masked_episodes = np.asarray(dataset.episodes)[joint_mask]
+            masked_episodes = dataset.get_episode_columns()[joint_mask]
             return masked_episodes
 
         elif dataset.regime == "custom":
@@ -303,30 +295,26 @@ class BaseNode(Node):
 
         elif regime == "reinforcement_learning":
             gamma = model.env_kwargs["gamma"]
-            episodes = dataset.episodes
-
-            if self.conditional_columns:
-                masked_episodes = self.mask_data(dataset, self.conditional_columns)
-            else:
-                masked_episodes = episodes
+            # The estimators work on the episodes in columnar storage
+            episodes = dataset.get_episode_columns()
 
             # Precalculate expected return from behavioral policy
             # using the reward specified by the alt_reward_number
             # These are only ever used in the zhat functions, so
-            # they pertain to the constraint, not the primary objective
-            if "alt_reward_number" in kwargs:
-                # use the alternate reward specified in the constraint string
-                # when calculating the return
-                alt_reward_number = kwargs["alt_reward_number"]
-                alt_reward_index = alt_reward_number - 1
-                masked_returns = [
-                    weighted_sum_gamma(ep.alt_rewards[:, alt_reward_index], gamma)
-                    for ep in masked_episodes
+            # they pertain to the constraint, not the primary objective.
+            # The dataset caches the returns of all of its episodes.
+            returns = dataset.get_discounted_returns(
+                gamma, alt_reward_number=kwargs.get("alt_reward_number")
+            )
+
+            if self.conditional_columns:
+                masked_episodes = self.mask_data(dataset, self.conditional_columns)
+                masked_returns = returns[
+                    dataset.get_mask_indices(self.conditional_columns)
                 ]
             else:
-                masked_returns = [
-                    weighted_sum_gamma(ep.rewards, gamma) for ep in masked_episodes
-                ]
+                masked_episodes = episodes
+                masked_returns = returns
 
             data_dict = {
                 "episodes": masked_episodes,
@@ -371,7 +359,44 @@ class BaseNode(Node):
                 # --TODO-- abstract away to support things like
                 # getting confidence intervals from bootstrap
                 # and RL cases
-                estimator_samples = self.zhat(**kwargs)
+                registry = kwargs.get("base_node_registry")
+                if registry is not None:
+                    # Moments computed elsewhere, e.g. merged from
+                    # the shards of data-parallel candidate selection
+                    moments = registry.get_stored_zhat(self, moments=True, **kwargs)
+                    if moments is not None:
+                        return self.calculate_bounds_from_moments(moments, **kwargs)
+
+                if (
+                    kwargs.get("use_analytic_gradients", False)
+                    and type(self).zhat is BaseNode.zhat
+                ):
+                    # Closed-form gradients of the bounds for built-in
+                    # models and measure functions, if available
+                    bounds_dict = analytic_gradients.calculate_bounds_analytic(
+                        self, **kwargs
+                    )
+                    if bounds_dict is not None:
+                        return bounds_dict
+
+                if self.use_streaming_bounds(**kwargs):
+                    # The t-test bounds only need the sufficient statistics,
+                    # so don't materialize the zhat vector
+                    if kwargs.get("base_node_registry") is not None:
+                        moments = kwargs["base_node_registry"].get_zhat_moments(
+                            self, **kwargs
+                        )
+                    else:
+                        moments = self.zhat_moments(**kwargs)
+                    return self.calculate_bounds_from_moments(moments, **kwargs)
+
+                if kwargs.get("base_node_registry") is not None:
+                    # Share zhat with identical base nodes in other trees
+                    estimator_samples = kwargs["base_node_registry"].get_zhat(
+                        self, **kwargs
+                    )
+                else:
+                    estimator_samples = self.zhat(**kwargs)
 
                 if len(estimator_samples) < 5:
                     bounds_dict = {}
@@ -467,6 +492,98 @@ class BaseNode(Node):
             **kwargs,
         )
 
+    def use_streaming_bounds(self, **kwargs):
+        """Whether the safety test bounds can be calculated
+        from the streamed sufficient statistics of zhat
+        (see :py:meth:`zhat_moments`). This is the case for the t-test
+        on the built-in measure functions of the supervised learning
+        and custom regimes when batch_size_safety is set.
+
+        :return: True if the streaming bounds are used
+        :rtype: bool
+        """
+        return (
+            kwargs["branch"] == "safety_test"
+            and kwargs.get("bound_method") == "ttest"
+            and kwargs.get("batch_size_safety") is not None
+            and kwargs["regime"] in ["supervised_learning", "custom"]
+            and type(self).zhat is BaseNode.zhat
+            and type(self).compute_HC_lowerbound is BaseNode.compute_HC_lowerbound
+            and type(self).compute_HC_upperbound is BaseNode.compute_HC_upperbound
+        )
+
+    def zhat_moments(self, model, theta, data_dict, sub_regime, **kwargs):
+        """
+        Calculate the sufficient statistics of the unbiased
+        estimates of the base variable node, streaming
+        over chunks of the data.
+
+        :param model: The machine learning model
+        :type model: models.SeldonianModel object
+        :param theta:
+            model weights
+        :type theta: numpy ndarray
+        :param data_dict:
+            Contains inputs to model,
+            such as features and labels
+        :type data_dict: dict
+
+        :return: (n, mean, M2) of the zhat vector
+        :rtype: tuple
+        """
+        return zhat_funcs.moments_from_statistic(
+            model=model,
+            statistic_name=self.measure_function_name,
+            theta=theta,
+            data_dict=data_dict,
+            sub_regime=sub_regime,
+            **kwargs,
+        )
+
+    def calculate_bounds_from_moments(self, moments, **kwargs):
+        """
+        Calculate the t-test bounds from the sufficient statistics
+        of the zhat vector. In the safety test this is equivalent to
+        :py:meth:`compute_HC_lowerbound` and :py:meth:`compute_HC_upperbound`
+        on the vector itself, and in candidate selection to
+        :py:meth:`predict_HC_lowerbound` and :py:meth:`predict_HC_upperbound`.
+
+        :param moments: (n, mean, M2) of the zhat vector
+        :type moments: tuple
+
+        :return: A dictionary mapping the bound name to its value,
+            e.g., {"lower":-1.0, "upper": 1.0}
+        """
+        n, mean, _ = moments
+        bounds_dict = {}
+        if n < 5:
+            if self.will_lower_bound:
+                bounds_dict["lower"] = -np.inf
+            if self.will_upper_bound:
+                bounds_dict["upper"] = np.inf
+            return bounds_dict
+
+        if kwargs["branch"] == "candidate_selection":
+            # Predict the bound on the safety dataset
+            n_candidate = kwargs["dataset"].num_datapoints
+            datasize = int(round((n / n_candidate) * kwargs["n_safety"]))
+            infl_factor_lower = self.infl_factor_lower
+            infl_factor_upper = self.infl_factor_upper
+        else:
+            datasize = n
+            infl_factor_lower = infl_factor_upper = 1
+
+        std_error = stddev_from_moments(moments) / np.sqrt(datasize)
+        if self.will_lower_bound:
+            bounds_dict["lower"] = mean - infl_factor_lower * std_error * tinv(
+                1.0 - self.delta_lower, datasize - 1
+            )
+        if self.will_upper_bound:
+            bounds_dict["upper"] = mean + infl_factor_upper * std_error * tinv(
+                1.0 - self.delta_upper, datasize - 1
+            )
+        return bounds_dict
+
     def predict_HC_lowerbound(self, data, datasize, delta, **kwargs):
         """
         Calculate high confidence lower bound
@@ -859,12 +976,9 @@ class NewPolicyPerformanceBaseNode(BaseNode):
         :type on_policy: Boolean
         """
         if on_policy:
-            episodes_new = kwargs["dataset"].episodes
             model = kwargs["model"]
             gamma = model.env_kwargs["gamma"]
-            returns_new = np.array(
-                [weighted_sum_gamma(ep.rewards, gamma) for ep in episodes_new]
-            )
+            returns_new = kwargs["dataset"].get_discounted_returns(gamma)
             value = np.mean(returns_new)
         else:
             value = zhat_funcs.evaluate_statistic(
@@ -940,10 +1054,9 @@ class RLAltRewardBaseNode(NewPolicyPerformanceBaseNode):
             model = kwargs["model"]
             gamma = model.env_kwargs["gamma"]
             alt_reward_index = self.alt_reward_number - 1
-            returns_new = [
-                weighted_sum_gamma(ep.alt_rewards[:, alt_reward_index], gamma)
-                for ep in episodes_new
-            ]
+            returns_new = calculate_episode_returns(
+                episodes_new, gamma, alt_rewards=True
+            )[:, alt_reward_index]
             value = np.mean(returns_new)
         else:
             value = zhat_funcs.evaluate_statistic(
@@ -27,6 +27,22 @@ during the construction of parse trees
 	If an operator has one child, A, then
 	arrays are boolean:
 	[need_A_lower, need_A_upper]
+
+.. data:: op_code_dict
+	:type: dict
+
+	Maps the string representation of each supported
+	operator to the integer opcode used in the
+	compiled evaluation plan of a parse tree.
+	Binary operators come first, followed by
+	unary operators (see :py:data:`n_binary_op_codes`)
+
+.. data:: n_binary_op_codes
+	:type: int
+
+	Number of binary operators in op_code_dict.
+	Any opcode greater than or equal to this
+	value refers to a unary operator.
 """
 import ast
 
@@ -62,3 +78,18 @@ bounds_required_dict = {
     "exp": {"lower": [1, 0], "upper": [0, 1],},
     "log": {"lower": [1, 0], "upper": [0, 1],},
 }
+
+op_code_dict = {
+    "add": 0,
+    "sub": 1,
+    "mult": 2,
+    "div": 3,
+    "pow": 4,
+    "min": 5,
+    "max": 6,
+    "abs": 7,
+    "exp": 8,
+    "log": 9,
+}
+
+n_binary_op_codes = 7
@@ -8,6 +8,7 @@ import warnings
 import graphviz
 import autograd.numpy as np  # Thinly-wrapped version of Numpy
 
+from seldonian.utils.array_utils import array_namespace
 from seldonian.warnings.custom_warnings import *
 from .nodes import *
 from .operators import *
@@ -15,6 +16,87 @@ from .operators import *
 default_bound_method = "ttest"
 
 
+class EvaluationPlan(object):
+    def __init__(self, root):
+        """
+        Flat, topologically ordered representation of a
+        parse tree used for propagating confidence bounds
+        without recursing through the tree. Every node is assigned
+        a slot in postorder (left, right, root), so the children of an
+        internal node are always evaluated before the node itself.
+
+        :param root: Root node of the parse tree
+        :type root: :py:class:`.Node` object
+
+        :ivar root: The root node the plan was compiled from
+        :vartype root: :py:class:`.Node` object
+        :ivar nodes: The node occupying each slot
+        :vartype nodes: List(:py:class:`.Node`)
+        :ivar base_slots: The slots occupied by base nodes
+        :vartype base_slots: List(int)
+        :ivar instructions: One (opcode, left_slot, right_slot, out_slot)
+                tuple per internal node, in evaluation order.
+                right_slot is -1 for unary operators.
+                Opcodes are defined in :py:data:`.op_code_dict`
+        :vartype instructions: List(tuple)
+        :ivar lower: Lower bound of the node in each slot
+        :vartype lower: List(float)
+        :ivar upper: Upper bound of the node in each slot
+        :vartype upper: List(float)
+        """
+        self.root = root
+        self.nodes = []
+        self.base_slots = []
+        self.instructions = []
+        if root is not None:
+            self._compile_helper(root)
+
+        # Preallocated slot buffers. These are lists rather than float arrays
+        # because during candidate selection the bounds are autograd boxes.
+        # Constant slots are filled once here and never overwritten.
+        n_slots = len(self.nodes)
+        self.lower = [float("-inf")] * n_slots
+        self.upper = [float("inf")] * n_slots
+        for slot, node in enumerate(self.nodes):
+            if isinstance(node, ConstantNode):
+                self.lower[slot] = node.lower
+                self.upper[slot] = node.upper
+
+    def _compile_helper(self, node):
+        """
+        Helper function for assigning slots
+        and emitting instructions in postorder
+
+        :param node: node in the parse tree
+        :type node: :py:class:`.Node` object
+        :return: The slot assigned to node
+        :rtype: int
+        """
+        if isinstance(node, (BaseNode, ConstantNode)):
+            slot = len(self.nodes)
+            self.nodes.append(node)
+            if isinstance(node, BaseNode):
+                self.base_slots.append(slot)
+            return slot
+
+        if node.name not in op_code_dict:
+            raise NotImplementedError(
+                "Encountered an operation we do not yet support", node.name
+            )
+
+        left_slot = self._compile_helper(node.left)
+        right_slot = -1
+        if node.right:
+            right_slot = self._compile_helper(node.right)
+
+        slot = len(self.nodes)
+        self.nodes.append(node)
+        self.instructions.append(
+            (op_code_dict[node.name], left_slot, right_slot, slot)
+        )
+        return slot
+
+
 class ParseTree(object):
     def __init__(
         self, delta, regime, sub_regime, columns=[], custom_measure_functions={}
@@ -82,6 +164,10 @@ class ParseTree(object):
                 for supervised regression or "PR", i.e. Positive Rate
                 for supervised classification.
         :vartype available_measure_functions: int
+        :ivar eval_plan:
+                The compiled evaluation plan used by propagate_bounds().
+                Set by compile()
+        :vartype eval_plan: :py:class:`EvaluationPlan`
         """
         if not (0.0 < delta < 1.0):
             raise ValueError("delta must be in (0,1)")
@@ -96,6 +182,7 @@ class ParseTree(object):
         self.base_node_dict = {}
         self.n_unique_bounds_tot = None
         self.node_fontsize = 12
+        self.eval_plan = None
 
         if self.regime in ["supervised_learning", "reinforcement_learning"]:
             self.available_measure_functions = measure_functions_dict[self.regime][
@@ -118,7 +205,8 @@ class ParseTree(object):
         Convenience function for building the tree from
         a constraint string, subdividing the tree delta 
         to deltas for each base node, and assigning which 
-        nodes need upper and lower bounding.
+        nodes need upper and lower bounding. Finally, compiles
+        the tree into a flat evaluation plan.
 
         :param constraint_str:
                 mathematical expression written in Python syntax
@@ -149,6 +237,8 @@ class ParseTree(object):
 
         self.assign_infl_factors(method=infl_factor_method, factors=infl_factors)
 
+        self.compile()
+
     def create_from_ast(self, s):
         """
         Create the node structure of the tree
@@ -173,6 +263,7 @@ class ParseTree(object):
 
         # Recursively build the tree
         self.root = self._ast_tree_helper(root)
+        self.eval_plan = None
 
     def _preprocess_constraint_str(self, s):
         """
@@ -314,6 +405,7 @@ class ParseTree(object):
                     "infl_factor_lower": None,
                     "infl_factor_upper": None,
                     "data_dict": None,
+                    "data_source": None,
                 }
 
         self.n_nodes += 1
@@ -956,22 +1048,112 @@ class ParseTree(object):
                 raise ValueError(f"factors must all be non-negative")
         return factors
 
+    def compile(self):
+        """
+        Lower the tree into a flat :py:class:`EvaluationPlan`
+        so that bounds can be propagated with a single loop
+        over integer opcodes instead of recursing through the tree.
+        Called by build_tree(). If the tree was built
+        another way, propagate_bounds() compiles it on first use.
+
+        :return: The compiled plan
+        :rtype: :py:class:`EvaluationPlan`
+        """
+        self.eval_plan = EvaluationPlan(self.root)
+        return self.eval_plan
+
+    def _get_eval_plan(self):
+        """Get the compiled evaluation plan,
+        compiling the tree if it has changed since
+        the plan was made
+
+        :rtype: :py:class:`EvaluationPlan`
+        """
+        plan = getattr(self, "eval_plan", None)
+        if plan is None or plan.root is not self.root:
+            plan = self.compile()
+        return plan
+
+    def get_unique_base_nodes(self):
+        """Get the base nodes of the tree, keeping only
+        the first base node with each name, since base nodes
+        with the same name share their bounds.
+
+        :return: List of base nodes in postorder
+        :rtype: List(:py:class:`.BaseNode`)
+        """
+        if not self.root:
+            return []
+        plan = self._get_eval_plan()
+        unique_nodes = {}
+        for slot in plan.base_slots:
+            node = plan.nodes[slot]
+            unique_nodes.setdefault(node.name, node)
+        return list(unique_nodes.values())
+
+    def get_unique_base_node(self, node_name):
+        """Get the first base node in the tree with a given name
+
+        :param node_name: The name of the base node, e.g. "FPR"
+        :type node_name: str
+
+        :rtype: :py:class:`.BaseNode`
+        """
+        for node in self.get_unique_base_nodes():
+            if node.name == node_name:
+                return node
+        raise KeyError(f"No base node named {node_name} in {self.constraint_str}")
+
     def propagate_bounds(self, **kwargs):
         """
-        Postorder traverse (left, right, root)
-        through the tree and calculate confidence
-        bounds on base nodes,
-        then propagate bounds using propagation logic
+        Calculate confidence bounds on base nodes,
+        then propagate bounds using propagation logic.
+        Runs the compiled evaluation plan, which visits nodes
+        in postorder (left, right, root).
         """
         if not self.root:
             return []
 
-        self._propagator_helper(self.root, **kwargs)
+        plan = self._get_eval_plan()
+
+        lower = plan.lower
+        upper = plan.upper
+        nodes = plan.nodes
+
+        for slot in plan.base_slots:
+            node = nodes[slot]
+            self._bound_base_node(node, **kwargs)
+            lower[slot] = node.lower
+            upper[slot] = node.upper
+
+        # Indexed by opcode, see operators.op_code_dict
+        op_funcs = (
+            self._add,
+            self._sub,
+            self._mult,
+            self._div,
+            self._warn_pow,
+            self._min,
+            self._max,
+            self._abs,
+            self._exp,
+            self._log,
+        )
+        for opcode, left_slot, right_slot, out_slot in plan.instructions:
+            a = (lower[left_slot], upper[left_slot])
+            if opcode < n_binary_op_codes:
+                result = op_funcs[opcode](a, (lower[right_slot], upper[right_slot]))
+            else:
+                result = op_funcs[opcode](a)
+            lower[out_slot], upper[out_slot] = result
+            nodes[out_slot].lower, nodes[out_slot].upper = result
 
     def _propagator_helper(self, node, **kwargs):
         """
-        Helper function for traversing
-        through the tree and propagating confidence bounds
+        Helper function for recursively traversing
+        through the tree and propagating confidence bounds.
+        Equivalent to running the compiled evaluation plan,
+        but slower for trees with many nodes.
 
         :param node: node in the parse tree
         :type node: :py:class:`.Node` object
@@ -985,67 +1167,117 @@ class ParseTree(object):
         # if we hit a BaseNode,
         # then calculate confidence bounds and return
         if isinstance(node, BaseNode):
-            # Check if bound has already been calculated for this node name
-            # If so, use precalculated bound
-            if self.base_node_dict[node.name]["bound_computed"] == True:
-                node.lower = self.base_node_dict[node.name]["lower"]
-                node.upper = self.base_node_dict[node.name]["upper"]
-                return
+            self._bound_base_node(node, **kwargs)
+            return
 
-            # Need to calculate the bound
-            if "tree_dataset_dict" in kwargs:
-                # First, extract the dataset for this base node
-                tree_dataset_dict = kwargs["tree_dataset_dict"]
-                if node.name in tree_dataset_dict:
-                    kwargs["dataset"] = tree_dataset_dict[node.name]
-                else:
-                    if "all" not in tree_dataset_dict:
-                        raise RuntimeError(
-                            "There was an issue getting the dataset for bounding "
-                            f"the base node: {node.name} in the parse tree: {self.constraint_str}"
-                        )
-                    kwargs["dataset"] = tree_dataset_dict["all"]
-                # Check if data has already been prepared
-                # for this node name. If so, use precalculated data
-                if self.base_node_dict[node.name]["data_dict"] != None:
-                    data_dict = self.base_node_dict[node.name]["data_dict"]
-                else:
-                    # Data not prepared already. Need to do that.
-                    if isinstance(node, RLAltRewardBaseNode):
-                        kwargs["alt_reward_number"] = node.alt_reward_number
+        # traverse to children first
+        self._propagator_helper(node.left, **kwargs)
+        self._propagator_helper(node.right, **kwargs)
 
-                    data_dict = node.calculate_data_forbound(**kwargs)
-                    self.base_node_dict[node.name]["data_dict"] = data_dict
+        # Here we must be at an internal node and therefore need to propagate
+        node.lower, node.upper = self.propagate(node)
 
-                kwargs["data_dict"] = data_dict
+    def _bound_base_node(self, node, **kwargs):
+        """
+        Calculate the confidence bounds on a single base node,
+        reusing bounds and data already computed for
+        base nodes with the same name
 
-            bound_method = self.base_node_dict[node.name]["bound_method"]
+        :param node: base node in the parse tree
+        :type node: :py:class:`.BaseNode` object
+        """
+        # Check if bound has already been calculated for this node name
+        # If so, use precalculated bound
+        if self.base_node_dict[node.name]["bound_computed"] == True:
+            node.lower = self.base_node_dict[node.name]["lower"]
+            node.upper = self.base_node_dict[node.name]["upper"]
+            return
 
-            if isinstance(node, ConfusionMatrixBaseNode):
-                kwargs["cm_true_index"] = node.cm_true_index
-                kwargs["cm_pred_index"] = node.cm_pred_index
-            if self.regime == "custom":
-                kwargs["custom_measure_functions"] = self.custom_measure_functions
+        # Need to calculate the bound
+        kwargs = self.get_base_node_kwargs(node, **kwargs)
+        bound_result = node.calculate_bounds(**kwargs)
+        self.base_node_dict[node.name]["bound_computed"] = True
 
-            bound_result = node.calculate_bounds(bound_method=bound_method, **kwargs)
-            self.base_node_dict[node.name]["bound_computed"] = True
+        if node.will_lower_bound:
+            node.lower = bound_result["lower"]
+            self.base_node_dict[node.name]["lower"] = node.lower
 
-            if node.will_lower_bound:
-                node.lower = bound_result["lower"]
-                self.base_node_dict[node.name]["lower"] = node.lower
+        if node.will_upper_bound:
+            node.upper = bound_result["upper"]
+            self.base_node_dict[node.name]["upper"] = node.upper
 
-            if node.will_upper_bound:
-                node.upper = bound_result["upper"]
-                self.base_node_dict[node.name]["upper"] = node.upper
+    def get_base_node_kwargs(self, node, **kwargs):
+        """
+        Get the keyword arguments for bounding a single base node
+        from those passed to propagate_bounds: its dataset and
+        prepared data, its bound method and any arguments
+        specific to the type of base node.
 
-            return
+        :param node: base node in the parse tree
+        :type node: :py:class:`.BaseNode` object
 
-        # traverse to children first
-        self._propagator_helper(node.left, **kwargs)
-        self._propagator_helper(node.right, **kwargs)
+        :return: keyword arguments for :py:meth:`.BaseNode.calculate_bounds`
+        :rtype: dict
+        """
+        if "tree_dataset_dict" in kwargs:
+            kwargs["dataset"], kwargs["data_dict"] = self._get_base_node_data(
+                node, **kwargs
+            )
 
-        # Here we must be at an internal node and therefore need to propagate
-        node.lower, node.upper = self.propagate(node)
+        kwargs["bound_method"] = self.base_node_dict[node.name]["bound_method"]
+
+        if isinstance(node, ConfusionMatrixBaseNode):
+            kwargs["cm_true_index"] = node.cm_true_index
+            kwargs["cm_pred_index"] = node.cm_pred_index
+        if isinstance(node, MultiClassBaseNode):
+            kwargs["class_index"] = node.class_index
+        if self.regime == "custom":
+            kwargs["custom_measure_functions"] = self.custom_measure_functions
+        return kwargs
+
+    def _get_base_node_data(self, node, **kwargs):
+        """
+        Get the dataset for a base node from the tree_dataset_dict
+        and the data prepared from it for bounding or evaluating
+        the node. Prepared data is reused for as long as the
+        base node is given the same dataset object, so it only
+        needs to be recalculated when the dataset (e.g. the batch) changes.
+
+        :param node: base node in the parse tree
+        :type node: :py:class:`.BaseNode` object
+
+        :return: (dataset, data_dict)
+        """
+        # First, extract the dataset for this base node
+        tree_dataset_dict = kwargs["tree_dataset_dict"]
+        if node.name in tree_dataset_dict:
+            dataset = tree_dataset_dict[node.name]
+        else:
+            if "all" not in tree_dataset_dict:
+                raise RuntimeError(
+                    "There was an issue getting the dataset for bounding "
+                    f"the base node: {node.name} in the parse tree: {self.constraint_str}"
+                )
+            dataset = tree_dataset_dict["all"]
+
+        # Check if data has already been prepared from this dataset
+        # for this node name. If so, use precalculated data
+        node_dict = self.base_node_dict[node.name]
+        if (
+            node_dict["data_dict"] != None
+            and node_dict.get("data_source", dataset) is dataset
+        ):
+            return dataset, node_dict["data_dict"]
+
+        # Data not prepared already. Need to do that.
+        kwargs["dataset"] = dataset
+        if isinstance(node, RLAltRewardBaseNode):
+            kwargs["alt_reward_number"] = node.alt_reward_number
+
+        data_dict = node.calculate_data_forbound(**kwargs)
+        node_dict["data_dict"] = data_dict
+        node_dict["data_source"] = dataset
+        return dataset, data_dict
 
     def evaluate_constraint(self, **kwargs):
         """
@@ -1084,34 +1316,15 @@ class ParseTree(object):
                 return
             else:
                 if "tree_dataset_dict" in kwargs:
-                    # First, extract the dataset for this base node
-                    tree_dataset_dict = kwargs["tree_dataset_dict"]
-                    if node.name in tree_dataset_dict:
-                        kwargs["dataset"] = tree_dataset_dict[node.name]
-                    else:
-                        if "all" not in tree_dataset_dict:
-                            raise RuntimeError(
-                                "There was an issue getting the dataset for bounding "
-                                f"the base node: {node.name} in the parse tree: {self.constraint_str}"
-                            )
-                        kwargs["dataset"] = tree_dataset_dict["all"]
-                    # Check if data has already been prepared
-                    # for this node name. If so, use precalculated data
-                    if self.base_node_dict[node.name]["data_dict"] != None:
-                        data_dict = self.base_node_dict[node.name]["data_dict"]
-                    else:
-                        # Data not prepared already. Need to do that.
-                        if isinstance(node, RLAltRewardBaseNode):
-                            kwargs["alt_reward_number"] = node.alt_reward_number
-
-                        data_dict = node.calculate_data_forbound(**kwargs)
-                        self.base_node_dict[node.name]["data_dict"] = data_dict
-
-                    kwargs["data_dict"] = data_dict
+                    kwargs["dataset"], kwargs["data_dict"] = self._get_base_node_data(
+                        node, **kwargs
+                    )
 
                 if isinstance(node, ConfusionMatrixBaseNode):
                     kwargs["cm_true_index"] = node.cm_true_index
                     kwargs["cm_pred_index"] = node.cm_pred_index
+                if isinstance(node, MultiClassBaseNode):
+                    kwargs["class_index"] = node.class_index
 
                 if self.regime == "custom":
                     kwargs["custom_measure_functions"] = self.custom_measure_functions
@@ -1172,11 +1385,11 @@ class ParseTree(object):
 
         if node.name == "exp":
             # takes one node
-            return np.exp(a)
+            return array_namespace(a).exp(a)
 
         if node.name == "log":
             # takes one node
-            return np.log(a)
+            return array_namespace(a).log(a)
 
         else:
             raise NotImplementedError(
@@ -1195,7 +1408,7 @@ class ParseTree(object):
                 'lower' or 'upper'
         :type bound_type: str
         """
-        if np.isnan(bound):
+        if array_namespace(bound).isnan(bound):
             if bound_type == "lower":
                 return float("-inf")
             if bound_type == "upper":
@@ -1231,14 +1444,9 @@ class ParseTree(object):
             return self._div(a, b)
 
         if node.name == "pow":
-            warning_msg = (
-                "Warning: Power operation "
-                "is an experimental feature. Use with caution."
-            )
-            warnings.warn(warning_msg)
             a = (node.left.lower, node.left.upper)
             b = (node.right.lower, node.right.upper)
-            return self._pow(a, b)
+            return self._warn_pow(a, b)
 
         if node.name == "min":
             a = (node.left.lower, node.left.upper)
@@ -1392,6 +1600,25 @@ class ParseTree(object):
 
         return (lower, upper)
 
+    def _warn_pow(self, a, b):
+        """
+        Warn that the power operation is experimental,
+        then raise confidence interval a to the power of b
+
+        :param a:
+                Confidence interval like: (lower,upper)
+        :type a: tuple
+        :param b:
+                Confidence interval like: (lower,upper)
+        :type b: tuple
+        """
+        warning_msg = (
+            "Warning: Power operation "
+            "is an experimental feature. Use with caution."
+        )
+        warnings.warn(warning_msg)
+        return self._pow(a, b)
+
     def _min(self, a, b):
         """
         Get the minimum of two confidence intervals
@@ -1432,9 +1659,11 @@ class ParseTree(object):
         """
         abs_a0 = abs(a[0])
         abs_a1 = abs(a[1])
+        sign_a0 = array_namespace(a[0]).sign(a[0])
+        sign_a1 = array_namespace(a[1]).sign(a[1])
 
         lower = self._protect_nan(
-            min(abs_a0, abs_a1) if np.sign(a[0]) == np.sign(a[1]) else 0, "lower"
+            min(abs_a0, abs_a1) if sign_a0 == sign_a1 else 0, "lower"
         )
 
         upper = self._protect_nan(max(abs_a0, abs_a1), "upper")
@@ -1450,9 +1679,9 @@ class ParseTree(object):
         :type a: tuple
         """
 
-        lower = self._protect_nan(np.exp(a[0]), "lower")
+        lower = self._protect_nan(array_namespace(a[0]).exp(a[0]), "lower")
 
-        upper = self._protect_nan(np.exp(a[1]), "upper")
+        upper = self._protect_nan(array_namespace(a[1]).exp(a[1]), "upper")
 
         return (lower, upper)
 
@@ -1464,9 +1693,9 @@ class ParseTree(object):
                 Confidence interval like: (lower,upper)
         :type a: tuple
         """
-        lower = self._protect_nan(np.log(a[0]), "lower")
+        lower = self._protect_nan(array_namespace(a[0]).log(a[0]), "lower")
 
-        upper = self._protect_nan(np.log(a[1]), "upper")
+        upper = self._protect_nan(array_namespace(a[1]).log(a[1]), "upper")
 
         return (lower, upper)
 
@@ -1480,7 +1709,9 @@ class ParseTree(object):
         :param reset_data:
                 Whether to reset the cached data
                 for each base node. This is needed less frequently
-                than one needs to reset the bounds.
+                than one needs to reset the bounds. Cached data is
+                also recalculated whenever a base node is
+                given a different dataset object.
         :type reset_data: bool
         """
         for node_name in self.base_node_dict:
@@ -1491,6 +1722,7 @@ class ParseTree(object):
             self.base_node_dict[node_name]["upper"] = float("inf")
             if reset_data:
                 self.base_node_dict[node_name]["data_dict"] = None
+                self.base_node_dict[node_name]["data_source"] = None
 
         return
 
@@ -11,12 +11,26 @@ for computing unbiased estimates of base variables
 """
 
 import autograd.numpy as np  # Thinly-wrapped version of Numpy
+from autograd.scipy.special import logsumexp
+from autograd.extend import primitive, defvjp, vspace
+from autograd import make_vjp
 import math
 
 from seldonian.utils.stats_utils import (
+    sample_moments,
+    merge_moments,
     weighted_sum_gamma,
-    custom_cumprod,
     stability_const,
+    segment_sum,
+    segment_cumsum,
+    exp_weighted,
+)
+from seldonian.dataset import EpisodeColumns
+from seldonian.models.prediction_cache import cached_predict
+from seldonian.utils.array_utils import as_array_like
+from seldonian.models.objectives import (
+    get_log_importance_ratios,
+    get_log_importance_weights,
 )
 
 
@@ -42,36 +56,20 @@ def batcher(func, N, batch_size, num_batches):
         regime = kw["regime"]
         model = args[0]
         theta = args[1]
-        if regime == "supervised_learning":
-            features = args[2]
-            labels = args[3]
-        elif regime == "reinforcement_learning":
+        if regime == "reinforcement_learning":
             episodes = args[2]
             weighted_returns = kw["weighted_returns"]
-        elif regime == "custom":
-            data = args[2]
         if num_batches > 1:
             res = np.zeros(N)
             batch_start = 0
             for i in range(num_batches):
                 batch_end = batch_start + batch_size
-                if regime == "supervised_learning":
-                    if type(features) == list:
-                        features_batch = [x[batch_start:batch_end] for x in features]
-                    else:
-                        features_batch = features[batch_start:batch_end]
-
-                    labels_batch = labels[batch_start:batch_end]
-                    batch_args = [model, theta, features_batch, labels_batch]
-
-                elif regime == "reinforcement_learning":
+                if regime == "reinforcement_learning":
                     episodes_batch = episodes[batch_start:batch_end]
                     weighted_returns_batch = weighted_returns[batch_start:batch_end]
                     batch_args = [model, theta, episodes_batch, weighted_returns_batch]
-
-                elif regime == "custom":
-                    data_batch = data[batch_start:batch_end]
-                    batch_args = [model, theta, data_batch]
+                else:
+                    batch_args = _slice_data_args(args, regime, batch_start, batch_end)
 
                 res[batch_start:batch_end] = func(*batch_args, **kw)
 
@@ -83,6 +81,139 @@ def batcher(func, N, batch_size, num_batches):
     return wrapper
 
 
+def _slice_data_args(args, regime, batch_start, batch_end):
+    """Get the positional arguments of a measure function
+    restricted to the rows batch_start:batch_end of the data.
+    Only for the supervised learning and custom regimes.
+
+    :param args: The positional arguments for the full data,
+        i.e. [model, theta, features, labels] or [model, theta, data]
+    :type args: list
+    :param regime: The category of the machine learning algorithm
+    :type regime: str
+    :param batch_start: The first row of the batch
+    :type batch_start: int
+    :param batch_end: One past the last row of the batch
+    :type batch_end: int
+
+    :return: The positional arguments for the batch
+    :rtype: list
+    """
+    model, theta = args[0], args[1]
+    if regime == "supervised_learning":
+        features, labels = args[2], args[3]
+        if type(features) == list:
+            features_batch = [x[batch_start:batch_end] for x in features]
+        else:
+            features_batch = features[batch_start:batch_end]
+        return [model, theta, features_batch, labels[batch_start:batch_end]]
+    return [model, theta, args[2][batch_start:batch_end]]
+
+
+@primitive
+def _evaluate_in_chunks(theta, chunk_funcs):
+    """Evaluate a measure function chunk by chunk without
+    recording any of the chunks in the autograd graph.
+
+    :param theta: The model weights
+    :type theta: numpy ndarray
+    :param chunk_funcs: List of functions of theta, each evaluating
+        the measure function on one chunk of the data
+
+    :return: The concatenated results of all chunks
+    :rtype: numpy ndarray
+    """
+    return np.concatenate([func(theta) for func in chunk_funcs])
+
+
+def _evaluate_in_chunks_vjp(ans, theta, chunk_funcs):
+    """Accumulate the vector Jacobian product over the chunks,
+    recomputing the forward pass of one chunk at a time so that
+    only one chunk's graph is held in memory."""
+
+    def fn(g):
+        grad = vspace(theta).zeros()
+        start = 0
+        for func in chunk_funcs:
+            # Conditional measures (e.g. FPR) return fewer
+            # values than the number of rows in the chunk
+            chunk_vjp, chunk_ans = make_vjp(func)(theta)
+            end = start + len(chunk_ans)
+            grad = grad + chunk_vjp(g[start:end])
+            start = end
+        return grad
+
+    return fn
+
+
+defvjp(_evaluate_in_chunks, _evaluate_in_chunks_vjp)
+
+
+def chunked_evaluator(func, N, batch_size):
+    """Like :py:func:`batcher`, but the returned wrapper
+    can be differentiated with autograd. The forward pass
+    of each chunk is discarded once it has been evaluated
+    and is recomputed on the backward pass, which bounds
+    the memory needed for the gradient by the size of one chunk.
+    Only for the supervised learning and custom regimes.
+
+    :param func: The measure function
+    :param N: The total number of datapoints
+    :type N: int
+    :param batch_size: The size of each chunk
+    :type batch_size: int
+
+    :return: A wrapper function that does the actual function calls
+    """
+
+    def wrapper(*args, **kw):
+        model, theta = args[0], args[1]
+        chunk_funcs = []
+        for chunk_data in _get_chunk_data_args(args, kw["regime"], N, batch_size):
+
+            def chunk_func(theta, chunk_data=chunk_data):
+                return func(model, theta, *chunk_data, **kw)
+
+            chunk_funcs.append(chunk_func)
+        return _evaluate_in_chunks(theta, chunk_funcs)
+
+    return wrapper
+
+
+def _get_chunk_data_args(args, regime, N, batch_size):
+    """Get the data arguments of a measure function, i.e. the
+    positional arguments after model and theta, for each chunk of
+    batch_size rows. If the model has a prediction cache, the chunks
+    are kept there, so that the primary objective and the base nodes
+    evaluated in chunks on the same data get the same chunk objects
+    and share the predictions made on them.
+
+    :param args: The positional arguments for the full data,
+        i.e. [model, theta, features, labels] or [model, theta, data]
+    :type args: list
+    :param regime: The category of the machine learning algorithm
+    :type regime: str
+    :param N: The total number of datapoints
+    :type N: int
+    :param batch_size: The size of each chunk
+    :type batch_size: int
+
+    :return: List of the data arguments of each chunk
+    :rtype: list(list)
+    """
+
+    def make_chunks():
+        return [
+            _slice_data_args(args, regime, batch_start, batch_start + batch_size)[2:]
+            for batch_start in range(0, N, batch_size)
+        ]
+
+    prediction_cache = getattr(args[0], "prediction_cache", None)
+    if prediction_cache is None:
+        return make_chunks()
+    return prediction_cache.get_chunks(args[2:], batch_size, make_chunks)
+
+
 def _setup_params_for_stat_funcs(model, theta, data_dict, **kwargs):
     """Set up args,kwargs to pass to the
     zhat functions.
@@ -155,6 +286,15 @@ def sample_from_statistic(model, statistic_name, theta, data_dict, **kwargs):
         msr_func = measure_function_vector_mapper[statistic_name]
 
     if branch == "candidate_selection":
+        batch_size_candidate_eval = kwargs.get("batch_size_candidate_eval")
+        if (
+            batch_size_candidate_eval is not None
+            and batch_size_candidate_eval < num_datapoints
+            and regime != "reinforcement_learning"
+        ):
+            return chunked_evaluator(
+                msr_func, N=num_datapoints, batch_size=batch_size_candidate_eval,
+            )(*args, **msr_func_kwargs)
         return msr_func(*args, **msr_func_kwargs)
 
     elif branch == "safety_test":
@@ -177,6 +317,52 @@ def sample_from_statistic(model, statistic_name, theta, data_dict, **kwargs):
         )(*args, **msr_func_kwargs)
 
 
+def moments_from_statistic(model, statistic_name, theta, data_dict, **kwargs):
+    """Calculate the sufficient statistics (n, mean, M2) of a statistical
+    function over the sample without keeping the whole vector of
+    observations. The data are passed through the model in chunks of
+    batch_size_safety and the moments of the chunks are merged,
+    so only one chunk of observations is held in memory at a time.
+    Only for the supervised learning and custom regimes.
+
+    :param model: SeldonianModel instance
+    :param statistic_name: The name of the statistic to evaluate,
+        e.g. 'FPR' for false positive rate
+    :type statistic_name: str
+    :param theta: The model weights
+    :type theta: numpy ndarray
+    :param data_dict: Contains the features and labels
+    :type data_dict: dict
+
+    :return: (n, mean, M2) of the statistic over the sample
+    :rtype: tuple
+    """
+    regime = kwargs["regime"]
+    (args, msr_func_kwargs, num_datapoints) = _setup_params_for_stat_funcs(
+        model=model, theta=theta, data_dict=data_dict, **kwargs
+    )
+
+    if regime == "custom":
+        msr_func = kwargs["custom_measure_functions"][statistic_name]
+    else:
+        msr_func = measure_function_vector_mapper[statistic_name]
+
+    batch_size = kwargs.get("batch_size_safety") or max(num_datapoints, 1)
+    prediction_cache = getattr(model, "prediction_cache", None)
+    moments = (0, 0.0, 0.0)
+    for batch_start in range(0, num_datapoints, batch_size):
+        batch_args = _slice_data_args(
+            args, regime, batch_start, batch_start + batch_size
+        )
+        moments = merge_moments(
+            moments, sample_moments(msr_func(*batch_args, **msr_func_kwargs))
+        )
+        if prediction_cache is not None:
+            # Don't keep the predictions of every chunk alive
+            prediction_cache.reset()
+    return moments
+
+
 def evaluate_statistic(model, statistic_name, theta, data_dict, **kwargs):
     """Evaluate the mean of a statistical function over the whole sample provided.
 
@@ -248,8 +434,8 @@ def vector_Squared_Error(model, theta, X, Y, **kwargs):
     :return: vector of squared error values
     :rtype: numpy ndarray(float)
     """
-    prediction = model.predict(theta, X)
-    return pow(prediction - Y, 2)
+    prediction = cached_predict(model, theta, X)
+    return pow(prediction - as_array_like(Y, prediction), 2)
 
 
 def vector_Error(model, theta, X, Y, **kwargs):
@@ -267,8 +453,8 @@ def vector_Error(model, theta, X, Y, **kwargs):
     :return: vector of error values
     :rtype: numpy ndarray(float)
     """
-    prediction = model.predict(theta, X)
-    return prediction - Y
+    prediction = cached_predict(model, theta, X)
+    return prediction - as_array_like(Y, prediction)
 
 
 """ Classification zhat functions """
@@ -316,7 +502,7 @@ def _vector_Positive_Rate_binary(model, theta, X, Y, **kwargs):
     :return: Positive rate for each observation
     :rtype: numpy ndarray(float between 0 and 1)
     """
-    prediction = model.predict(theta, X)
+    prediction = cached_predict(model, theta, X)
     return prediction
 
 
@@ -339,7 +525,7 @@ def _vector_Positive_Rate_multiclass(model, theta, X, Y, class_index, **kwargs):
     :return: Positive rate for each observation
     :rtype: numpy ndarray(float between 0 and 1)
     """
-    prediction = model.predict(theta, X)
+    prediction = cached_predict(model, theta, X)
     return prediction[:, class_index]
 
 
@@ -385,7 +571,7 @@ def _vector_Negative_Rate_binary(model, theta, X, Y, **kwargs):
     :return: Negative rate for each observation
     :rtype: numpy ndarray(float between 0 and 1)
     """
-    prediction = model.predict(theta, X)
+    prediction = cached_predict(model, theta, X)
     return 1.0 - prediction
 
 
@@ -408,7 +594,7 @@ def _vector_Negative_Rate_multiclass(model, theta, X, Y, class_index, **kwargs):
     :return: Negative rate for each observation
     :rtype: numpy ndarray(float between 0 and 1)
     """
-    prediction = model.predict(theta, X)
+    prediction = cached_predict(model, theta, X)
     return 1.0 - prediction[:, class_index]
 
 
@@ -454,7 +640,7 @@ def _vector_False_Positive_Rate_binary(model, theta, X, Y, **kwargs):
     :return: False positive rate for each observation
     :rtype: numpy ndarray(float between 0 and 1)
     """
-    prediction = model.predict(theta, X)
+    prediction = cached_predict(model, theta, X)
     neg_mask = Y != 1.0  # this includes false positives and true negatives
     return prediction[neg_mask]
 
@@ -478,7 +664,7 @@ def _vector_False_Positive_Rate_multiclass(model, theta, X, Y, class_index, **kw
     :return: False positive rate for each observation
     :rtype: numpy ndarray(float between 0 and 1)
     """
-    prediction = model.predict(theta, X)
+    prediction = cached_predict(model, theta, X)
     other_mask = Y != class_index
     return prediction[:, class_index][other_mask]
 
@@ -525,7 +711,7 @@ def _vector_False_Negative_Rate_binary(model, theta, X, Y, **kwargs):
     :return: False negative rate for each observation
     :rtype: numpy ndarray(float between 0 and 1)
     """
-    prediction = model.predict(theta, X)
+    prediction = cached_predict(model, theta, X)
     pos_mask = Y == 1.0  # this includes false positives and true negatives
     return 1.0 - prediction[pos_mask]
 
@@ -549,7 +735,7 @@ def _vector_False_Negative_Rate_multiclass(model, theta, X, Y, class_index, **kw
     :return: False negative rate for each observation
     :rtype: numpy ndarray(float between 0 and 1)
     """
-    prediction = model.predict(theta, X)
+    prediction = cached_predict(model, theta, X)
     pos_mask = Y == class_index  # this includes false positives and true negatives
     return (1.0 - prediction[:, class_index])[pos_mask]
 
@@ -596,7 +782,7 @@ def _vector_True_Positive_Rate_binary(model, theta, X, Y, **kwargs):
     :return: True positive rate for each observation
     :rtype: numpy ndarray(float between 0 and 1)
     """
-    prediction = model.predict(theta, X)
+    prediction = cached_predict(model, theta, X)
     pos_mask = Y == 1.0  # this includes false positives and true negatives
     return prediction[pos_mask]
 
@@ -620,7 +806,7 @@ def _vector_True_Positive_Rate_multiclass(model, theta, X, Y, class_index, **kwa
     :return: True positive rate for each observation
     :rtype: numpy ndarray(float between 0 and 1)
     """
-    prediction = model.predict(theta, X)
+    prediction = cached_predict(model, theta, X)
     pos_mask = Y == class_index  # this includes false positives and true negatives
     return (prediction[:, class_index])[pos_mask]
 
@@ -667,7 +853,7 @@ def _vector_True_Negative_Rate_binary(model, theta, X, Y, **kwargs):
     :return: True negative rate for each observation
     :rtype: numpy ndarray(float between 0 and 1)
     """
-    prediction = model.predict(theta, X)
+    prediction = cached_predict(model, theta, X)
     neg_mask = Y != 1.0
     return 1.0 - prediction[neg_mask]
 
@@ -691,7 +877,7 @@ def _vector_True_Negative_Rate_multiclass(model, theta, X, Y, class_index, **kwa
     :return: True negative rate for each observation
     :rtype: numpy ndarray(float between 0 and 1)
     """
-    prediction = model.predict(theta, X)
+    prediction = cached_predict(model, theta, X)
     neg_mask = Y != class_index
     return (1.0 - prediction[:, class_index])[neg_mask]
 
@@ -736,10 +922,11 @@ def _vector_Error_Rate_binary(model, theta, X, Y, **kwargs):
     :return: Error rate for each observation
     :rtype: numpy ndarray(float between 0 and 1)
     """
-    Y_pred_probs = model.predict(theta, X)
+    Y_pred_probs = cached_predict(model, theta, X)
     # Get probabilities of true positives and true negatives
     # Use the vector Y_pred as it already has the true positive
     # probs. Just need to replace the probabilites in the neg mask with 1-prob
+    Y = as_array_like(Y, Y_pred_probs)
     return Y * (1 - Y_pred_probs) + (1 - Y) * Y_pred_probs
 
 
@@ -761,7 +948,7 @@ def _vector_Error_Rate_multiclass(model, theta, X, Y, **kwargs):
     :rtype: numpy ndarray(float between 0 and 1)
     """
     n = len(X)
-    Y_pred_probs = model.predict(theta, X)
+    Y_pred_probs = cached_predict(model, theta, X)
     return 1.0 - Y_pred_probs[np.arange(n), Y]
 
 
@@ -805,7 +992,8 @@ def _vector_Accuracy_binary(model, theta, X, Y, **kwargs):
     :return: Accuracy for each observation
     :rtype: numpy ndarray(float between 0 and 1)
     """
-    Y_pred_probs = model.predict(theta, X)
+    Y_pred_probs = cached_predict(model, theta, X)
+    Y = as_array_like(Y, Y_pred_probs)
     return Y * Y_pred_probs + (1 - Y) * (1 - Y_pred_probs)
 
 
@@ -827,7 +1015,7 @@ def _vector_Accuracy_multiclass(model, theta, X, Y, **kwargs):
     :rtype: numpy ndarray(float between 0 and 1)
     """
     n = len(X)
-    Y_pred_probs = model.predict(theta, X)
+    Y_pred_probs = cached_predict(model, theta, X)
     return Y_pred_probs[np.arange(n), Y]
 
 
@@ -857,7 +1045,7 @@ def vector_confusion_matrix(model, theta, X, Y, l_i, l_k, **kwargs):
     :return: C[l_i,l_k] for each observation
     :rtype: numpy ndarray(float between 0 and 1)
     """
-    Y_pred = model.predict(theta, X)  # i x k
+    Y_pred = cached_predict(model, theta, X)  # i x k
     true_mask = Y == l_i  # length i
 
     N_mask = sum(true_mask)
@@ -882,16 +1070,10 @@ def vector_IS_estimate(model, theta, episodes, weighted_returns, **kwargs):
     :return: A vector of IS estimates calculated for each episode
     :rtype: numpy ndarray(float)
     """
-
-    result = []
-    for ii, ep in enumerate(episodes):
-        pi_news = model.get_probs_from_observations_and_actions(
-            theta, ep.observations, ep.actions, ep.action_probs
-        )
-        pi_ratio_prod = np.prod(pi_news / ep.action_probs)
-        result.append(pi_ratio_prod * weighted_returns[ii])
-
-    return np.array(result)
+    episode_columns = EpisodeColumns.from_episodes(episodes)
+    # rho_i * G_i, calculated in log space so the products don't overflow
+    log_rhos = get_log_importance_weights(model, theta, episode_columns)
+    return exp_weighted(log_rhos, weighted_returns)
 
 
 def vector_PDIS_estimate(model, theta, episodes, weighted_returns, **kwargs):
@@ -910,20 +1092,19 @@ def vector_PDIS_estimate(model, theta, episodes, weighted_returns, **kwargs):
     """
 
     gamma = model.env_kwargs["gamma"] if "gamma" in model.env_kwargs else 1.0
-    PDIS_vector = []
-    for ep in episodes:
-        discount = np.power(gamma, range(len(ep.rewards)))
-        pi_news = model.get_probs_from_observations_and_actions(
-            theta, ep.observations, ep.actions, ep.action_probs
-        )
-        pi_ratios = pi_news / ep.action_probs
-
-        # autograd doesn't support np.cumprod
-        pi_ratio_prods = custom_cumprod(pi_ratios)
-
-        PDIS_vector.append(np.sum(pi_ratio_prods * discount * ep.rewards))
-
-    return np.array(PDIS_vector)
+    episode_columns = EpisodeColumns.from_episodes(episodes)
+    timesteps = episode_columns.timesteps
+    discount = episode_columns.get_discounts(gamma)
+    log_ratios = get_log_importance_ratios(model, theta, episode_columns)
+    log_pi_ratio_prods = segment_cumsum(log_ratios, timesteps)
+
+    # Weighted, discounted rewards, calculated in log space
+    # so the products don't overflow
+    return segment_sum(
+        exp_weighted(log_pi_ratio_prods, discount * episode_columns.rewards),
+        episode_columns.episode_ids,
+        len(episode_columns),
+    )
 
 
 def vector_WIS_estimate(model, theta, episodes, weighted_returns, **kwargs):
@@ -941,17 +1122,12 @@ def vector_WIS_estimate(model, theta, episodes, weighted_returns, **kwargs):
         such that the mean of this vector will be the WIS estimate.
     :rtype: numpy ndarray(float)
     """
-    gamma = model.env_kwargs["gamma"] if "gamma" in model.env_kwargs else 1.0
-    n = len(episodes)
-    rho_array = []
-    for ii, ep in enumerate(episodes):
-        # Get pi_new for each timestep in this ep
-        pi_news = model.get_probs_from_observations_and_actions(
-            theta, ep.observations, ep.actions, ep.action_probs
-        )
-        rho_array.append(np.prod(pi_news / ep.action_probs))
-    rho_array = np.array(rho_array)
-    WIS_vector = n * rho_array * weighted_returns / np.sum(rho_array)
+    episode_columns = EpisodeColumns.from_episodes(episodes)
+    n = len(episode_columns)
+    # rho_i/rhosum, calculated in log space so the products don't overflow
+    log_rhos = get_log_importance_weights(model, theta, episode_columns)
+    normalized_rhos = np.exp(log_rhos - logsumexp(log_rhos))
+    WIS_vector = n * normalized_rhos * weighted_returns
     return WIS_vector
 
 
@@ -988,6 +1164,7 @@ measure_function_vector_mapper = {
     "TPR": vector_True_Positive_Rate,
     "TNR": vector_True_Negative_Rate,
     "ACC": vector_Accuracy,
+    "CM": vector_confusion_matrix,
     "J_pi_new_IS": vector_IS_estimate,
     "J_pi_new_PDIS": vector_PDIS_estimate,
     "J_pi_new_WIS": vector_WIS_estimate,
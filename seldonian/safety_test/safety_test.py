@@ -2,6 +2,29 @@
 
 import autograd.numpy as np  # Thinly-wrapped version of Numpy
 import copy
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from seldonian.parse_tree.base_node_registry import BaseNodeRegistry
+from seldonian.parse_tree.nodes import BaseNode
+from seldonian.models.objectives import get_log_importance_weights
+
+# Base node evaluations for the worker processes of the parallel
+# safety test. Set before the workers are forked so that they
+# inherit the model and data instead of receiving pickled copies.
+_parallel_tasks = []
+
+
+def _run_parallel_task(task_index):
+    """Evaluate one base node in a worker process
+
+    :param task_index: Index into _parallel_tasks
+    :type task_index: int
+
+    :return: The zhat vector or its moments
+    """
+    method_name, node, node_kwargs = _parallel_tasks[task_index]
+    return getattr(node, method_name)(**node_kwargs)
 
 
 class SafetyTest(object):
@@ -42,8 +65,17 @@ class SafetyTest(object):
         self.additional_datasets = additional_datasets
 
         self.st_result = {}  # stores parse tree evaluated on safety test data
+        # Shares zhats of identical base nodes across parse trees
+        self.base_node_registry = BaseNodeRegistry()
 
-    def run(self, solution, batch_size_safety=None, **kwargs):
+    def run(
+        self,
+        solution,
+        batch_size_safety=None,
+        n_workers=1,
+        parallel_backend="thread",
+        **kwargs
+    ):
         """Loop over parse trees, calculate the bounds on leaf nodes
         and propagate to the root node. The safety test passes if
         the upper bounds of all parse tree root nodes are less than or equal to 0.
@@ -56,11 +88,28 @@ class SafetyTest(object):
                 to pass through the model in a single forward pass
         :type batch_size_safety: int
 
+        :param n_workers: The number of workers used to evaluate
+                the base nodes of all parse trees in parallel.
+                See :py:meth:`evaluate_base_nodes_parallel`
+        :type n_workers: int, defaults to 1
+
+        :param parallel_backend: "thread" or "process"
+        :type parallel_backend: str, defaults to "thread"
+
         :return: passed, whether the candidate solution passed the safety test
         :rtype: bool
         """
+        if n_workers < 1:
+            raise ValueError(f"n_workers value of {n_workers} must be >=1")
+        if parallel_backend not in ["thread", "process"]:
+            raise NotImplementedError(
+                f"parallel_backend: {parallel_backend} not supported"
+            )
+
         passed = True
+        self.base_node_registry.reset(solution)
 
+        tree_bounds_kwargs = []
         for tree_i, pt in enumerate(self.parse_trees):
             # before we propagate reset the tree
             pt.reset_base_node_dict()
@@ -82,20 +131,125 @@ class SafetyTest(object):
                 regime=self.regime,
                 batch_size_safety=batch_size_safety,
                 sub_regime=self.safety_dataset.meta.sub_regime,
+                base_node_registry=self.base_node_registry,
                 **kwargs
             )
+            tree_bounds_kwargs.append(bounds_kwargs)
+
+        if n_workers > 1:
+            self.evaluate_base_nodes_parallel(
+                tree_bounds_kwargs, n_workers=n_workers, parallel_backend=parallel_backend
+            )
 
+        for pt, bounds_kwargs in zip(self.parse_trees, tree_bounds_kwargs):
+            # Base nodes evaluated in parallel are found in the registry
             pt.propagate_bounds(**bounds_kwargs)
             # Check if the i-th behavioral constraint is satisfied
             upperBound = pt.root.upper
-            self.st_result[pt.constraint_str] = copy.deepcopy(pt)
+            self.st_result[pt.constraint_str] = self.snapshot_parse_tree(pt)
             if (
                 upperBound > 0.0
             ):  # If the current constraint was not satisfied, the safety test failed
                 passed = False
 
+        self.base_node_registry.reset()
         return passed
 
+    def evaluate_base_nodes_parallel(
+        self, tree_bounds_kwargs, n_workers, parallel_backend="thread"
+    ):
+        """Evaluate the zhat vectors (or their moments, see
+        :py:meth:`.BaseNode.use_streaming_bounds`) of the unique base
+        nodes across all parse trees in parallel and store them in the
+        base node registry, so that propagating the bounds afterwards
+        only has to calculate the bounds themselves.
+        Base nodes with custom calculate_bounds methods and
+        manual or random bounds are left to the parse trees.
+
+        The "thread" backend suits models whose forward pass releases
+        the GIL (e.g. PyTorch or TensorFlow models) and is thread-safe.
+        The "process" backend forks one worker process per worker,
+        which inherit the model and the data. Only available where
+        the fork start method is.
+
+        :param tree_bounds_kwargs: The keyword arguments
+            for propagate_bounds() of each parse tree
+        :type tree_bounds_kwargs: List(dict)
+        :param n_workers: The number of threads or processes
+        :type n_workers: int
+        :param parallel_backend: "thread" or "process"
+        :type parallel_backend: str, defaults to "thread"
+        """
+        global _parallel_tasks
+        tasks = []
+        task_keys = set()
+        for pt, bounds_kwargs in zip(self.parse_trees, tree_bounds_kwargs):
+            for node in pt.get_unique_base_nodes():
+                node_kwargs = pt.get_base_node_kwargs(node, **bounds_kwargs)
+                if type(node).calculate_bounds is not BaseNode.calculate_bounds or (
+                    node_kwargs["bound_method"] in ["manual", "random"]
+                ):
+                    continue
+                moments = node.use_streaming_bounds(**node_kwargs)
+                key, _ = self.base_node_registry.get_key(
+                    node, moments=moments, **node_kwargs
+                )
+                if key in task_keys:
+                    continue
+                task_keys.add(key)
+                method_name = "zhat_moments" if moments else "zhat"
+                tasks.append((method_name, node, node_kwargs, moments))
+
+        # The prediction cache is not thread-safe and would
+        # not be shared between processes anyway
+        prediction_cache = getattr(self.model, "prediction_cache", None)
+        self.model.prediction_cache = None
+        try:
+            if parallel_backend == "thread":
+                with ThreadPoolExecutor(max_workers=n_workers) as ex:
+                    results = list(
+                        ex.map(
+                            lambda task: getattr(task[1], task[0])(**task[2]), tasks
+                        )
+                    )
+            elif parallel_backend == "process":
+                _parallel_tasks = [task[:3] for task in tasks]
+                with ProcessPoolExecutor(
+                    max_workers=n_workers, mp_context=mp.get_context("fork")
+                ) as ex:
+                    results = list(ex.map(_run_parallel_task, range(len(tasks))))
+            else:
+                raise NotImplementedError(
+                    f"parallel_backend: {parallel_backend} not supported"
+                )
+        finally:
+            _parallel_tasks = []
+            self.model.prediction_cache = prediction_cache
+
+        for (_, node, node_kwargs, moments), result in zip(tasks, results):
+            self.base_node_registry.set_zhat(
+                node, result, moments=moments, **node_kwargs
+            )
+
+    def snapshot_parse_tree(self, pt):
+        """Copy a parse tree after bounding it so the bounds can be
+        inspected after the next run. The data prepared for its
+        base nodes (which can be as large as the safety dataset)
+        is shared with the original tree rather than copied.
+
+        :param pt: The parse tree
+        :type pt: :py:class:`.ParseTree` object
+
+        :return: A copy of the parse tree
+        :rtype: :py:class:`.ParseTree` object
+        """
+        memo = {}
+        for node_dict in pt.base_node_dict.values():
+            for key in ["data_dict", "data_source"]:
+                if node_dict.get(key) is not None:
+                    memo[id(node_dict[key])] = node_dict[key]
+        return copy.deepcopy(pt, memo)
+
     def evaluate_primary_objective(self, theta, primary_objective):
         """Get value of the primary objective given model weights
         theta, and the safety data, D_s. This is a wrapper for primary_objective where
@@ -127,8 +281,10 @@ class SafetyTest(object):
             result = -1.0 * primary_objective(
                 model=self.model,
                 theta=theta,
-                episodes=self.safety_dataset.episodes,
-                weighted_returns=None,
+                episodes=self.safety_dataset.get_episode_columns(),
+                weighted_returns=self.safety_dataset.get_discounted_returns(
+                    self.model.env_kwargs.get("gamma", 1.0)
+                ),
             )
 
             if hasattr(self, "reg_coef"):
@@ -143,23 +299,23 @@ class SafetyTest(object):
             result = primary_objective(self.model, theta, self.safety_dataset.data,)
             return result
 
-    def get_importance_weights(self, theta):
+    def get_importance_weights(self, theta, log=False):
         """Get an array of importance weights given model weights, theta,
         and the safety data, D_s. Only relevant for RL.
 
         :param theta: model weights
         :type theta: numpy.ndarray
+        :param log: Whether to return the log of the importance weights,
+                which does not overflow for long episodes
+        :type log: bool
 
         :return: The importance weights 
         :rtype: numpy.ndarray
         """
         assert self.regime == "reinforcement_learning"
-        rho_is = []
-
-        for ii, ep in enumerate(self.safety_dataset.episodes):
-            pi_news = self.model.get_probs_from_observations_and_actions(
-                theta, ep.observations, ep.actions, ep.action_probs
-            )
-            rho_is.append(np.prod(pi_news / ep.action_probs))
-
-        return np.array(rho_is)
+        log_rho_is = get_log_importance_weights(
+            self.model, theta, self.safety_dataset.get_episode_columns()
+        )
+        if log:
+            return log_rho_is
+        return np.exp(log_rho_is)
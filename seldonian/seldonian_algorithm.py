@@ -615,6 +615,8 @@ class SeldonianAlgorithm:
         passed_safety, solution = self.run_safety_test(
             candidate_solution=candidate_solution,
             batch_size_safety=batch_size_safety,
+            n_workers=getattr(self.spec, "n_workers_safety", 1),
+            parallel_backend=getattr(self.spec, "safety_parallel_backend", "thread"),
             debug=debug,
         )
 
@@ -644,6 +646,9 @@ class SeldonianAlgorithm:
             **self.spec.optimization_hyperparams,
             use_builtin_primary_gradient_fn=self.spec.use_builtin_primary_gradient_fn,
             custom_primary_gradient_fn=self.spec.custom_primary_gradient_fn,
+            custom_primary_value_and_gradient_fn=getattr(
+                self.spec, "custom_primary_value_and_gradient_fn", None
+            ),
             debug=debug,
         )
 
@@ -651,13 +656,25 @@ class SeldonianAlgorithm:
         self.cs_result = cs.optimization_result
         return candidate_solution
 
-    def run_safety_test(self, candidate_solution, batch_size_safety=None, debug=False):
+    def run_safety_test(
+        self,
+        candidate_solution,
+        batch_size_safety=None,
+        debug=False,
+        n_workers=1,
+        parallel_backend="thread",
+    ):
         """
         Runs safety test using solution from candidate selection.
 
         :param candidate_solution: model weights from candidate selection
                 or other process
+        :param batch_size_safety: The number of datapoints
+                to pass through the model in a single forward pass
         :param debug: Whether to print out debugging info
+        :param n_workers: The number of workers used to evaluate
+                the base nodes in parallel
+        :param parallel_backend: "thread" or "process"
         :return: (passed_safety, solution). passed_safety
                 indicates whether solution found during candidate selection
                 passed the safety test. solution is the optimized
@@ -666,7 +683,12 @@ class SeldonianAlgorithm:
         """
 
         st = self.safety_test()
-        passed_safety = st.run(candidate_solution, batch_size_safety=batch_size_safety)
+        passed_safety = st.run(
+            candidate_solution,
+            batch_size_safety=batch_size_safety,
+            n_workers=n_workers,
+            parallel_backend=parallel_backend,
+        )
         if not passed_safety:
             solution = "NSF"
         else:
@@ -737,7 +759,7 @@ class SeldonianAlgorithm:
             result = cs.evaluate_primary_objective(theta)
         return result
 
-    def get_importance_weights(self, branch, theta):
+    def get_importance_weights(self, branch, theta, log=False):
         """Get the importance weights from the model weights, theta,
         evaluated either on the candidate data or safety data.
 
@@ -745,6 +767,8 @@ class SeldonianAlgorithm:
         :type branch: str
         :param theta: model weights
         :type theta: numpy.ndarray
+        :param log: Whether to return the log of the importance weights
+        :type log: bool
         :return: an array of importance weights (floats) the same length as the number of
             episodes in the data (depending on which branch was chosen)
         """
@@ -754,10 +778,10 @@ class SeldonianAlgorithm:
 
         if branch == "safety_test":
             st = self.safety_test()
-            rho_is = st.get_importance_weights(theta=theta)
+            rho_is = st.get_importance_weights(theta=theta, log=log)
 
         elif branch == "candidate_selection":
             cs = self.candidate_selection()
-            rho_is = cs.get_importance_weights(theta=theta)
+            rho_is = cs.get_importance_weights(theta=theta, log=log)
 
         return rho_is
@@ -41,6 +41,11 @@ class Spec(object):
             the gradient of the primary objective. If None,
             falls back on builtin function or autograd
     :type custom_primary_gradient_fn: function, defaults to None
+    :param custom_primary_value_and_gradient_fn: A function returning
+            the primary objective and its gradient as a tuple from a
+            single evaluation. If provided, it is used instead of
+            custom_primary_gradient_fn, the builtin function or autograd
+    :type custom_primary_value_and_gradient_fn: function, defaults to None
     :param optimization_technique: The method for optimization during
             candidate selection. E.g. 'gradient_descent', 'barrier_function'
     :type optimization_technique: str, defaults to 'gradient_descent'
@@ -57,6 +62,12 @@ class Spec(object):
         through the model during the safety test. Value does not change result, 
         but sometimes is necessary when dataset is large to avoid memory overflow. 
     :type batch_size_safety: int, defaults to None
+    :param n_workers_safety: The number of workers used to evaluate
+        the base nodes of the parse trees in parallel during the safety test.
+    :type n_workers_safety: int, defaults to 1
+    :param safety_parallel_backend: Whether the safety test workers
+        are threads ("thread") or forked processes ("process")
+    :type safety_parallel_backend: str, defaults to "thread"
     :param candidate_dataset: An dataset to use explicitly for candidate selection.
         If provided, overrides the data splitting and dataset is not used. 
     :type candidate_dataset: :py:class:`.DataSet`, defaults to None
@@ -80,6 +91,7 @@ class Spec(object):
         base_node_bound_method_dict={},
         use_builtin_primary_gradient_fn=True,
         custom_primary_gradient_fn=None,
+        custom_primary_value_and_gradient_fn=None,
         optimization_technique="gradient_descent",
         optimizer="adam",
         optimization_hyperparams={
@@ -95,6 +107,8 @@ class Spec(object):
         },
         regularization_hyperparams={},
         batch_size_safety=None,
+        n_workers_safety=1,
+        safety_parallel_backend="thread",
         candidate_dataset=None,
         safety_dataset=None,
         additional_datasets={},
@@ -109,6 +123,9 @@ class Spec(object):
         self.initial_solution_fn = initial_solution_fn
         self.use_builtin_primary_gradient_fn = use_builtin_primary_gradient_fn
         self.custom_primary_gradient_fn = custom_primary_gradient_fn
+        self.custom_primary_value_and_gradient_fn = (
+            custom_primary_value_and_gradient_fn
+        )
         self.parse_trees = self.validate_parse_trees(parse_trees)
         self.base_node_bound_method_dict = base_node_bound_method_dict
         self.optimization_technique = optimization_technique
@@ -116,6 +133,8 @@ class Spec(object):
         self.optimization_hyperparams = optimization_hyperparams
         self.regularization_hyperparams = regularization_hyperparams
         self.batch_size_safety = batch_size_safety
+        self.n_workers_safety = n_workers_safety
+        self.safety_parallel_backend = safety_parallel_backend
 
         # Deal with custom datasets
         self.candidate_dataset, self.safety_dataset = self.validate_custom_datasets(
@@ -298,6 +317,11 @@ class SupervisedSpec(Spec):
             the gradient of the primary objective. If None,
             falls back on builtin function or autograd
     :type custom_primary_gradient_fn: function, defaults to None
+    :param custom_primary_value_and_gradient_fn: A function returning
+            the primary objective and its gradient as a tuple from a
+            single evaluation. If provided, it is used instead of
+            custom_primary_gradient_fn, the builtin function or autograd
+    :type custom_primary_value_and_gradient_fn: function, defaults to None
     :param optimization_technique: The method for optimization during
             candidate selection. E.g. 'gradient_descent', 'barrier_function'
     :type optimization_technique: str, defaults to 'gradient_descent'
@@ -314,6 +338,12 @@ class SupervisedSpec(Spec):
         through the model during the safety test. Value does not change result, 
         but sometimes is necessary when dataset is large to avoid memory overflow. 
     :type batch_size_safety: int, defaults to None
+    :param n_workers_safety: The number of workers used to evaluate
+        the base nodes of the parse trees in parallel during the safety test.
+    :type n_workers_safety: int, defaults to 1
+    :param safety_parallel_backend: Whether the safety test workers
+        are threads ("thread") or forked processes ("process")
+    :type safety_parallel_backend: str, defaults to "thread"
     :param candidate_dataset: An dataset to use explicitly for candidate selection.
         If provided, overrides the data splitting and dataset is not used. 
     :type candidate_dataset: :py:class:`.DataSet`, defaults to None
@@ -338,6 +368,7 @@ class SupervisedSpec(Spec):
         base_node_bound_method_dict={},
         use_builtin_primary_gradient_fn=True,
         custom_primary_gradient_fn=None,
+        custom_primary_value_and_gradient_fn=None,
         optimization_technique="gradient_descent",
         optimizer="adam",
         optimization_hyperparams={
@@ -354,6 +385,8 @@ class SupervisedSpec(Spec):
         },
         regularization_hyperparams={},
         batch_size_safety=None,
+        n_workers_safety=1,
+        safety_parallel_backend="thread",
         candidate_dataset=None,
         additional_datasets={},
         safety_dataset=None,
@@ -369,11 +402,14 @@ class SupervisedSpec(Spec):
             base_node_bound_method_dict=base_node_bound_method_dict,
             use_builtin_primary_gradient_fn=use_builtin_primary_gradient_fn,
             custom_primary_gradient_fn=custom_primary_gradient_fn,
+            custom_primary_value_and_gradient_fn=custom_primary_value_and_gradient_fn,
             optimization_technique=optimization_technique,
             optimizer=optimizer,
             optimization_hyperparams=optimization_hyperparams,
             regularization_hyperparams=regularization_hyperparams,
             batch_size_safety=batch_size_safety,
+            n_workers_safety=n_workers_safety,
+            safety_parallel_backend=safety_parallel_backend,
             candidate_dataset=candidate_dataset,
             safety_dataset=safety_dataset,
             additional_datasets=additional_datasets,
@@ -420,6 +456,11 @@ class RLSpec(Spec):
             the gradient of the primary objective. If None,
             falls back on builtin function or autograd
     :type custom_primary_gradient_fn: function, defaults to None
+    :param custom_primary_value_and_gradient_fn: A function returning
+            the primary objective and its gradient as a tuple from a
+            single evaluation. If provided, it is used instead of
+            custom_primary_gradient_fn, the builtin function or autograd
+    :type custom_primary_value_and_gradient_fn: function, defaults to None
 
     :param optimization_technique: The method for optimization during
             candidate selection. E.g. 'gradient_descent', 'barrier_function'
@@ -442,6 +483,12 @@ class RLSpec(Spec):
         through the model during the safety test. Value does not change result, 
         but sometimes is necessary when dataset is large to avoid memory overflow. 
     :type batch_size_safety: int, defaults to None
+    :param n_workers_safety: The number of workers used to evaluate
+        the base nodes of the parse trees in parallel during the safety test.
+    :type n_workers_safety: int, defaults to 1
+    :param safety_parallel_backend: Whether the safety test workers
+        are threads ("thread") or forked processes ("process")
+    :type safety_parallel_backend: str, defaults to "thread"
     :param candidate_dataset: An dataset to use explicitly for candidate selection.
         If provided, overrides the data splitting and dataset is not used. 
     :type candidate_dataset: :py:class:`.DataSet`, defaults to None
@@ -465,6 +512,7 @@ class RLSpec(Spec):
         base_node_bound_method_dict={},
         use_builtin_primary_gradient_fn=True,
         custom_primary_gradient_fn=None,
+        custom_primary_value_and_gradient_fn=None,
         optimization_technique="gradient_descent",
         optimizer="adam",
         optimization_hyperparams={
@@ -481,6 +529,8 @@ class RLSpec(Spec):
         },
         regularization_hyperparams={},
         batch_size_safety=None,
+        n_workers_safety=1,
+        safety_parallel_backend="thread",
         candidate_dataset=None,
         safety_dataset=None,
         additional_datasets={},
@@ -496,11 +546,14 @@ class RLSpec(Spec):
             base_node_bound_method_dict=base_node_bound_method_dict,
             use_builtin_primary_gradient_fn=use_builtin_primary_gradient_fn,
             custom_primary_gradient_fn=custom_primary_gradient_fn,
+            custom_primary_value_and_gradient_fn=custom_primary_value_and_gradient_fn,
             optimization_technique=optimization_technique,
             optimizer=optimizer,
             optimization_hyperparams=optimization_hyperparams,
             regularization_hyperparams=regularization_hyperparams,
             batch_size_safety=batch_size_safety,
+            n_workers_safety=n_workers_safety,
+            safety_parallel_backend=safety_parallel_backend,
             candidate_dataset=candidate_dataset,
             safety_dataset=safety_dataset,
             additional_datasets=additional_datasets,
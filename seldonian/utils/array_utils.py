@@ -0,0 +1,69 @@
+""" Helpers for functions that accept either numpy arrays,
+which autograd may trace, or PyTorch tensors, which the "torch"
+gradient library passes through candidate selection so that the model
+weights, predictions, zhat vectors and confidence bounds stay tensors
+from end to end. PyTorch is optional, so it is never imported here. """
+
+import sys
+
+import autograd.numpy as np  # Thinly-wrapped version of Numpy
+
+
+def is_tensor(x):
+    """Whether x is a PyTorch tensor
+
+    :param x: The object to check
+    :rtype: bool
+    """
+    torch = sys.modules.get("torch")
+    return torch is not None and isinstance(x, torch.Tensor)
+
+
+def array_namespace(x):
+    """Get the module whose functions, e.g. exp, log, sign and isnan,
+    operate on x: torch for a PyTorch tensor and autograd.numpy otherwise
+
+    :param x: An array, tensor or number
+    :return: torch or autograd.numpy
+    """
+    if is_tensor(x):
+        return sys.modules["torch"]
+    return np
+
+
+def as_array_like(x, like):
+    """Convert x, e.g. the labels, to a tensor on the device of like
+    if like is a PyTorch tensor, so that the two can be combined
+    arithmetically. Otherwise x is returned unchanged.
+
+    :param x: The array to convert
+    :type x: numpy ndarray
+    :param like: An array or tensor, e.g. the predictions
+
+    :return: x as a tensor or the original x
+    """
+    if is_tensor(like):
+        return sys.modules["torch"].as_tensor(x, device=like.device)
+    return x
+
+
+def stack_values(values, like):
+    """Stack scalars, e.g. the upper bounds on the constraints,
+    into a vector of the same kind as like. Plain floats, such as
+    an infinite bound, can be mixed with tensors.
+
+    :param values: The scalars to stack
+    :type values: list
+    :param like: An array or tensor, e.g. the model weights
+
+    :return: A tensor of the dtype of like if like is a tensor,
+        otherwise a numpy array of floats
+    """
+    if is_tensor(like):
+        torch = sys.modules["torch"]
+        if len(values) == 0:
+            return like.new_zeros(0)
+        return torch.stack(
+            [torch.as_tensor(v, dtype=like.dtype, device=like.device) for v in values]
+        )
+    return np.array(values, dtype="float")
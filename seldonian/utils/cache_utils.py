@@ -0,0 +1,62 @@
+""" Module for caching values computed from large arrays """
+
+
+class ArrayCache(object):
+    def __init__(self, max_bytes=2**28):
+        """Caches values computed from arrays, e.g. features copied
+        to a device or transformed by a basis, keyed on the identity
+        of the array. Optimizers pass the same array on every step
+        for as long as the batch does not change, so the value
+        does not need to be computed again.
+
+        Entries are evicted oldest first once the cached values
+        take up more than max_bytes, and values larger than max_bytes
+        are not cached at all, so a stream of new arrays, e.g. the
+        slices of a batched evaluation, can never pin more than max_bytes.
+        Because entries are keyed on identity, an array
+        must not be modified in place while it is cached.
+
+        :param max_bytes: The maximum total size of the cached values
+        :type max_bytes: int, defaults to 256 MiB
+
+        :ivar entries: Maps id(array) to (array, value, nbytes).
+            The array is kept so that its id cannot be reused
+            while the entry is alive.
+        :vartype entries: dict
+        :ivar nbytes: The total size of the cached values
+        :vartype nbytes: int
+        """
+        self.max_bytes = max_bytes
+        self.entries = {}
+        self.nbytes = 0
+
+    def get(self, array, compute):
+        """Get compute(array), only calling compute
+        if the value for array is not cached
+
+        :param array: The array the value is computed from
+        :param compute: Function of array computing the value,
+            which must have an nbytes attribute, e.g. a numpy array
+            or torch tensor
+
+        :return: compute(array)
+        """
+        entry = self.entries.get(id(array))
+        if entry is not None:
+            return entry[1]
+
+        value = compute(array)
+        nbytes = value.nbytes
+        if nbytes <= self.max_bytes:
+            while self.nbytes + nbytes > self.max_bytes:
+                # Evict the oldest entry
+                oldest = self.entries.pop(next(iter(self.entries)))
+                self.nbytes -= oldest[2]
+            self.entries[id(array)] = (array, value, nbytes)
+            self.nbytes += nbytes
+        return value
+
+    def clear(self):
+        """Remove all cached values"""
+        self.entries = {}
+        self.nbytes = 0
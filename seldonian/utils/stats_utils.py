@@ -1,6 +1,10 @@
 import autograd.numpy as np  # Thinly-wrapped version of Numpy
+from autograd.extend import primitive, defvjp
+from autograd.scipy.special import logsumexp
 from scipy.stats import t
 
+from seldonian.utils.array_utils import is_tensor
+
 stability_const = 1e-15
 
 
@@ -10,13 +14,74 @@ def stddev(v):
     with Bessel's correction
 
     :param v: vector of data
-    :type v: Numpy ndarray
+    :type v: Numpy ndarray or torch.Tensor
     :return: Standard deviation with Bessel's correction
     :rtype: float
     """
+    if is_tensor(v):
+        return v.std(correction=1)
     return np.std(v, ddof=1)
 
 
+def sample_moments(v):
+    """
+    Sufficient statistics of the vector v for a t-test:
+    the number of samples, their mean and their sum of
+    squared deviations from the mean.
+
+    :param v: vector of data
+    :type v: Numpy ndarray
+    :return: (n, mean, M2)
+    :rtype: tuple
+    """
+    n = len(v)
+    if n == 0:
+        return 0, 0.0, 0.0
+    mean = np.mean(v)
+    return n, mean, np.sum((v - mean) ** 2)
+
+
+def merge_moments(moments_a, moments_b):
+    """
+    Combine the sufficient statistics of two samples
+    into those of their union (Chan et al.'s parallel
+    form of Welford's algorithm), so that the moments
+    of a large sample can be accumulated chunk by chunk
+    and in any order.
+
+    :param moments_a: (n, mean, M2) of the first sample
+    :type moments_a: tuple
+    :param moments_b: (n, mean, M2) of the second sample
+    :type moments_b: tuple
+    :return: (n, mean, M2) of the combined sample
+    :rtype: tuple
+    """
+    n_a, mean_a, M2_a = moments_a
+    n_b, mean_b, M2_b = moments_b
+    n = n_a + n_b
+    if n_a == 0 or n_b == 0:
+        return moments_b if n_a == 0 else moments_a
+    delta = mean_b - mean_a
+    mean = mean_a + delta * n_b / n
+    M2 = M2_a + M2_b + delta ** 2 * n_a * n_b / n
+    return n, mean, M2
+
+
+def stddev_from_moments(moments):
+    """
+    Sample standard deviation with Bessel's correction,
+    from the sufficient statistics of the sample.
+    Equivalent to :py:func:`stddev` on the sample itself.
+
+    :param moments: (n, mean, M2) of the sample
+    :type moments: tuple
+    :return: Standard deviation with Bessel's correction
+    :rtype: float
+    """
+    n, _, M2 = moments
+    return np.sqrt(M2 / (n - 1))
+
+
 def tinv(p, nu):
     """
     Returns the inverse of Student's t CDF
@@ -49,8 +114,147 @@ def weighted_sum_gamma(arr, gamma=0.9):
     :return: The weighted sum
     :rtype: float
     """
-    weights = np.power(gamma, range(len(arr)))
-    return np.average(arr, weights=weights) * np.sum(weights)
+    weights = np.power(gamma, np.arange(len(arr)))
+    return np.dot(weights, arr)
+
+
+def discounted_returns(rewards, episode_lengths, gamma=0.9):
+    """Calculate the discounted return of many episodes at once.
+    The rewards of all episodes are concatenated into a single
+    (ragged) array, so that every return is computed in one
+    vectorized pass instead of calling :py:func:`weighted_sum_gamma`
+    once per episode.
+
+    :param rewards: The rewards of all episodes, concatenated in
+        episode order. Either 1D, or 2D with one column per
+        reward function.
+    :type rewards: Numpy ndarray
+    :param episode_lengths: The number of timesteps in each episode
+    :type episode_lengths: Numpy ndarray(int)
+    :param gamma: The discount factor
+    :type gamma: float
+    :return: The discounted return of each episode, of shape
+        (n_episodes,) or (n_episodes, n_reward_columns)
+    :rtype: Numpy ndarray
+    """
+    rewards = np.asarray(rewards, dtype=float)
+    episode_lengths = np.asarray(episode_lengths, dtype=int)
+    n_episodes = len(episode_lengths)
+    episode_starts = np.cumsum(episode_lengths) - episode_lengths
+    # Timestep of each reward within its own episode
+    timesteps = np.arange(len(rewards)) - np.repeat(episode_starts, episode_lengths)
+    discount = np.power(gamma, timesteps)
+    episode_ids = np.repeat(np.arange(n_episodes), episode_lengths)
+    if rewards.ndim == 1:
+        return np.bincount(
+            episode_ids, weights=discount * rewards, minlength=n_episodes
+        )
+    return np.stack(
+        [
+            np.bincount(episode_ids, weights=discount * col, minlength=n_episodes)
+            for col in rewards.T
+        ],
+        axis=1,
+    )
+
+
+@primitive
+def segment_sum(values, segment_ids, n_segments):
+    """Sum the values belonging to each segment,
+    e.g. the per-timestep values of each episode.
+    Works with autograd.
+
+    :param values: The values to sum
+    :type values: numpy ndarray
+    :param segment_ids: The segment that each value belongs to
+    :type segment_ids: numpy ndarray(int)
+    :param n_segments: The total number of segments
+    :type n_segments: int
+    :return: The sum of each segment
+    :rtype: numpy ndarray(float)
+    """
+    return np.bincount(segment_ids, weights=values, minlength=n_segments)
+
+
+def segment_sum_vjp(ans, values, segment_ids, n_segments):
+    """Each value's gradient is the gradient
+    of the sum of the segment it belongs to"""
+    return lambda g: g[segment_ids]
+
+
+defvjp(segment_sum, segment_sum_vjp)
+
+
+def segment_cumsum(values, timesteps):
+    """Cumulative sum of the values restarting at the
+    beginning of each segment, e.g. each episode.
+    Uses log2(longest segment) vectorized passes
+    (a Hillis-Steele scan) that only ever add values from the same segment.
+    A single np.cumsum over all segments followed by subtracting each
+    segment's starting total would carry a -inf log-term (a zero
+    probability ratio) from one segment into every later one,
+    giving -inf - (-inf) = nan there, and loses precision
+    as the running total grows.
+
+    :param values: The values to sum, with the segments
+        stored one after another
+    :type values: numpy ndarray
+    :param timesteps: The position of each value within its segment
+    :type timesteps: numpy ndarray(int)
+    :return: The cumulative sums
+    :rtype: numpy ndarray(float)
+    """
+    result = values
+    max_timestep = np.max(timesteps) if len(timesteps) > 0 else 0
+    shift = 1
+    while shift <= max_timestep:
+        shifted = np.concatenate([np.zeros(shift), result[:-shift]])
+        result = result + np.where(timesteps >= shift, shifted, 0.0)
+        shift *= 2
+    return result
+
+
+def exp_weighted(log_weights, values):
+    """Elementwise exp(log_weights)*values, computed as
+    sign(values)*exp(log_weights + log|values|), so that a weight
+    too large for a float, e.g. the importance weight of a long episode,
+    does not overflow unless the product itself does.
+
+    :param log_weights: The logs of the weights
+    :type log_weights: numpy ndarray
+    :param values: The values to weight. Not differentiated.
+    :type values: numpy ndarray
+    :return: The weighted values
+    :rtype: numpy ndarray(float)
+    """
+    values = np.asarray(values, dtype=float)
+    # log|0| = -inf, which makes the product and its gradient exactly zero
+    with np.errstate(divide="ignore"):
+        log_abs_values = np.log(np.abs(values))
+    return np.sign(values) * np.exp(log_weights + log_abs_values)
+
+
+def exp_weighted_mean(log_weights, values):
+    """The mean of exp(log_weights)*values, computed with a logsumexp
+    over the positive and the negative values separately, so that it does
+    not overflow unless the mean itself does.
+
+    :param log_weights: The logs of the weights
+    :type log_weights: numpy ndarray
+    :param values: The values to weight. Not differentiated.
+    :type values: numpy ndarray
+    :return: The weighted mean
+    :rtype: float
+    """
+    values = np.asarray(values, dtype=float)
+    log_n = np.log(len(values))
+    result = 0.0
+    for sign in [1.0, -1.0]:
+        mask = sign * values > 0
+        if np.any(mask):
+            log_terms = log_weights[mask] + np.log(sign * values[mask])
+            result = result + sign * np.exp(logsumexp(log_terms) - log_n)
+    return result
 
 
 def softmax(x):
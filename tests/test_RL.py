@@ -1,3 +1,4 @@
+import pickle
 import pytest
 from seldonian.RL.Agents.Agent import Agent
 from seldonian.RL.Agents.Function_Approximators.Table import *
@@ -193,6 +194,96 @@ def test_MixedSoftmax():
     )
 
 
+def test_batched_policy_probs():
+    """The batched probabilities should match the per-observation ones"""
+    from autograd import grad
+
+    np.random.seed(0)
+    # Tabular Q Table with states that are not 0-indexed
+    observation_space = Discrete_Space(-2, 3)
+    action_space = Discrete_Space(-1, 1)
+    env_description = Env_Description(observation_space, action_space)
+    observations = np.random.randint(-2, 4, 50)
+    actions = np.random.randint(-1, 2, 50)
+    behavior_action_probs = np.random.uniform(0.1, 0.9, 50)
+
+    for sm in [
+        Softmax({}, env_description),
+        DiscreteSoftmax({}, env_description),
+    ]:
+        sm.set_new_params(np.random.normal(size=sm.get_params().shape))
+        answer = [
+            sm.get_prob_this_action(obs, action)
+            for obs, action in zip(observations, actions)
+        ]
+        probs = sm.get_probs_from_observations_and_actions(
+            observations, actions, behavior_action_probs
+        )
+        assert np.allclose(probs, answer)
+        log_probs = sm.get_log_probs_from_observations_and_actions(
+            observations, actions, behavior_action_probs
+        )
+        assert np.allclose(log_probs, np.log(answer))
+
+    # Differentiable with respect to the Q Table
+    def f(theta, batched):
+        sm.set_new_params(theta)
+        if batched:
+            return np.sum(
+                sm.get_probs_from_observations_and_actions(
+                    observations, actions, behavior_action_probs
+                )
+            )
+        return np.sum(
+            np.array(
+                [
+                    sm.get_prob_this_action(obs, action)
+                    for obs, action in zip(observations, actions)
+                ]
+            )
+        )
+
+    theta = np.random.normal(size=sm.get_params().shape)
+    assert np.allclose(grad(f)(theta, True), grad(f)(theta, False))
+
+    # Mixed softmax
+    mixed_sm = MixedSoftmax({}, env_description, alpha=0.3)
+    mixed_sm.set_new_params(theta)
+    answer = [
+        mixed_sm.get_prob_this_action(obs, action, pi_b)
+        for obs, action, pi_b in zip(observations, actions, behavior_action_probs)
+    ]
+    assert np.allclose(
+        mixed_sm.get_probs_from_observations_and_actions(
+            observations, actions, behavior_action_probs
+        ),
+        answer,
+    )
+
+    # Linear function approximator with a Fourier basis
+    env_description = Mountaincar().env_description
+    hyperparam_and_setting_dict = {
+        "basis": "Fourier",
+        "order": 2,
+        "max_coupled_vars": -1,
+    }
+    sm = Softmax(hyperparam_and_setting_dict, env_description)
+    sm.set_new_params(np.random.normal(size=sm.get_params().shape))
+    bounds = env_description.observation_space.bounds
+    observations = np.random.uniform(bounds[:, 0], bounds[:, 1], size=(50, 2))
+    actions = np.random.randint(-1, 2, 50)
+    answer = [
+        sm.get_prob_this_action(obs, action)
+        for obs, action in zip(observations, actions)
+    ]
+    assert np.allclose(
+        sm.get_probs_from_observations_and_actions(
+            observations, actions, behavior_action_probs
+        ),
+        answer,
+    )
+
+
 def test_simglucose_policy():
     bb_crmin = 5.0
     bb_crmax = 15.0
@@ -409,6 +500,50 @@ def test_Fourier():
     assert num_features == 19
 
 
+def test_Fourier_features_batch():
+    """Batched features should match the per-observation features"""
+    np.random.seed(0)
+    env_desc = Mountaincar().env_description
+    bounds = env_desc.observation_space.bounds
+    observations = np.random.uniform(bounds[:, 0], bounds[:, 1], size=(30, 2))
+    for cache_features in [False, True]:
+        hyperparam_and_setting_dict = {
+            "order": 3,
+            "max_coupled_vars": -1,
+            "cache_features": cache_features,
+        }
+        basis = Fourier(hyperparam_and_setting_dict, env_desc)
+        features = basis.get_features_batch(observations)
+        assert features.shape == (30, 16)
+        assert np.allclose(
+            features, [basis.get_features(obs) for obs in observations]
+        )
+        # Features are only memoized if asked for
+        assert (basis.get_features_batch(observations) is features) == cache_features
+
+    # Bases pickled before the feature cache existed
+    basis = Fourier({"order": 3, "max_coupled_vars": -1}, env_desc)
+    del basis.cache_features
+    del basis.feature_cache
+    basis = pickle.loads(pickle.dumps(basis))
+    assert np.allclose(basis.get_features_batch(observations), features)
+    # and with the cache turned on after unpickling
+    basis.cache_features = True
+    features = basis.get_features_batch(observations)
+    assert basis.get_features_batch(observations) is features
+
+    # Basis with fewer coupled variables than observation dimensions
+    cont_space = Continuous_Space(np.array([[-1.0, 1.0], [0.0, 2.0], [0.0, 1.0]]))
+    env_desc = Env_Description(cont_space, Discrete_Space(0, 1))
+    hyperparam_and_setting_dict = {"order": 2, "max_coupled_vars": 1}
+    basis = Fourier(hyperparam_and_setting_dict, env_desc)
+    assert basis.num_features == 7
+    assert np.array_equal(
+        basis.basis_matrix,
+        [[0, 0, 0], [0, 0, 1], [0, 0, 2], [0, 1, 0], [0, 2, 0], [1, 0, 0], [2, 0, 0]],
+    )
+
+
 def test_createRLSpec_gridworld(RL_gridworld_dataset):
     """Test creating RLSpec object
     for default gridworld inputs"""
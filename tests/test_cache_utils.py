@@ -0,0 +1,44 @@
+import pytest
+import autograd.numpy as np
+
+from seldonian.utils.cache_utils import ArrayCache
+
+
+def test_array_cache():
+    """Values should be cached on the identity of the array,
+    evicted oldest first to stay within max_bytes,
+    and not cached at all if larger than max_bytes"""
+    n_calls = [0]
+
+    def compute(array):
+        n_calls[0] += 1
+        return array * 2.0
+
+    # Room for the values of two arrays of 10 floats
+    cache = ArrayCache(max_bytes=160)
+    arrays = [np.arange(10.0) + i for i in range(3)]
+
+    value = cache.get(arrays[0], compute)
+    assert np.allclose(value, 2 * arrays[0])
+    assert cache.get(arrays[0], compute) is value
+    # An equal but different array is a different entry
+    cache.get(arrays[0].copy(), compute)
+    assert n_calls[0] == 2
+    assert cache.nbytes == 160
+
+    # Evicts the oldest entry
+    cache.get(arrays[1], compute)
+    assert cache.nbytes == 160
+    assert id(arrays[0]) not in cache.entries
+    assert cache.get(arrays[1], compute) is cache.entries[id(arrays[1])][1]
+    assert n_calls[0] == 3
+
+    # Too large to cache
+    large = np.arange(100.0)
+    cache.get(large, compute)
+    cache.get(large, compute)
+    assert n_calls[0] == 5
+    assert id(large) not in cache.entries
+
+    cache.clear()
+    assert cache.entries == {} and cache.nbytes == 0
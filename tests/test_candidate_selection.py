@@ -10,7 +10,12 @@ from seldonian.utils.tutorial_utils import (
     generate_data,
 )
 from seldonian.parse_tree.parse_tree import ParseTree, make_parse_trees_from_constraints
-from seldonian.dataset import DataSetLoader, SupervisedDataSet, RLDataSet
+from seldonian.dataset import (
+    DataSetLoader,
+    SupervisedDataSet,
+    SupervisedMetaData,
+    RLDataSet,
+)
 
 from seldonian.spec import *
 from seldonian.seldonian_algorithm import SeldonianAlgorithm
@@ -260,3 +265,690 @@ def test_addl_dataset_batches(gpa_classification_addl_datasets):
         "which is larger than the number of data points in the candidate dataset: 13857 after splitting."
     )
     assert str(excinfo.value) == error_str
+
+
+def test_analytic_constraint_gradients(monkeypatch):
+    """The closed-form gradients of the base node bounds
+    should give the same constraint Jacobian as autograd"""
+    from autograd import jacobian
+    from seldonian.candidate_selection.candidate_selection import CandidateSelection
+    from seldonian.parse_tree import analytic_gradients
+
+    n_attach_calls = [0]
+    attach_gradient = analytic_gradients.attach_gradient
+
+    def counting_attach_gradient(*args):
+        n_attach_calls[0] += 1
+        return attach_gradient(*args)
+
+    monkeypatch.setattr(
+        analytic_gradients, "attach_gradient", counting_attach_gradient
+    )
+
+    np.random.seed(0)
+    n = 500
+    X = np.random.normal(0, 1, (n, 3))
+    meta_kwargs = dict(
+        all_col_names=["x1", "x2", "x3", "label"],
+        feature_col_names=["x1", "x2", "x3"],
+        label_col_names=["label"],
+    )
+    cases = [
+        (
+            LinearRegressionModel(),
+            "regression",
+            X @ np.array([1.0, -0.5, 0.25]) + np.random.normal(0, 1, n),
+            np.random.normal(0, 1, 4),
+            ["Mean_Squared_Error - 2.0", "abs(Mean_Error) - 0.1"],
+        ),
+        (
+            BinaryLogisticRegressionModel(),
+            "classification",
+            np.random.randint(0, 2, n),
+            np.random.normal(0, 1, 4),
+            ["FPR + FNR - 0.5", "min(TPR,TNR) - ACC", "PR/NR - 1.0"],
+        ),
+        (
+            MultiClassLogisticRegressionModel(),
+            "multiclass_classification",
+            np.random.randint(0, 3, n),
+            np.random.normal(0, 1, (4, 3)),
+            ["0.8 - ACC", "FPR_[0] - 0.3", "CM_[1,2] + TNR_[2] - 0.5"],
+        ),
+    ]
+    for model, sub_regime, Y, theta, constraint_strs in cases:
+        meta = SupervisedMetaData(sub_regime=sub_regime, **meta_kwargs)
+        dataset = SupervisedDataSet(
+            features=X, labels=Y, sensitive_attrs=[], num_datapoints=n, meta=meta
+        )
+        parse_trees = make_parse_trees_from_constraints(
+            constraint_strs,
+            deltas=[0.05] * len(constraint_strs),
+            sub_regime=sub_regime,
+        )
+        cs = CandidateSelection(
+            model=model,
+            candidate_dataset=dataset,
+            n_safety=n,
+            parse_trees=parse_trees,
+            primary_objective=None,
+            optimization_technique="gradient_descent",
+            optimizer="adam",
+            initial_solution=theta,
+        )
+        cs.calculate_batches(batch_index=0, batch_size=n, epoch=0, n_batches=1)
+
+        n_attach_calls[0] = 0
+        upper_bounds = cs.get_constraint_upper_bounds(theta)
+        analytic_jacobian = jacobian(cs.get_constraint_upper_bounds)(theta)
+        # Every base node has at least one bound computed analytically
+        n_base_nodes = sum(len(pt.base_node_dict) for pt in parse_trees)
+        assert n_attach_calls[0] >= n_base_nodes
+
+        cs.use_analytic_gradients = False
+        n_attach_calls[0] = 0
+        autograd_jacobian = jacobian(cs.get_constraint_upper_bounds)(theta)
+        assert n_attach_calls[0] == 0
+
+        assert np.allclose(cs.get_constraint_upper_bounds(theta), upper_bounds)
+        assert analytic_jacobian.shape == (len(constraint_strs),) + theta.shape
+        assert np.allclose(analytic_jacobian, autograd_jacobian)
+
+
+def test_chunked_candidate_eval():
+    """Evaluating the primary objective and the base nodes in chunks
+    should give the same values and gradients as evaluating them
+    all at once, while never passing more than
+    batch_size_candidate_eval datapoints to the model
+    and sharing the predictions of each chunk"""
+    from autograd import jacobian
+    from seldonian.candidate_selection.candidate_selection import CandidateSelection
+    from seldonian.models.prediction_cache import PredictionCache
+    from seldonian.optimizers.gradient_descent import setup_autograd_gradients
+
+    class CountingModel(BinaryLogisticRegressionModel):
+        def __init__(self):
+            super().__init__()
+            self.max_rows = 0
+            self.n_predict_calls = 0
+
+        def predict(self, theta, X):
+            self.max_rows = max(self.max_rows, len(X))
+            self.n_predict_calls += 1
+            return super().predict(theta, X)
+
+    np.random.seed(0)
+    n = 500
+    X = np.random.normal(0, 1, (n, 3))
+    Y = np.random.randint(0, 2, n)
+    meta = SupervisedMetaData(
+        sub_regime="classification",
+        all_col_names=["x1", "x2", "x3", "label"],
+        feature_col_names=["x1", "x2", "x3"],
+        label_col_names=["label"],
+    )
+    dataset = SupervisedDataSet(
+        features=X, labels=Y, sensitive_attrs=[], num_datapoints=n, meta=meta
+    )
+    constraint_strs = ["FPR + FNR - 0.5", "min(TPR,TNR) - ACC"]
+    parse_trees = make_parse_trees_from_constraints(
+        constraint_strs,
+        deltas=[0.05] * len(constraint_strs),
+        sub_regime="classification",
+    )
+    model = CountingModel()
+    cs = CandidateSelection(
+        model=model,
+        candidate_dataset=dataset,
+        n_safety=n,
+        parse_trees=parse_trees,
+        primary_objective=None,
+        optimization_technique="gradient_descent",
+        optimizer="adam",
+        initial_solution=np.zeros(4),
+    )
+    cs.use_analytic_gradients = False
+    cs.calculate_batches(batch_index=0, batch_size=n, epoch=0, n_batches=1)
+    theta = np.random.normal(0, 1, 4)
+
+    upper_bounds = cs.get_constraint_upper_bounds(theta)
+    full_jacobian = jacobian(cs.get_constraint_upper_bounds)(theta)
+    assert model.max_rows == n
+
+    cs.batch_size_candidate_eval = 128
+    model.max_rows = 0
+    chunked_upper_bounds = cs.get_constraint_upper_bounds(theta)
+    chunked_jacobian = jacobian(cs.get_constraint_upper_bounds)(theta)
+    assert model.max_rows == 128
+    assert np.allclose(chunked_upper_bounds, upper_bounds)
+    assert np.allclose(chunked_jacobian, full_jacobian)
+
+    # With the primary objective in the same trace
+    cs.primary_objective = objectives.binary_logistic_loss
+    model.prediction_cache = PredictionCache()
+    lagrangian_terms_and_gradients = setup_autograd_gradients(
+        cs.evaluate_primary_objective, cs.get_constraint_upper_bounds
+    )
+    cs.batch_size_candidate_eval = None
+    model.max_rows = 0
+    full_terms = lagrangian_terms_and_gradients(theta)
+    assert model.max_rows == n
+
+    cs.batch_size_candidate_eval = 128
+    model.prediction_cache.reset()
+    model.max_rows = 0
+    chunked_terms = lagrangian_terms_and_gradients(theta)
+    assert model.max_rows == 128
+    for full_term, chunked_term in zip(full_terms, chunked_terms):
+        assert np.allclose(chunked_term, full_term)
+
+    # The primary objective and the base nodes share
+    # one forward pass per chunk
+    model.prediction_cache.reset()
+    model.n_predict_calls = 0
+    cs.evaluate_primary_objective(theta)
+    cs.get_constraint_upper_bounds(theta)
+    assert model.n_predict_calls == 4
+    model.prediction_cache = None
+
+    # Primary objectives that are not a mean over the
+    # datapoints are not chunked
+    cs.primary_objective = lambda model, theta, X, Y, **kwargs: np.sum(theta ** 2)
+    cs.initial_solution = theta
+    with pytest.warns(UserWarning, match="batch_size_candidate_eval"):
+        cs.run(
+            batch_size_candidate_eval=128,
+            lambda_init=0.5,
+            alpha_theta=0.05,
+            alpha_lamb=0.05,
+            beta_velocity=0.9,
+            beta_rmsprop=0.95,
+            use_batches=False,
+            num_iters=2,
+            gradient_library="autograd",
+            custom_primary_gradient_fn=None,
+            verbose=False,
+            debug=False,
+        )
+
+
+def test_data_parallel_constraint_upper_bounds():
+    """Merging the moments of base nodes evaluated on shards
+    of the batch in worker processes should give the same upper bounds
+    and Jacobian as evaluating them on the whole batch"""
+    from autograd import jacobian
+    from seldonian.candidate_selection.candidate_selection import CandidateSelection
+    from seldonian.candidate_selection.data_parallel import DataParallelEvaluator
+
+    np.random.seed(0)
+    n = 600
+    X = np.random.normal(0, 1, (n, 3))
+    Y = np.random.randint(0, 2, n)
+    meta = SupervisedMetaData(
+        sub_regime="classification",
+        all_col_names=["x1", "x2", "x3", "label"],
+        feature_col_names=["x1", "x2", "x3"],
+        label_col_names=["label"],
+    )
+    dataset = SupervisedDataSet(
+        features=X, labels=Y, sensitive_attrs=[], num_datapoints=n, meta=meta
+    )
+    constraint_strs = ["FPR + FNR - 0.5", "min(TPR,TNR) - ACC", "FPR - 0.9"]
+    parse_trees = make_parse_trees_from_constraints(
+        constraint_strs,
+        deltas=[0.05] * len(constraint_strs),
+        sub_regime="classification",
+    )
+    cs = CandidateSelection(
+        model=BinaryLogisticRegressionModel(),
+        candidate_dataset=dataset,
+        n_safety=n,
+        parse_trees=parse_trees,
+        primary_objective=None,
+        optimization_technique="gradient_descent",
+        optimizer="adam",
+        initial_solution=np.zeros(4),
+    )
+    theta = np.random.normal(0, 1, 4)
+
+    for batch_index, batch_size in [(0, n), (1, 250)]:
+        cs.calculate_batches(
+            batch_index=batch_index, batch_size=batch_size, epoch=0, n_batches=1
+        )
+        upper_bounds = cs.get_constraint_upper_bounds(theta)
+        full_jacobian = jacobian(cs.get_constraint_upper_bounds)(theta)
+
+        cs.data_parallel_evaluator = DataParallelEvaluator(cs, 3)
+        try:
+            assert len(cs.data_parallel_evaluator.tasks) == 5
+            parallel_upper_bounds = cs.get_constraint_upper_bounds(theta)
+            parallel_jacobian = jacobian(cs.get_constraint_upper_bounds)(theta)
+        finally:
+            cs.data_parallel_evaluator.shutdown()
+            cs.data_parallel_evaluator = None
+        assert np.allclose(parallel_upper_bounds, upper_bounds)
+        assert np.allclose(parallel_jacobian, full_jacobian)
+
+
+def test_multi_start_candidate_selection():
+    """Multi-start gradient descent should follow the same trajectory
+    from each starting point as single-start gradient descent does,
+    with the predictions of all starting points made in one forward pass"""
+    from seldonian.candidate_selection.candidate_selection import CandidateSelection
+
+    class CountingModel(BinaryLogisticRegressionModel):
+        def __init__(self):
+            super().__init__()
+            self.n_predict_calls = 0
+            self.n_predict_stacked_calls = 0
+
+        def predict(self, theta, X):
+            self.n_predict_calls += 1
+            return super().predict(theta, X)
+
+        def predict_stacked(self, thetas, X):
+            self.n_predict_stacked_calls += 1
+            return super().predict_stacked(thetas, X)
+
+    np.random.seed(0)
+    n = 300
+    X = np.random.normal(0, 1, (n, 3))
+    Y = np.random.randint(0, 2, n)
+    meta = SupervisedMetaData(
+        sub_regime="classification",
+        all_col_names=["x1", "x2", "x3", "label"],
+        feature_col_names=["x1", "x2", "x3"],
+        label_col_names=["label"],
+    )
+    dataset = SupervisedDataSet(
+        features=X, labels=Y, sensitive_attrs=[], num_datapoints=n, meta=meta
+    )
+    hyperparams = dict(
+        lambda_init=0.5,
+        alpha_theta=0.05,
+        alpha_lamb=0.05,
+        beta_velocity=0.9,
+        beta_rmsprop=0.95,
+        use_batches=False,
+        num_iters=20,
+        gradient_library="autograd",
+        custom_primary_gradient_fn=None,
+        verbose=False,
+        debug=False,
+    )
+
+    def make_cs(initial_solution):
+        parse_trees = make_parse_trees_from_constraints(
+            ["FPR - 0.4"], deltas=[0.05], sub_regime="classification",
+        )
+        return CandidateSelection(
+            model=CountingModel(),
+            candidate_dataset=dataset,
+            n_safety=n,
+            parse_trees=parse_trees,
+            primary_objective=objectives.binary_logistic_loss,
+            optimization_technique="gradient_descent",
+            optimizer="adam",
+            initial_solution=initial_solution,
+            write_logfile=False,
+        )
+
+    initial_solution = np.array([0.1, -0.2, 0.3, 0.1])
+    cs = make_cs(np.copy(initial_solution))
+    theta_inits = cs.get_multi_start_thetas(3, start_scale=1.0, seed=0)
+    assert np.allclose(theta_inits[0], initial_solution)
+    cs.run(n_starts=3, start_scale=1.0, seed=0, **hyperparams)
+    res = cs.optimization_result
+    assert res["n_starts"] == 3
+    # One stacked forward pass per step feeds the primary objective
+    # and the base node of every starting point
+    assert cs.model.n_predict_stacked_calls == hyperparams["num_iters"]
+    assert cs.model.n_predict_calls == 0
+
+    single_results = []
+    for theta_init in theta_inits:
+        single_cs = make_cs(np.copy(theta_init))
+        single_cs.run(**hyperparams)
+        single_results.append(single_cs.optimization_result)
+
+    best_start = res["best_start"]
+    assert np.allclose(res["f_vals"], single_results[best_start]["f_vals"])
+    assert np.allclose(res["g_vals"], single_results[best_start]["g_vals"])
+    assert np.allclose(
+        res["candidate_solution"], single_results[best_start]["candidate_solution"]
+    )
+    feasible_fs = [r["best_f"] for r in single_results if r["found_feasible_solution"]]
+    if feasible_fs:
+        assert res["best_f"] == pytest.approx(min(feasible_fs))
+
+
+def test_multi_start_stateful_model():
+    """Multi-start gradient descent should follow the same trajectory
+    from each starting point as single-start gradient descent does
+    for a model whose forward and backward passes depend on the weights
+    it last loaded, rather than only on the theta passed in"""
+    from seldonian.candidate_selection.candidate_selection import CandidateSelection
+    from seldonian.models.sklearn_lr import SkLearnLinearRegressor
+
+    np.random.seed(0)
+    n = 200
+    X = np.random.normal(0, 1, (n, 2))
+    Y = X @ np.array([1.0, -0.5]) + np.random.normal(0, 0.5, n)
+    meta = SupervisedMetaData(
+        sub_regime="regression",
+        all_col_names=["x1", "x2", "label"],
+        feature_col_names=["x1", "x2"],
+        label_col_names=["label"],
+    )
+    dataset = SupervisedDataSet(
+        features=X, labels=Y, sensitive_attrs=[], num_datapoints=n, meta=meta
+    )
+    hyperparams = dict(
+        lambda_init=0.5,
+        alpha_theta=0.05,
+        alpha_lamb=0.05,
+        beta_velocity=0.9,
+        beta_rmsprop=0.95,
+        use_batches=False,
+        num_iters=20,
+        gradient_library="autograd",
+        custom_primary_gradient_fn=None,
+        verbose=False,
+        debug=False,
+    )
+
+    def make_cs(initial_solution):
+        parse_trees = make_parse_trees_from_constraints(
+            ["Mean_Squared_Error - 10.0"], deltas=[0.05], sub_regime="regression",
+        )
+        return CandidateSelection(
+            model=SkLearnLinearRegressor(),
+            candidate_dataset=dataset,
+            n_safety=n,
+            parse_trees=parse_trees,
+            primary_objective=objectives.Mean_Squared_Error,
+            optimization_technique="gradient_descent",
+            optimizer="adam",
+            initial_solution=initial_solution,
+            write_logfile=False,
+        )
+
+    # Start from a poor solution so that a perturbed start does best. If the
+    # model kept the weights of the first start, all starts would look alike
+    cs = make_cs(np.array([2.0, 2.0, 2.0]))
+    theta_inits = cs.get_multi_start_thetas(3, start_scale=1.0, seed=8)
+    cs.run(n_starts=3, start_scale=1.0, seed=8, **hyperparams)
+    res = cs.optimization_result
+
+    single_results = []
+    for theta_init in theta_inits:
+        single_cs = make_cs(np.copy(theta_init))
+        single_cs.run(**hyperparams)
+        single_results.append(single_cs.optimization_result)
+
+    best_start = res["best_start"]
+    assert best_start != 0
+    assert np.allclose(res["f_vals"], single_results[best_start]["f_vals"])
+    assert np.allclose(res["g_vals"], single_results[best_start]["g_vals"])
+    assert np.allclose(res["lamb_vals"], single_results[best_start]["lamb_vals"])
+    assert np.allclose(
+        res["candidate_solution"], single_results[best_start]["candidate_solution"]
+    )
+    feasible_fs = [r["best_f"] for r in single_results if r["found_feasible_solution"]]
+    assert res["best_f"] == pytest.approx(min(feasible_fs))
+
+
+def test_cmaes_population_evaluation(monkeypatch):
+    """Evaluating each CMA-ES generation as a whole, with stacked
+    predictions or in worker processes, should find the same solution
+    as evaluating one candidate solution at a time"""
+    import cma
+    from seldonian.candidate_selection.candidate_selection import CandidateSelection
+
+    class CountingModel(LinearRegressionModel):
+        def __init__(self):
+            super().__init__()
+            self.n_predict_stacked_calls = 0
+
+        def predict_stacked(self, thetas, X):
+            self.n_predict_stacked_calls += 1
+            return super().predict_stacked(thetas, X)
+
+    np.random.seed(0)
+    n = 200
+    X = np.random.normal(0, 1, (n, 2))
+    Y = X @ np.array([1.0, -0.5]) + np.random.normal(0, 0.5, n)
+    meta = SupervisedMetaData(
+        sub_regime="regression",
+        all_col_names=["x1", "x2", "label"],
+        feature_col_names=["x1", "x2"],
+        label_col_names=["label"],
+    )
+    dataset = SupervisedDataSet(
+        features=X, labels=Y, sensitive_attrs=[], num_datapoints=n, meta=meta
+    )
+    hyperparams = dict(maxiter=15, seed=1, verbose=False)
+
+    def make_cs():
+        parse_trees = make_parse_trees_from_constraints(
+            ["Mean_Squared_Error - 0.5"], deltas=[0.05], sub_regime="regression",
+        )
+        return CandidateSelection(
+            model=CountingModel(),
+            candidate_dataset=dataset,
+            n_safety=n,
+            parse_trees=parse_trees,
+            primary_objective=objectives.Mean_Squared_Error,
+            optimization_technique="barrier_function",
+            optimizer="CMA-ES",
+            initial_solution=np.zeros(3),
+            write_logfile=False,
+        )
+
+    # Reference: one candidate solution at a time
+    ref_cs = make_cs()
+    ref_cs.model.prediction_cache = None
+    es = cma.CMAEvolutionStrategy(
+        np.zeros(3), 0.2, {"maxiter": 15, "seed": 1, "verbose": -9}
+    )
+    es.optimize(ref_cs.objective_with_barrier)
+
+    # Like es.optimize(), the final generation is always logged
+    final_logging_iterations = []
+    force_final_logging = cma.CMAEvolutionStrategy._force_final_logging
+
+    def record_final_logging(self):
+        final_logging_iterations.append(self.countiter)
+        return force_final_logging(self)
+
+    monkeypatch.setattr(
+        cma.CMAEvolutionStrategy, "_force_final_logging", record_final_logging
+    )
+
+    cs = make_cs()
+    solution = cs.run(**hyperparams)
+    assert np.allclose(solution, es.result.xbest)
+    assert cs.model.n_predict_stacked_calls == cs.optimization_result.iterations
+    assert final_logging_iterations == [cs.optimization_result.iterations]
+
+    cs = make_cs()
+    solution = cs.run(n_population_workers=2, **hyperparams)
+    assert np.allclose(solution, es.result.xbest)
+
+
+def test_one_forward_pass_per_step():
+    """The primary objective and the base nodes should share
+    one model.predict call per gradient descent step, also when the
+    primary gradient or the base node gradients are computed analytically"""
+    from seldonian.candidate_selection.candidate_selection import CandidateSelection
+
+    class CountingModel(BinaryLogisticRegressionModel):
+        def __init__(self):
+            super().__init__()
+            self.n_predict_calls = 0
+
+        def predict(self, theta, X):
+            self.n_predict_calls += 1
+            return super().predict(theta, X)
+
+    np.random.seed(0)
+    n = 200
+    X = np.random.normal(0, 1, (n, 3))
+    Y = np.random.randint(0, 2, n)
+    meta = SupervisedMetaData(
+        sub_regime="classification",
+        all_col_names=["x1", "x2", "x3", "label"],
+        feature_col_names=["x1", "x2", "x3"],
+        label_col_names=["label"],
+    )
+    dataset = SupervisedDataSet(
+        features=X, labels=Y, sensitive_attrs=[], num_datapoints=n, meta=meta
+    )
+    num_iters = 10
+    hyperparams = dict(
+        lambda_init=0.5,
+        alpha_theta=0.05,
+        alpha_lamb=0.05,
+        beta_velocity=0.9,
+        beta_rmsprop=0.95,
+        use_batches=False,
+        num_iters=num_iters,
+        gradient_library="autograd",
+        custom_primary_gradient_fn=None,
+        verbose=False,
+        debug=False,
+    )
+
+    def make_cs():
+        parse_trees = make_parse_trees_from_constraints(
+            ["FPR - 0.4", "ACC >= 0.4"],
+            deltas=[0.05, 0.05],
+            sub_regime="classification",
+        )
+        return CandidateSelection(
+            model=CountingModel(),
+            candidate_dataset=dataset,
+            n_safety=n,
+            parse_trees=parse_trees,
+            primary_objective=objectives.binary_logistic_loss,
+            optimization_technique="gradient_descent",
+            optimizer="adam",
+            initial_solution=np.array([0.1, -0.2, 0.3, 0.1]),
+            write_logfile=False,
+        )
+
+    for extra_hyperparams in [
+        {},
+        {"use_builtin_primary_gradient_fn": True},
+        {"use_analytic_gradients": True},
+    ]:
+        cs = make_cs()
+        cs.run(**hyperparams, **extra_hyperparams)
+        assert cs.model.n_predict_calls == num_iters
+        assert cs.model.prediction_cache is None
+
+    # The prediction cache is detached from the model even if the run fails
+    cs = make_cs()
+    with pytest.raises(KeyError):
+        cs.run(**{k: v for k, v in hyperparams.items() if k != "use_batches"})
+    assert cs.model.prediction_cache is None
+
+
+def test_torch_gradient_library():
+    """gradient_library='torch' should follow the same path
+    as autograd for a PyTorch model, with a single tensor forward pass
+    per step and without going through pytorch_predict"""
+    torch = pytest.importorskip("torch")
+    from seldonian.candidate_selection.candidate_selection import CandidateSelection
+    from seldonian.models.pytorch_model import SupervisedPytorchBaseModel
+
+    class TorchMLP(SupervisedPytorchBaseModel):
+        def __init__(self):
+            super().__init__(device="cpu")
+            self.n_tensor_predict_calls = 0
+
+        def create_model(self, **kwargs):
+            return torch.nn.Sequential(
+                torch.nn.Linear(3, 4),
+                torch.nn.Tanh(),
+                torch.nn.Linear(4, 1),
+                torch.nn.Sigmoid(),
+                torch.nn.Flatten(0),
+            )
+
+        def functional_forward_pass(self, theta, X):
+            self.n_tensor_predict_calls += 1
+            return super().functional_forward_pass(theta, X)
+
+    np.random.seed(0)
+    torch.manual_seed(0)
+    n = 200
+    X = np.random.normal(0, 1, (n, 3))
+    Y = np.random.randint(0, 2, n).astype(float)
+    meta = SupervisedMetaData(
+        sub_regime="classification",
+        all_col_names=["x1", "x2", "x3", "label"],
+        feature_col_names=["x1", "x2", "x3"],
+        label_col_names=["label"],
+    )
+    dataset = SupervisedDataSet(
+        features=X, labels=Y, sensitive_attrs=[], num_datapoints=n, meta=meta
+    )
+    num_iters = 5
+    hyperparams = dict(
+        lambda_init=0.5,
+        alpha_theta=0.01,
+        alpha_lamb=0.01,
+        beta_velocity=0.9,
+        beta_rmsprop=0.95,
+        use_batches=False,
+        num_iters=num_iters,
+        custom_primary_gradient_fn=None,
+        verbose=False,
+        debug=False,
+    )
+    constraint_strs = ["FPR + FNR - 0.5", "abs(PR - 0.5) - 0.1", "exp(NR) - 2"]
+    initial_solution = TorchMLP().get_model_params().astype(float)
+
+    results = {}
+    for gradient_library in ["autograd", "torch"]:
+        parse_trees = make_parse_trees_from_constraints(
+            constraint_strs,
+            deltas=[0.05] * len(constraint_strs),
+            sub_regime="classification",
+        )
+        cs = CandidateSelection(
+            model=TorchMLP(),
+            candidate_dataset=dataset,
+            n_safety=n,
+            parse_trees=parse_trees,
+            primary_objective=objectives.binary_logistic_loss,
+            optimization_technique="gradient_descent",
+            optimizer="adam",
+            initial_solution=initial_solution.copy(),
+            write_logfile=False,
+        )
+        cs.run(gradient_library=gradient_library, **hyperparams)
+        results[gradient_library] = cs.optimization_result
+        expected_calls = num_iters if gradient_library == "torch" else 0
+        assert cs.model.n_tensor_predict_calls == expected_calls
+
+    # Same objective and constraint values along the whole trajectory
+    for key in ["f_vals", "g_vals", "lamb_vals"]:
+        assert np.allclose(results["torch"][key], results["autograd"][key], atol=1e-5)
+    assert len(set(results["torch"]["f_vals"])) == num_iters
+
+    # Only PyTorch models accept tensor weights
+    cs = CandidateSelection(
+        model=BinaryLogisticRegressionModel(),
+        candidate_dataset=dataset,
+        n_safety=n,
+        parse_trees=parse_trees,
+        primary_objective=objectives.binary_logistic_loss,
+        optimization_technique="gradient_descent",
+        optimizer="adam",
+        initial_solution=np.zeros(4),
+        write_logfile=False,
+    )
+    with pytest.raises(NotImplementedError):
+        cs.run(gradient_library="torch", **hyperparams)
@@ -1,3 +1,4 @@
+import os
 import pytest
 import importlib
 import autograd.numpy as np
@@ -328,3 +329,205 @@ def test_add_supervised_datasets():
     assert dataset3.features.shape == (86606, 9)
     assert dataset3.sensitive_col_names == ["M", "F"]
     assert dataset3.num_datapoints == 86606
+
+
+def test_mask_indices():
+    np.random.seed(0)
+    N = 1000
+    sensitive_col_names = ["M", "F", "A", "B"]
+    meta = SupervisedMetaData(
+        sub_regime="regression",
+        all_col_names=["x1", "x2", "M", "F", "A", "B", "y"],
+        feature_col_names=["x1", "x2"],
+        label_col_names=["y"],
+        sensitive_col_names=sensitive_col_names,
+    )
+    features = np.random.normal(size=(N, 2))
+    labels = np.random.normal(size=N)
+    sensitive_attrs = np.random.randint(0, 2, size=(N, 4))
+    dataset = SupervisedDataSet(
+        features=features,
+        labels=labels,
+        sensitive_attrs=sensitive_attrs,
+        num_datapoints=N,
+        meta=meta,
+    )
+    assert dataset.mask_index == {}
+
+    bool_mask = (sensitive_attrs[:, 0] == 1) & (sensitive_attrs[:, 2] == 1)
+    indices = dataset.get_mask_indices(["M", "A"])
+    assert np.array_equal(indices, np.flatnonzero(bool_mask))
+    assert np.array_equal(features[indices], features[bool_mask])
+    # Computed once and then reused
+    assert dataset.get_mask_indices(["M", "A"]) is indices
+    assert list(dataset.mask_index.keys()) == [("M", "A")]
+
+    # A batch slices the index of its source dataset
+    batch_start, batch_end = 300, 550
+    batch_dataset = SupervisedDataSet(
+        features=features[batch_start:batch_end],
+        labels=labels[batch_start:batch_end],
+        sensitive_attrs=sensitive_attrs[batch_start:batch_end],
+        num_datapoints=batch_end - batch_start,
+        meta=meta,
+    )
+    batch_dataset.set_batch_source(dataset, batch_start, batch_end)
+    for cols in [["M", "A"], ["F"], ["M", "F", "A", "B"]]:
+        col_indices = [sensitive_col_names.index(col) for col in cols]
+        batch_bool_mask = np.all(
+            sensitive_attrs[batch_start:batch_end, col_indices] == 1, axis=1
+        )
+        assert np.array_equal(
+            batch_dataset.get_mask_indices(cols), np.flatnonzero(batch_bool_mask)
+        )
+    assert ("F",) in dataset.mask_index
+
+
+def test_discounted_returns():
+    from seldonian.utils.stats_utils import weighted_sum_gamma
+
+    metadata_pth = "static/datasets/RL/gridworld/gridworld_2altrewards_metadata.json"
+    data_pth_csv = "static/datasets/RL/gridworld/gridworld_100episodes_2altrewards.csv"
+    loader = DataSetLoader(regime="reinforcement_learning")
+    dataset = loader.load_RL_dataset_from_csv(
+        filename=data_pth_csv, metadata_filename=metadata_pth
+    )
+    gamma = 0.9
+    episodes = dataset.episodes
+    returns = dataset.get_discounted_returns(gamma)
+    assert np.allclose(
+        returns, [weighted_sum_gamma(ep.rewards, gamma) for ep in episodes]
+    )
+    # Computed once per discount factor and then reused
+    assert dataset.get_discounted_returns(gamma) is returns
+    assert np.allclose(
+        dataset.get_discounted_returns(1.0), [np.sum(ep.rewards) for ep in episodes]
+    )
+    for alt_reward_number in [1, 2]:
+        alt_returns = dataset.get_discounted_returns(gamma, alt_reward_number)
+        assert np.allclose(
+            alt_returns,
+            [
+                weighted_sum_gamma(ep.alt_rewards[:, alt_reward_number - 1], gamma)
+                for ep in episodes
+            ],
+        )
+
+    # A batch slices the returns of its source dataset
+    batch_start, batch_end = 20, 65
+    batch_dataset = RLDataSet(
+        episodes=episodes[batch_start:batch_end], meta=dataset.meta
+    )
+    batch_dataset.set_batch_source(dataset, batch_start, batch_end)
+    assert np.array_equal(
+        batch_dataset.get_discounted_returns(gamma, 2),
+        dataset.get_discounted_returns(gamma, 2)[batch_start:batch_end],
+    )
+
+
+def test_episode_columns():
+    metadata_pth = "static/datasets/RL/gridworld/gridworld_2altrewards_metadata.json"
+    data_pth_csv = "static/datasets/RL/gridworld/gridworld_100episodes_2altrewards.csv"
+    loader = DataSetLoader(regime="reinforcement_learning")
+    dataset = loader.load_RL_dataset_from_csv(
+        filename=data_pth_csv, metadata_filename=metadata_pth
+    )
+    columnar_dataset = loader.load_RL_dataset_from_csv(
+        filename=data_pth_csv, metadata_filename=metadata_pth, columnar=True
+    )
+    episodes = dataset.episodes
+    columns = columnar_dataset.episodes
+    assert isinstance(columns, EpisodeColumns)
+    assert columnar_dataset.num_datapoints == len(columns) == 100
+    assert columns.n_alt_rewards == 2
+    assert columns.episode_offsets[-1] == len(columns.rewards)
+    assert np.array_equal(
+        columns.episode_lengths, [len(ep.rewards) for ep in episodes]
+    )
+
+    def assert_same_episodes(eps1, eps2):
+        assert len(eps1) == len(eps2)
+        for ep1, ep2 in zip(eps1, eps2):
+            assert np.array_equal(ep1.observations, ep2.observations)
+            assert np.array_equal(ep1.actions, ep2.actions)
+            assert np.array_equal(ep1.rewards, ep2.rewards)
+            assert np.array_equal(ep1.action_probs, ep2.action_probs)
+            assert np.array_equal(ep1.alt_rewards, ep2.alt_rewards)
+
+    assert_same_episodes(columns, episodes)
+    assert_same_episodes(EpisodeColumns.from_episodes(episodes), episodes)
+    assert_same_episodes([columns[-1]], [episodes[-1]])
+
+    # Contiguous slices are views, not copies
+    batch = columns[10:40]
+    assert isinstance(batch, EpisodeColumns)
+    assert np.shares_memory(batch.rewards, columns.rewards)
+    assert_same_episodes(batch, episodes[10:40])
+    assert np.shares_memory(columns[5].rewards, columns.rewards)
+
+    # Index arrays, masks and concatenation
+    indices = np.array([3, 0, 57, 99])
+    assert_same_episodes(columns[indices], [episodes[ii] for ii in indices])
+    mask = np.zeros(100, dtype=bool)
+    mask[indices] = True
+    assert_same_episodes(columns[mask], [episodes[ii] for ii in sorted(indices)])
+    assert_same_episodes(columns[90:] + columns[:5], episodes[90:] + episodes[:5])
+
+    for alt_reward_number in [None, 1, 2]:
+        assert np.allclose(
+            columnar_dataset.get_discounted_returns(0.9, alt_reward_number),
+            dataset.get_discounted_returns(0.9, alt_reward_number),
+        )
+
+
+def test_RL_precomputed_quantities(tmp_path):
+    data_pth = "static/datasets/RL/gridworld/gridworld_100episodes_2altrewards.pkl"
+    loader = DataSetLoader(regime="reinforcement_learning")
+    dataset = loader.load_RL_dataset_from_episode_file(filename=data_pth)
+    gamma = 0.9
+
+    columns = dataset.get_episode_columns()
+    assert isinstance(columns, EpisodeColumns)
+    # Converted once and then reused
+    assert dataset.get_episode_columns() is columns
+    ep = dataset.episodes[7]
+    lo, hi = columns.episode_offsets[7], columns.episode_offsets[8]
+    assert np.array_equal(columns.timesteps[lo:hi], np.arange(len(ep.rewards)))
+    assert np.allclose(
+        columns.get_discounts(gamma)[lo:hi], np.power(gamma, range(len(ep.rewards)))
+    )
+    assert columns.get_discounts(gamma) is columns.get_discounts(gamma)
+
+    # Batches are views into the columns of their source,
+    # including the cached per-timestep quantities
+    batch_start, batch_end = 30, 80
+    batch_dataset = RLDataSet(
+        episodes=dataset.episodes[batch_start:batch_end], meta=dataset.meta
+    )
+    batch_dataset.set_batch_source(dataset, batch_start, batch_end)
+    batch_columns = batch_dataset.get_episode_columns()
+    assert len(batch_columns) == 50
+    assert np.shares_memory(batch_columns.rewards, columns.rewards)
+    assert np.shares_memory(
+        batch_columns.get_discounts(gamma), columns.get_discounts(gamma)
+    )
+
+    # Save and load alongside the dataset
+    dataset.precompute(gamma)
+    filename = os.path.join(tmp_path, "precomputed.pkl")
+    dataset.save_precomputed(filename)
+    new_dataset = loader.load_RL_dataset_from_episode_file(filename=data_pth)
+    new_dataset.load_precomputed(filename)
+    assert gamma in new_dataset.get_episode_columns().discount_cache
+    for alt_reward_number in [None, 1, 2]:
+        assert np.array_equal(
+            new_dataset.get_discounted_returns(gamma, alt_reward_number),
+            dataset.get_discounted_returns(gamma, alt_reward_number),
+        )
+
+    # Precomputed quantities must match the dataset
+    with pytest.raises(RuntimeError) as excinfo:
+        batch_dataset.load_precomputed(filename)
+    assert "are for 100 episodes, but the dataset has 50 episodes" in str(
+        excinfo.value
+    )
@@ -0,0 +1,293 @@
+import pytest
+import autograd.numpy as np
+from autograd import jacobian
+
+from seldonian.optimizers.gradient_descent import (
+    multi_start_gradient_descent_adam,
+    value_and_jacobian,
+    gradient_descent_adam,
+    gradient_library_dict,
+    register_gradient_library,
+    setup_gradients,
+)
+
+
+def test_value_and_jacobian():
+    """The value and Jacobian should match separate evaluations"""
+
+    def f(theta):
+        return np.array([np.sum(theta ** 2), np.prod(np.sin(theta)), theta[0]])
+
+    theta = np.array([0.3, -1.2, 2.0])
+    value, jac = value_and_jacobian(f)(theta)
+    assert np.allclose(value, f(theta))
+    assert jac.shape == (3, 3)
+    assert np.allclose(jac, jacobian(f)(theta))
+
+    # Matrix-valued theta
+    def g(theta):
+        return np.array([np.sum(theta[0] * theta[1]), np.max(theta)])
+
+    theta = np.array([[0.5, 1.5], [-1.0, 2.5]])
+    value, jac = value_and_jacobian(g)(theta)
+    assert np.allclose(value, g(theta))
+    assert jac.shape == (2, 2, 2)
+    assert np.allclose(jac, jacobian(g)(theta))
+
+
+def test_upper_bounds_evaluated_once_per_step():
+    """Each step of gradient descent should run the
+    primary objective and upper bounds function exactly once"""
+    n_calls = [0]
+    n_primary_calls = [0]
+
+    def primary_objective(theta):
+        n_primary_calls[0] += 1
+        return np.sum((theta - 1.0) ** 2)
+
+    def upper_bounds_function(theta):
+        n_calls[0] += 1
+        return np.array([theta[0] - 0.5, np.sum(theta) - 3.0])
+
+    n_epochs = 20
+    res = gradient_descent_adam(
+        primary_objective=primary_objective,
+        n_constraints=2,
+        upper_bounds_function=upper_bounds_function,
+        theta_init=np.zeros(2),
+        lambda_init=0.5,
+        batch_calculator=lambda *args: False,
+        n_batches=1,
+        n_epochs=n_epochs,
+        alpha_theta=0.05,
+        alpha_lamb=0.05,
+    )
+    assert n_calls[0] == n_epochs
+    assert n_primary_calls[0] == n_epochs
+    assert np.allclose(
+        res["g_vals"][0], upper_bounds_function(np.zeros(2)), atol=1e-12
+    )
+    assert res["found_feasible_solution"]
+
+
+def test_primary_value_and_gradient():
+    """A fused primary objective and gradient function
+    should replace both the objective and autograd"""
+    n_primary_calls = [0]
+    n_fused_calls = [0]
+
+    def primary_objective(theta):
+        n_primary_calls[0] += 1
+        return np.sum((theta - 1.0) ** 2)
+
+    def primary_value_and_gradient(theta):
+        n_fused_calls[0] += 1
+        return np.sum((theta - 1.0) ** 2), 2 * (theta - 1.0)
+
+    gd_kwargs = dict(
+        n_constraints=1,
+        upper_bounds_function=lambda theta: np.array([theta[0] - 0.5]),
+        lambda_init=0.5,
+        batch_calculator=lambda *args: False,
+        n_batches=1,
+        n_epochs=20,
+    )
+    res_fused = gradient_descent_adam(
+        primary_objective=primary_objective,
+        theta_init=np.zeros(2),
+        primary_value_and_gradient=primary_value_and_gradient,
+        **gd_kwargs,
+    )
+    assert n_primary_calls[0] == 0
+    assert n_fused_calls[0] == 20
+
+    res_autograd = gradient_descent_adam(
+        primary_objective=primary_objective, theta_init=np.zeros(2), **gd_kwargs
+    )
+    assert np.allclose(res_fused["f_vals"], res_autograd["f_vals"])
+    assert np.allclose(
+        res_fused["candidate_solution"], res_autograd["candidate_solution"]
+    )
+
+
+def test_register_gradient_library():
+    """A registered gradient library should be used by
+    gradient descent, and unknown libraries should raise"""
+    n_setup_calls = [0]
+
+    def setup_counting_gradients(primary_objective, upper_bounds_function):
+        n_setup_calls[0] += 1
+        return gradient_library_dict["autograd"](
+            primary_objective, upper_bounds_function
+        )
+
+    register_gradient_library("counting", setup_counting_gradients)
+    try:
+        gd_kwargs = dict(
+            primary_objective=lambda theta: np.sum((theta - 1.0) ** 2),
+            n_constraints=1,
+            upper_bounds_function=lambda theta: np.array([theta[0] - 0.5]),
+            lambda_init=0.5,
+            batch_calculator=lambda *args: False,
+            n_batches=1,
+            n_epochs=10,
+        )
+        res_counting = gradient_descent_adam(
+            gradient_library="counting", theta_init=np.zeros(2), **gd_kwargs
+        )
+        assert n_setup_calls[0] == 1
+        res_autograd = gradient_descent_adam(theta_init=np.zeros(2), **gd_kwargs)
+        assert np.allclose(
+            res_counting["candidate_solution"], res_autograd["candidate_solution"]
+        )
+    finally:
+        gradient_library_dict.pop("counting")
+
+    with pytest.raises(NotImplementedError) as excinfo:
+        setup_gradients("notalibrary", lambda theta: 0, lambda theta: 0)
+    assert str(excinfo.value) == "gradient library: notalibrary not supported"
+
+
+@pytest.mark.parametrize("stacked_trace", [False, True])
+def test_multi_start_gradient_descent_adam(stacked_trace):
+    """Each trajectory of multi-start gradient descent should match
+    single-start gradient descent from the same starting point,
+    and a trajectory that diverges should be dropped"""
+    gd_kwargs = dict(
+        primary_objective=lambda theta: np.sum((theta - 1.0) ** 2),
+        n_constraints=1,
+        upper_bounds_function=lambda theta: np.array([theta[0] - 0.5]),
+        lambda_init=0.5,
+        batch_calculator=lambda *args: False,
+        n_batches=1,
+        n_epochs=20,
+    )
+    theta_inits = np.array([[0.0, 0.0], [2.0, -1.0], [-3.0, 4.0]])
+    res = multi_start_gradient_descent_adam(
+        theta_inits=theta_inits, stacked_trace=stacked_trace, **gd_kwargs
+    )
+    # theta_inits is not updated in place
+    assert np.allclose(theta_inits[0], [0.0, 0.0])
+    assert res["n_starts"] == 3
+    single_results = [
+        gradient_descent_adam(theta_init=np.copy(theta_init), **gd_kwargs)
+        for theta_init in theta_inits
+    ]
+    best_start = res["best_start"]
+    best_single = min(single_results, key=lambda r: r["best_f"])
+    assert single_results[best_start] is best_single
+    assert np.allclose(res["candidate_solution"], best_single["candidate_solution"])
+    assert np.allclose(res["f_vals"], best_single["f_vals"])
+    assert np.allclose(res["lamb_vals"], best_single["lamb_vals"])
+
+    # A starting point that produces nans is dropped, the others continue
+    theta_inits = np.array([[0.0, 0.0], [np.nan, 0.0]])
+    with pytest.warns(UserWarning, match="starting point 1"):
+        res = multi_start_gradient_descent_adam(
+            theta_inits=theta_inits, stacked_trace=stacked_trace, **gd_kwargs
+        )
+    assert res["best_start"] == 0
+    assert np.allclose(
+        res["candidate_solution"], single_results[0]["candidate_solution"]
+    )
+
+
+def test_early_stopping():
+    """Gradient descent should stop once a convergence criterion
+    has held for long enough and record why it stopped"""
+    gd_kwargs = dict(
+        primary_objective=lambda theta: np.sum((theta - 1.0) ** 2) + 1.0,
+        n_constraints=1,
+        upper_bounds_function=lambda theta: np.array([theta[0] - 2.0]),
+        lambda_init=0.5,
+        batch_calculator=lambda *args: False,
+        n_batches=1,
+        n_epochs=500,
+        beta_velocity=0.0,
+    )
+    res_full = gradient_descent_adam(theta_init=np.zeros(2), **gd_kwargs)
+    assert res_full["stop_reason"] == "max_iterations"
+    assert res_full["n_iters"] == 500
+    assert len(res_full["f_vals"]) == 500
+
+    res = gradient_descent_adam(
+        theta_init=np.zeros(2), feasibility_patience=5, **gd_kwargs
+    )
+    assert res["stop_reason"] == "feasibility_stable"
+    assert res["found_feasible_solution"]
+    assert np.all(res["g_vals"] <= 0)
+    assert res["n_iters"] == len(res["f_vals"]) == 5
+
+    res = gradient_descent_adam(
+        theta_init=np.zeros(2), tol_L=1e-4, patience=3, **gd_kwargs
+    )
+    assert res["stop_reason"] == "L_converged"
+    assert res["n_iters"] < 500
+    L_vals = res["L_vals"]
+    rel_changes = np.abs(np.diff(L_vals[-4:])) / np.abs(L_vals[-4:-1])
+    assert np.all(rel_changes < 1e-4)
+    # Identical to the full run up to the step it stopped at
+    assert np.allclose(L_vals, res_full["L_vals"][: res["n_iters"]])
+
+    res = gradient_descent_adam(
+        theta_init=np.zeros(2), tol_grad=1e-2, patience=2, **gd_kwargs
+    )
+    assert res["stop_reason"] == "gradient_converged"
+    assert res["n_iters"] < 500
+
+
+@pytest.mark.parametrize("stacked_trace", [False, True])
+def test_multi_start_early_stopping(stacked_trace):
+    """Each trajectory of multi-start gradient descent should stop
+    where single-start gradient descent from the same starting point
+    stops, while the other trajectories continue"""
+    gd_kwargs = dict(
+        primary_objective=lambda theta: np.sum((theta - 1.0) ** 2) + 1.0,
+        n_constraints=1,
+        upper_bounds_function=lambda theta: np.array([theta[0] - 2.0]),
+        lambda_init=0.5,
+        batch_calculator=lambda *args: False,
+        n_batches=1,
+        n_epochs=500,
+        beta_velocity=0.0,
+    )
+    # The first starting point is feasible from the start and stops first
+    theta_inits = np.array([[0.0, 0.0], [3.0, 1.0], [-2.0, 4.0]])
+    for stopping_kwargs in [
+        dict(feasibility_patience=5),
+        dict(tol_L=1e-4, patience=3),
+        dict(tol_grad=1e-2, patience=2),
+    ]:
+        res = multi_start_gradient_descent_adam(
+            theta_inits=theta_inits,
+            stacked_trace=stacked_trace,
+            **stopping_kwargs,
+            **gd_kwargs,
+        )
+        single_results = [
+            gradient_descent_adam(
+                theta_init=np.copy(theta_init), **stopping_kwargs, **gd_kwargs
+            )
+            for theta_init in theta_inits
+        ]
+        assert all(r["stop_reason"] != "max_iterations" for r in single_results)
+        best_start = res["best_start"]
+        best_single = single_results[best_start]
+        assert best_single["best_f"] == min(r["best_f"] for r in single_results)
+        assert res["stop_reason"] == best_single["stop_reason"]
+        assert res["n_iters"] == best_single["n_iters"]
+        assert np.allclose(res["f_vals"], best_single["f_vals"])
+        assert np.allclose(res["L_vals"], best_single["L_vals"])
+        assert np.allclose(
+            res["candidate_solution"], best_single["candidate_solution"]
+        )
+
+    # The best trajectory ran on after the first one stopped
+    res = multi_start_gradient_descent_adam(
+        theta_inits=theta_inits,
+        stacked_trace=stacked_trace,
+        feasibility_patience=5,
+        **gd_kwargs,
+    )
+    assert res["best_start"] != 0
+    assert res["n_iters"] > 5
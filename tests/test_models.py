@@ -72,6 +72,77 @@ def test_multiclass_logistic_regression_model():
     assert np.allclose(theta_fitted, answer2)
 
 
+def test_prediction_cache():
+    from seldonian.models.prediction_cache import PredictionCache, cached_predict
+    from seldonian.parse_tree import zhat_funcs
+
+    class CountingModel(BinaryLogisticRegressionModel):
+        def __init__(self):
+            super().__init__()
+            self.n_predict_calls = 0
+
+        def predict(self, theta, X):
+            self.n_predict_calls += 1
+            return super().predict(theta, X)
+
+    model = CountingModel()
+    X = np.array([[0.0, 0.0], [0.25, 0.5], [0.5, 1.0], [0.75, 1.5]])
+    Y = np.array([0, 0, 1, 1])
+    theta = np.array([0.0, -1.0, 1.0])
+
+    # No cache attached, so every call goes to the model
+    cached_predict(model, theta, X)
+    cached_predict(model, theta, X)
+    assert model.n_predict_calls == 2
+
+    model.prediction_cache = PredictionCache()
+    model.n_predict_calls = 0
+    # Primary objective and several measure functions share one forward pass
+    loss = objectives.binary_logistic_loss(model, theta, X, Y)
+    fpr = zhat_funcs.vector_False_Positive_Rate(
+        model, theta, X, Y, sub_regime="classification"
+    )
+    tpr = zhat_funcs.vector_True_Positive_Rate(
+        model, theta, X, Y, sub_regime="classification"
+    )
+    assert model.n_predict_calls == 1
+    assert loss == pytest.approx(
+        objectives.binary_logistic_loss(BinaryLogisticRegressionModel(), theta, X, Y)
+    )
+    assert np.allclose(fpr, [0.5, 0.5621765])
+    assert np.allclose(tpr, [0.62245933, 0.6791787])
+
+    # A new theta or different features invalidate the cached prediction
+    cached_predict(model, np.copy(theta), X)
+    assert model.n_predict_calls == 2
+    cached_predict(model, model.prediction_cache.theta, X[:2])
+    assert model.n_predict_calls == 3
+
+    # After a reset, the same theta is predicted again
+    model.prediction_cache.reset()
+    cached_predict(model, theta, X)
+    assert model.n_predict_calls == 4
+
+
+def test_predict_stacked():
+    X = np.array([[0.0, 0.0], [0.25, 0.5], [0.5, 1.0], [0.75, 1.5]])
+    np.random.seed(0)
+    for model, theta_shape in [
+        (LinearRegressionModel(), (3,)),
+        (BinaryLogisticRegressionModel(), (3,)),
+        (MultiClassLogisticRegressionModel(), (3, 3)),
+    ]:
+        assert has_stacked_predict(model)
+        thetas = np.random.normal(0, 1, (4,) + theta_shape)
+        y_pred = model.predict_stacked(thetas, X)
+        for k, theta in enumerate(thetas):
+            assert np.allclose(y_pred[k], model.predict(theta, X))
+
+    # Overriding predict() without predict_stacked() opts out
+    assert not has_stacked_predict(BoundedLinearRegressionModel())
+    assert not has_stacked_predict(DummyClassifierModel())
+
+
 def test_sklearn_dtree():
     model = SeldonianDecisionTree(max_depth=4, criterion="entropy")
     assert model.has_intercept == False
@@ -94,3 +165,117 @@ def test_sklearn_random_forest():
     assert len(y_pred) == 100
     prob_mask = np.logical_and(y_pred >= 0, y_pred <= 1)
     assert all(prob_mask)
+
+
+def test_pytorch_flat_params():
+    """A PyTorch model with flat parameter buffers should give the same
+    predictions and gradients as one without over several in-place
+    gradient steps, and theta should never alias the model's weights"""
+    torch = pytest.importorskip("torch")
+    from autograd import grad
+    from seldonian.models.pytorch_model import SupervisedPytorchBaseModel
+
+    class TorchMLP(SupervisedPytorchBaseModel):
+        def create_model(self, **kwargs):
+            return torch.nn.Sequential(
+                torch.nn.Linear(3, 4),
+                torch.nn.Tanh(),
+                torch.nn.Linear(4, 1),
+                torch.nn.Flatten(0),
+            )
+
+    np.random.seed(0)
+    X = np.random.normal(0, 1, (20, 3))
+    Y = np.random.normal(0, 1, 20)
+    thetas, predictions, gradients = {}, {}, {}
+    for flat_params in [False, True]:
+        torch.manual_seed(0)
+        model = TorchMLP(device="cpu", flat_params=flat_params)
+        assert (model.flat_param_buffer is not None) == flat_params
+
+        theta_init = model.get_model_params()
+        theta_init_copy = np.copy(theta_init)
+        theta = theta_init
+        predictions[flat_params], gradients[flat_params] = [], []
+        loss = lambda theta: np.mean((model.predict(theta, X) - Y) ** 2)
+        for _ in range(3):
+            predictions[flat_params].append(model.predict(theta, X))
+            gradient = grad(loss)(theta)
+            gradients[flat_params].append(gradient)
+            # Updated in place like gradient_descent_adam does
+            theta -= 0.1 * gradient
+            # The model only sees theta when it is passed in
+            assert np.allclose(model.get_model_params(), theta + 0.1 * gradient)
+        thetas[flat_params] = theta
+
+        # Updating theta never changed the model's weights directly
+        model.update_model_params(theta_init_copy)
+        assert np.allclose(model.get_model_params(), theta_init_copy)
+        assert not np.allclose(theta_init, theta_init_copy)
+
+    assert np.allclose(thetas[True], thetas[False])
+    for k in range(3):
+        assert np.allclose(predictions[True][k], predictions[False][k])
+        assert np.allclose(gradients[True][k], gradients[False][k])
+
+
+@pytest.mark.parametrize(
+    "use_tf_function,batch_size_predict", [(True, None), (False, 7), (True, 7)]
+)
+def test_tensorflow_compiled_chunked(use_tf_function, batch_size_predict):
+    """A TensorFlow model with a compiled and/or chunked forward pass and
+    vector Jacobian product should give the same predictions and gradients
+    as the eager model, including when several thetas are traced
+    before the backward pass and when there are no samples"""
+    tf = pytest.importorskip("tensorflow")
+    from autograd import grad
+    from seldonian.models.tensorflow_model import SupervisedTensorFlowBaseModel
+
+    class TensorFlowMLP(SupervisedTensorFlowBaseModel):
+        def create_model(self, **kwargs):
+            tf.keras.utils.set_random_seed(0)
+            return tf.keras.Sequential(
+                [
+                    tf.keras.Input(shape=(3,)),
+                    tf.keras.layers.Dense(4, activation="tanh"),
+                    tf.keras.layers.Dense(1),
+                    tf.keras.layers.Flatten(data_format=None),
+                    tf.keras.layers.Reshape(()),
+                ]
+            )
+
+    np.random.seed(0)
+    X = np.random.normal(0, 1, (20, 3)).astype("float32")
+    Y = np.random.normal(0, 1, 20).astype("float32")
+    eager_model = TensorFlowMLP()
+    model = TensorFlowMLP(
+        use_tf_function=use_tf_function, batch_size_predict=batch_size_predict
+    )
+    theta_0 = eager_model.get_model_params()
+    assert np.allclose(model.get_model_params(), theta_0)
+    theta_1 = theta_0 + np.random.normal(0, 0.1, len(theta_0))
+
+    loss_0 = lambda theta, model: np.mean((model.predict(theta, X) - Y) ** 2)
+    loss_1 = lambda theta, model: np.mean(model.predict(2 * theta, X) ** 2)
+    # Both forward passes run before either backward pass,
+    # so the weights loaded last are those of 2*theta
+    loss = lambda theta, model: loss_0(theta, model) + loss_1(theta, model)
+
+    for theta in [theta_0, theta_1]:
+        assert np.allclose(
+            model.predict(theta, X), eager_model.predict(theta, X), atol=1e-6
+        )
+        # The eager model keeps the tape of the most recent forward pass,
+        # so its gradients are only taken one forward pass at a time
+        eager_grad = grad(loss_0)(theta, eager_model) + grad(loss_1)(
+            theta, eager_model
+        )
+        assert np.allclose(
+            grad(loss_0)(theta, model), grad(loss_0)(theta, eager_model), atol=1e-5
+        )
+        assert np.allclose(grad(loss)(theta, model), eager_grad, atol=1e-5)
+
+    X_empty = X[:0]
+    assert model.predict(theta_0, X_empty).shape == (0,)
+    empty_grad = grad(lambda theta: np.sum(model.predict(theta, X_empty)))(theta_0)
+    assert np.allclose(empty_grad, 0)
@@ -168,3 +168,304 @@ def test_multiclass_classification_measure_functions():
         ]
     )
     assert np.allclose(CM_array, CM_ans)
+
+
+def test_RL_estimators(RL_gridworld_dataset):
+    """The vectorized importance sampling estimators
+    should match per-episode calculations, including gradients"""
+    from autograd import grad
+    from seldonian.RL.RL_model import RL_model
+    from seldonian.utils.stats_utils import weighted_sum_gamma
+
+    (dataset, policy, env_kwargs, _) = RL_gridworld_dataset()
+    model = RL_model(policy=policy, env_kwargs=env_kwargs)
+    gamma = env_kwargs["gamma"]
+    episodes = dataset.episodes
+    returns = dataset.get_discounted_returns(gamma)
+    np.random.seed(42)
+    theta = np.random.normal(0, 0.5, size=policy.get_params().shape)
+
+    def rhos_ref(theta):
+        rhos = []
+        for ep in episodes:
+            pi_news = model.get_probs_from_observations_and_actions(
+                theta, ep.observations, ep.actions, ep.action_probs
+            )
+            rhos.append(np.prod(pi_news / ep.action_probs))
+        return np.array(rhos)
+
+    def PDIS_ref(theta):
+        result = []
+        for ep in episodes:
+            pi_news = model.get_probs_from_observations_and_actions(
+                theta, ep.observations, ep.actions, ep.action_probs
+            )
+            ratio_prods = np.exp(np.cumsum(np.log(pi_news / ep.action_probs)))
+            discount = np.power(gamma, range(len(ep.rewards)))
+            result.append(np.sum(ratio_prods * discount * ep.rewards))
+        return np.array(result)
+
+    rhos = rhos_ref(theta)
+    IS_vector = zhat_funcs.vector_IS_estimate(model, theta, episodes, returns)
+    assert np.allclose(IS_vector, rhos * returns)
+    assert objectives.IS_estimate(model, theta, episodes) == pytest.approx(
+        np.mean(rhos * returns)
+    )
+
+    WIS_vector = zhat_funcs.vector_WIS_estimate(model, theta, episodes, returns)
+    assert np.allclose(WIS_vector, len(episodes) * rhos * returns / np.sum(rhos))
+    assert objectives.WIS_estimate(model, theta, episodes) == pytest.approx(
+        np.sum(rhos * returns) / np.sum(rhos)
+    )
+
+    PDIS_vector = zhat_funcs.vector_PDIS_estimate(model, theta, episodes, returns)
+    assert np.allclose(PDIS_vector, PDIS_ref(theta))
+    assert objectives.PDIS_estimate(model, theta, episodes) == pytest.approx(
+        np.mean(PDIS_ref(theta))
+    )
+
+    grad_IS = grad(lambda th: objectives.IS_estimate(model, th, episodes))(theta)
+    grad_IS_ref = grad(lambda th: np.mean(rhos_ref(th) * returns))(theta)
+    assert np.allclose(grad_IS, grad_IS_ref)
+    grad_PDIS = grad(lambda th: objectives.PDIS_estimate(model, th, episodes))(theta)
+    grad_PDIS_ref = grad(lambda th: np.mean(PDIS_ref(th)))(theta)
+    assert np.allclose(grad_PDIS, grad_PDIS_ref)
+
+
+def test_RL_estimators_overridden_probs(RL_gridworld_dataset):
+    """Policies that override the action probabilities,
+    but not the log action probabilities, should have their
+    probabilities used by the importance sampling estimators"""
+    from seldonian.RL.RL_model import RL_model
+    from seldonian.RL.Agents.Policies.Softmax import DiscreteSoftmax
+    from seldonian.RL.Env_Description import Spaces, Env_Description
+
+    class TemperedSoftmax(DiscreteSoftmax):
+        def get_probs_from_observations_and_actions(self, observations, actions, _):
+            logits = self.FA.weights / 2.0
+            e_x = np.exp(logits - np.max(logits, axis=1, keepdims=True))
+            probs = e_x / np.sum(e_x, axis=1, keepdims=True)
+            return probs[observations, actions]
+
+    class TemperedActionSoftmax(DiscreteSoftmax):
+        def get_prob_this_action(self, observation, action):
+            logits = self.FA.weights[observation] / 2.0
+            e_x = np.exp(logits - np.max(logits))
+            return e_x[action] / np.sum(e_x)
+
+    (dataset, _, env_kwargs, _) = RL_gridworld_dataset()
+    env_description = Env_Description.Env_Description(
+        Spaces.Discrete_Space(0, 8), Spaces.Discrete_Space(0, 3)
+    )
+    episodes = dataset.episodes
+    returns = dataset.get_discounted_returns(env_kwargs["gamma"])
+    np.random.seed(42)
+    theta = np.random.normal(0, 0.5, size=(9, 4))
+    # The probabilities of the softmax of theta/2
+    logits = theta / 2.0
+    probs = np.exp(logits) / np.sum(np.exp(logits), axis=1, keepdims=True)
+    ratios = [probs[ep.observations, ep.actions] / ep.action_probs for ep in episodes]
+    rhos = np.array([np.prod(ratio) for ratio in ratios])
+    gamma = env_kwargs["gamma"]
+    discounts = [np.power(gamma, range(len(ep.rewards))) for ep in episodes]
+    PDIS_ref = np.array(
+        [
+            np.sum(np.cumprod(ratio) * discount * ep.rewards)
+            for ratio, discount, ep in zip(ratios, discounts, episodes)
+        ]
+    )
+    for policy_class in [TemperedSoftmax, TemperedActionSoftmax]:
+        policy = policy_class(
+            env_description=env_description, hyperparam_and_setting_dict={}
+        )
+        model = RL_model(policy=policy, env_kwargs=env_kwargs)
+        assert not objectives.has_log_probs(model)
+        assert objectives.IS_estimate(model, theta, episodes) == pytest.approx(
+            np.mean(rhos * returns)
+        )
+        assert objectives.WIS_estimate(model, theta, episodes) == pytest.approx(
+            np.sum(rhos * returns) / np.sum(rhos)
+        )
+        PDIS_vector = zhat_funcs.vector_PDIS_estimate(model, theta, episodes, returns)
+        assert np.allclose(PDIS_vector, PDIS_ref)
+        assert objectives.PDIS_estimate(model, theta, episodes) == pytest.approx(
+            np.mean(PDIS_ref)
+        )
+
+    policy = DiscreteSoftmax(
+        env_description=env_description, hyperparam_and_setting_dict={}
+    )
+    assert objectives.has_log_probs(RL_model(policy=policy, env_kwargs=env_kwargs))
+
+
+def test_RL_long_episode_importance_weights(RL_gridworld_dataset):
+    """Importance weights of long episodes are kept in log space,
+    so the estimators stay finite where the direct product of the
+    per-decision ratios would overflow"""
+    from seldonian.RL.RL_model import RL_model
+    from seldonian.dataset import Episode, EpisodeColumns
+
+    (dataset, policy, env_kwargs, _) = RL_gridworld_dataset()
+    model = RL_model(policy=policy, env_kwargs=env_kwargs)
+    gamma = env_kwargs["gamma"]
+    # Stitch the first 100 gridworld episodes into two very long ones
+    episodes = dataset.episodes[:100]
+    long_episodes = [
+        Episode(
+            observations=np.concatenate([ep.observations for ep in half]),
+            actions=np.concatenate([ep.actions for ep in half]),
+            rewards=np.concatenate([ep.rewards for ep in half]),
+            action_probs=np.concatenate([ep.action_probs for ep in half]),
+        )
+        for half in [episodes[:50], episodes[50:]]
+    ]
+    episode_columns = EpisodeColumns.from_episodes(long_episodes)
+    assert min(episode_columns.episode_lengths) > 500
+    returns = np.array(
+        [
+            np.sum(np.power(gamma, range(len(ep.rewards))) * ep.rewards)
+            for ep in long_episodes
+        ]
+    )
+    theta = np.zeros(policy.get_params().shape)
+    # Push the new policy towards action 0 everywhere
+    theta[:, 0] = 5.0
+
+    with np.errstate(over="ignore", under="ignore"):
+        ratios = (
+            model.get_probs_from_observations_and_actions(
+                theta,
+                episode_columns.observations,
+                episode_columns.actions,
+                episode_columns.action_probs,
+            )
+            / episode_columns.action_probs
+        )
+        direct_products = [
+            np.prod(ratios[episode_columns.episode_ids == ii]) for ii in range(2)
+        ]
+    assert not np.all(np.isfinite(direct_products) & (np.array(direct_products) > 0))
+
+    log_weights = objectives.get_log_importance_weights(model, theta, episode_columns)
+    assert np.all(np.isfinite(log_weights))
+    WIS = objectives.WIS_estimate(model, theta, episode_columns, weighted_returns=returns)
+    assert np.isfinite(WIS)
+    assert min(returns) - 1e-9 <= WIS <= max(returns) + 1e-9
+    assert np.all(
+        np.isfinite(
+            zhat_funcs.vector_WIS_estimate(model, theta, episode_columns, returns)
+        )
+    )
+
+    # Truncated per-decision ratios stay within the bounds
+    model = RL_model(
+        policy=policy, env_kwargs=env_kwargs, importance_ratio_bounds=(0.5, 2.0)
+    )
+    log_ratios = objectives.get_log_importance_ratios(model, theta, episode_columns)
+    assert np.min(log_ratios) >= np.log(0.5) - 1e-12
+    assert np.max(log_ratios) <= np.log(2.0) + 1e-12
+    assert np.allclose(
+        objectives.get_log_importance_weights(model, theta, episode_columns),
+        [np.sum(log_ratios[episode_columns.episode_ids == ii]) for ii in range(2)],
+    )
+
+def test_RL_long_episode_IS_estimate(RL_gridworld_dataset):
+    """The IS estimate of long episodes is calculated in log space,
+    so it stays finite where the importance weights themselves
+    overflow but their products with the returns do not"""
+    from seldonian.RL.RL_model import RL_model
+    from seldonian.dataset import Episode, EpisodeColumns
+    from autograd import grad
+
+    (dataset, policy, env_kwargs, _) = RL_gridworld_dataset()
+    model = RL_model(policy=policy, env_kwargs=env_kwargs)
+    # Stitch the first 100 gridworld episodes into two very long ones,
+    # with behavior probabilities lowered so that the weights blow up
+    episodes = dataset.episodes[:100]
+    long_episodes = [
+        Episode(
+            observations=np.concatenate([ep.observations for ep in half]),
+            actions=np.concatenate([ep.actions for ep in half]),
+            rewards=np.concatenate([ep.rewards for ep in half]),
+            action_probs=0.6 * np.concatenate([ep.action_probs for ep in half]),
+        )
+        for half in [episodes[:50], episodes[50:]]
+    ]
+    episode_columns = EpisodeColumns.from_episodes(long_episodes)
+    theta = np.zeros(policy.get_params().shape)
+    log_weights = objectives.get_log_importance_weights(model, theta, episode_columns)
+    assert np.all(log_weights > 710)
+    returns = np.array([0.0, -1e-300])
+    with np.errstate(over="ignore", invalid="ignore"):
+        assert not np.any(np.isfinite(np.exp(log_weights) * returns))
+
+    expected = np.array([0.0, -np.exp(log_weights[1] + np.log(1e-300))])
+    IS_vector = zhat_funcs.vector_IS_estimate(model, theta, episode_columns, returns)
+    assert np.allclose(IS_vector, expected)
+    IS = objectives.IS_estimate(model, theta, episode_columns, weighted_returns=returns)
+    assert IS == pytest.approx(np.mean(expected))
+    grad_IS = grad(
+        lambda th: objectives.IS_estimate(
+            model, th, episode_columns, weighted_returns=returns
+        )
+    )(theta)
+    assert np.all(np.isfinite(grad_IS))
+
+
+def test_RL_long_episode_PDIS_estimate(RL_gridworld_dataset):
+    """The PDIS estimate of long episodes is calculated in log space,
+    so it stays finite where the per-decision importance weights
+    overflow but their products with the rewards do not"""
+    from seldonian.RL.RL_model import RL_model
+    from seldonian.dataset import Episode, EpisodeColumns
+    from seldonian.utils.stats_utils import segment_cumsum
+    from autograd import grad
+
+    (dataset, policy, _, _) = RL_gridworld_dataset()
+    model = RL_model(policy=policy, env_kwargs={"gamma": 1.0})
+    # Stitch the first 100 gridworld episodes into two very long ones,
+    # with behavior probabilities lowered so that the weights blow up
+    # and rewards small enough that the weighted rewards do not
+    episodes = dataset.episodes[:100]
+    long_episodes = [
+        Episode(
+            observations=np.concatenate([ep.observations for ep in half]),
+            actions=np.concatenate([ep.actions for ep in half]),
+            rewards=1e-300 * np.concatenate([ep.rewards for ep in half]),
+            action_probs=0.6 * np.concatenate([ep.action_probs for ep in half]),
+        )
+        for half in [episodes[:50], episodes[50:]]
+    ]
+    episode_columns = EpisodeColumns.from_episodes(long_episodes)
+    theta = np.zeros(policy.get_params().shape)
+    log_ratios = objectives.get_log_importance_ratios(model, theta, episode_columns)
+    log_weights = segment_cumsum(log_ratios, episode_columns.timesteps)
+    assert np.max(log_weights) > 710
+    with np.errstate(over="ignore", invalid="ignore"):
+        assert np.isnan(np.sum(np.exp(log_weights) * episode_columns.rewards))
+
+    # Every softmax action probability is 1/4 at theta = 0
+    expected = []
+    for ep in long_episodes:
+        log_cum_ratios = np.cumsum(np.log(0.25 / ep.action_probs))
+        nonzero = ep.rewards != 0
+        expected.append(
+            np.sum(
+                np.sign(ep.rewards[nonzero])
+                * np.exp(log_cum_ratios[nonzero] + np.log(np.abs(ep.rewards[nonzero])))
+            )
+        )
+    expected = np.array(expected)
+    assert np.all(np.isfinite(expected))
+    assert not np.allclose(expected, 0)
+
+    PDIS_vector = zhat_funcs.vector_PDIS_estimate(
+        model, theta, episode_columns, np.zeros(2)
+    )
+    assert np.allclose(PDIS_vector, expected)
+    PDIS = objectives.PDIS_estimate(model, theta, episode_columns)
+    assert PDIS == pytest.approx(np.mean(expected))
+    gradient = grad(lambda th: objectives.PDIS_estimate(model, th, episode_columns))(
+        theta
+    )
+    assert np.all(np.isfinite(gradient))
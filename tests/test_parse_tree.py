@@ -3057,3 +3057,161 @@ def test_e_assigned_as_constant_node():
     pt.create_from_ast(constraint_str)
     assert pt.root.right.left.name == "e"
     assert isinstance(pt.root.right.left, ConstantNode)
+
+
+def test_compiled_plan_matches_recursive_propagation(gpa_regression_dataset):
+    np.random.seed(0)
+    constraint_strs = [
+        "max(abs(Mean_Error|[M]) - 0.1, Mean_Squared_Error/2.0) + exp(-Mean_Error)"
+    ]
+    deltas = [0.05]
+    (dataset, model, primary_objective, parse_trees) = gpa_regression_dataset(
+        constraint_strs, deltas
+    )
+
+    pt = ParseTree(
+        deltas[0],
+        regime="supervised_learning",
+        sub_regime="regression",
+        columns=dataset.meta.sensitive_col_names,
+    )
+    pt.build_tree(constraint_strs[0])
+
+    # Plan is compiled by build_tree, postorder with one slot per node
+    plan = pt.eval_plan
+    assert plan.root is pt.root
+    assert len(plan.nodes) == pt.n_nodes
+    assert plan.nodes[-1] is pt.root
+    assert len(plan.base_slots) == pt.n_base_nodes
+    for opcode, left_slot, right_slot, out_slot in plan.instructions:
+        assert left_slot < out_slot
+        assert right_slot < out_slot
+
+    theta = np.random.uniform(-0.05, 0.05, 10)
+    kwargs = dict(
+        theta=theta,
+        tree_dataset_dict={"all": dataset},
+        model=model,
+        branch="safety_test",
+        regime="supervised_learning",
+        sub_regime="regression",
+    )
+    pt.propagate_bounds(**kwargs)
+    compiled_bounds = (pt.root.lower, pt.root.upper)
+
+    pt.reset_base_node_dict()
+    pt._propagator_helper(pt.root, **kwargs)
+    assert compiled_bounds[0] == pytest.approx(pt.root.lower)
+    assert compiled_bounds[1] == pytest.approx(pt.root.upper)
+
+    # The plan is recompiled if the root changes
+    pt.create_from_ast("Mean_Squared_Error - 2.0")
+    pt.assign_deltas(weight_method="equal")
+    pt.propagate_bounds(**kwargs)
+    assert pt.eval_plan.root is pt.root
+    assert len(pt.eval_plan.nodes) == 3
+
+
+def test_base_node_registry_shared_across_trees(simulated_regression_dataset):
+    from seldonian.parse_tree.base_node_registry import BaseNodeRegistry
+
+    constraint_strs = ["Mean_Squared_Error - 2.0", "abs(Mean_Squared_Error - 1.0)"]
+    deltas = [0.05, 0.1]
+    (dataset, model, primary_objective, parse_trees) = simulated_regression_dataset(
+        constraint_strs, deltas
+    )
+    theta = np.array([0.0, 1.0])
+    bounds_kwargs = dict(
+        theta=theta,
+        tree_dataset_dict={"all": dataset},
+        model=model,
+        branch="safety_test",
+        regime="supervised_learning",
+        sub_regime="regression",
+    )
+
+    # Bounds without sharing
+    expected_bounds = []
+    for pt in parse_trees:
+        pt.propagate_bounds(**bounds_kwargs)
+        expected_bounds.append((pt.root.lower, pt.root.upper))
+        pt.reset_base_node_dict(reset_data=True)
+
+    registry = BaseNodeRegistry()
+    registry.reset(theta)
+    for ii, pt in enumerate(parse_trees):
+        pt.propagate_bounds(base_node_registry=registry, **bounds_kwargs)
+        assert pt.root.lower == pytest.approx(expected_bounds[ii][0])
+        assert pt.root.upper == pytest.approx(expected_bounds[ii][1])
+
+    # The base node appears in both trees but was only evaluated once
+    assert len(registry.zhat_dict) == 1
+
+    registry.reset()
+    assert registry.zhat_dict == {}
+
+
+def test_base_node_registry_key_on_dataset():
+    """The registry should key zhats on the dataset when one is given,
+    without needing the prepared data_dict"""
+    from seldonian.parse_tree.base_node_registry import BaseNodeRegistry
+
+    class CountingNode(object):
+        name = "Mean_Squared_Error"
+
+        def __init__(self):
+            self.n_zhat_calls = 0
+
+        def zhat(self, **kwargs):
+            self.n_zhat_calls += 1
+            return np.ones(3)
+
+    node = CountingNode()
+    registry = BaseNodeRegistry()
+    registry.reset()
+    dataset = object()
+    other_dataset = object()
+    assert np.allclose(registry.get_zhat(node, dataset=dataset), np.ones(3))
+    registry.get_zhat(node, dataset=dataset)
+    assert node.n_zhat_calls == 1
+    registry.get_zhat(node, dataset=other_dataset)
+    assert node.n_zhat_calls == 2
+
+
+def test_data_dict_reused_until_dataset_changes(simulated_regression_dataset):
+    constraint_strs = ["Mean_Squared_Error - 2.0"]
+    deltas = [0.05]
+    (dataset, model, primary_objective, parse_trees) = simulated_regression_dataset(
+        constraint_strs, deltas
+    )
+    pt = parse_trees[0]
+    bounds_kwargs = dict(
+        theta=np.array([0.0, 1.0]),
+        model=model,
+        branch="safety_test",
+        regime="supervised_learning",
+        sub_regime="regression",
+    )
+    pt.propagate_bounds(tree_dataset_dict={"all": dataset}, **bounds_kwargs)
+    data_dict = pt.base_node_dict["Mean_Squared_Error"]["data_dict"]
+    assert pt.base_node_dict["Mean_Squared_Error"]["data_source"] is dataset
+
+    # Same dataset: prepared data is reused
+    pt.reset_base_node_dict()
+    pt.propagate_bounds(tree_dataset_dict={"all": dataset}, **bounds_kwargs)
+    assert pt.base_node_dict["Mean_Squared_Error"]["data_dict"] is data_dict
+
+    # Different dataset: data is prepared again without needing reset_data=True
+    half = dataset.num_datapoints // 2
+    half_dataset = SupervisedDataSet(
+        features=dataset.features[:half],
+        labels=dataset.labels[:half],
+        sensitive_attrs=[],
+        num_datapoints=half,
+        meta=dataset.meta,
+    )
+    pt.reset_base_node_dict()
+    pt.propagate_bounds(tree_dataset_dict={"all": half_dataset}, **bounds_kwargs)
+    new_data_dict = pt.base_node_dict["Mean_Squared_Error"]["data_dict"]
+    assert new_data_dict is not data_dict
+    assert len(new_data_dict["labels"]) == half
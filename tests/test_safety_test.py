@@ -146,3 +146,103 @@ def test_evaluate_primary_objective_RL(RL_gridworld_dataset):
     st = SafetyTest(safety_dataset, model, parse_trees, regime=regime)
     primary_obj_evl = st.evaluate_primary_objective(solution, primary_objective)
     assert primary_obj_evl == pytest.approx(0.45250228)
+
+
+def test_streaming_safety_test_bounds():
+    """With batch_size_safety set, the t-test bounds are calculated
+    from moments streamed over chunks of the safety data
+    and should match the bounds calculated from the full zhat vector"""
+    from seldonian.models.models import BinaryLogisticRegressionModel
+
+    np.random.seed(0)
+    n = 1000
+    X = np.random.normal(0, 1, (n, 3))
+    Y = np.random.randint(0, 2, n)
+    meta = SupervisedMetaData(
+        sub_regime="classification",
+        all_col_names=["x1", "x2", "x3", "label"],
+        feature_col_names=["x1", "x2", "x3"],
+        label_col_names=["label"],
+    )
+    safety_dataset = SupervisedDataSet(
+        features=X, labels=Y, sensitive_attrs=[], num_datapoints=n, meta=meta
+    )
+    constraint_strs = ["abs(FPR - FNR) - 0.3", "0.4 - ACC"]
+    parse_trees = make_parse_trees_from_constraints(
+        constraint_strs,
+        deltas=[0.05] * len(constraint_strs),
+        sub_regime="classification",
+    )
+    model = BinaryLogisticRegressionModel()
+    st = SafetyTest(safety_dataset, model, parse_trees)
+    solution = np.array([0.1, 0.5, -0.25, 0.3])
+
+    st.run(solution)
+    upper_bounds = [pt.root.upper for pt in parse_trees]
+
+    st.run(solution, batch_size_safety=64)
+    streaming_upper_bounds = [pt.root.upper for pt in parse_trees]
+    assert np.allclose(streaming_upper_bounds, upper_bounds)
+
+
+def test_parallel_safety_test(monkeypatch):
+    """Evaluating the base nodes in parallel should give
+    the same bounds as the serial safety test, evaluating
+    each unique base node once across all parse trees"""
+    from seldonian.models.models import BinaryLogisticRegressionModel
+    from seldonian.parse_tree.nodes import BaseNode
+
+    n_zhat_calls = [0]
+    zhat = BaseNode.zhat
+
+    def counting_zhat(self, **kwargs):
+        n_zhat_calls[0] += 1
+        return zhat(self, **kwargs)
+
+    monkeypatch.setattr(BaseNode, "zhat", counting_zhat)
+
+    np.random.seed(0)
+    n = 1000
+    X = np.random.normal(0, 1, (n, 3))
+    Y = np.random.randint(0, 2, n)
+    meta = SupervisedMetaData(
+        sub_regime="classification",
+        all_col_names=["x1", "x2", "x3", "label"],
+        feature_col_names=["x1", "x2", "x3"],
+        label_col_names=["label"],
+    )
+    safety_dataset = SupervisedDataSet(
+        features=X, labels=Y, sensitive_attrs=[], num_datapoints=n, meta=meta
+    )
+    constraint_strs = ["abs(FPR - FNR) - 0.3", "FPR - 0.6", "0.4 - ACC"]
+    parse_trees = make_parse_trees_from_constraints(
+        constraint_strs,
+        deltas=[0.05] * len(constraint_strs),
+        sub_regime="classification",
+    )
+    st = SafetyTest(safety_dataset, BinaryLogisticRegressionModel(), parse_trees)
+    solution = np.array([0.1, 0.5, -0.25, 0.3])
+
+    passed = st.run(solution)
+    upper_bounds = [pt.root.upper for pt in parse_trees]
+
+    n_zhat_calls[0] = 0
+    assert st.run(solution, n_workers=2, parallel_backend="thread") == passed
+    assert n_zhat_calls[0] == 3
+    assert np.allclose([pt.root.upper for pt in parse_trees], upper_bounds)
+
+    assert st.run(solution, n_workers=2, parallel_backend="process") == passed
+    assert np.allclose([pt.root.upper for pt in parse_trees], upper_bounds)
+    assert np.allclose(
+        [st.st_result[cstr].root.upper for cstr in constraint_strs], upper_bounds
+    )
+    # The stored trees share the prepared data with the originals
+    assert (
+        st.st_result["FPR - 0.6"].base_node_dict["FPR"]["data_dict"]
+        is parse_trees[1].base_node_dict["FPR"]["data_dict"]
+    )
+
+    with pytest.raises(ValueError):
+        st.run(solution, n_workers=0)
+    with pytest.raises(NotImplementedError):
+        st.run(solution, n_workers=2, parallel_backend="mpi")
@@ -10,7 +10,12 @@ from seldonian.utils.tutorial_utils import (
     generate_data,
 )
 from seldonian.parse_tree.parse_tree import ParseTree, make_parse_trees_from_constraints
-from seldonian.dataset import DataSetLoader, SupervisedDataSet, RLDataSet
+from seldonian.dataset import (
+    DataSetLoader,
+    SupervisedDataSet,
+    RLDataSet,
+    EpisodeColumns,
+)
 
 from seldonian.spec import Spec, RLSpec, SupervisedSpec, createSupervisedSpec
 from seldonian.seldonian_algorithm import SeldonianAlgorithm
@@ -386,15 +391,15 @@ def test_phil_custom_base_node(gpa_regression_dataset):
     array_to_compare = np.array(
         [
             0.42523186,
-            -0.00285919,
-            -0.00202504,
-            -0.00241554,
-            -0.00234768,
-            -0.00258539,
-            0.01924093,
-            0.01865392,
-            -0.00308652,
-            -0.00244911,
+            -0.00285192,
+            -0.00202239,
+            -0.00241261,
+            -0.00234646,
+            -0.0025831,
+            0.01924249,
+            0.01865552,
+            -0.00308212,
+            -0.0024446,
         ]
     )
 
@@ -468,7 +473,7 @@ def test_cvar_custom_base_node():
         branch="safety_test",
         sub_regime="regression",
     )
-    assert pt.root.value == pytest.approx(-47.163772762)
+    assert pt.root.value == pytest.approx(-47.083710622)
 
 
 def test_cvar_lower_bound():
@@ -647,15 +652,15 @@ def test_gpa_data_regression_custom_constraint(gpa_regression_dataset):
     array_to_compare = np.array(
         [
             0.42155706,
-            -0.00153405,
-            -0.00069985,
-            -0.00109037,
-            -0.00102248,
-            -0.00126023,
-            0.01056612,
-            0.00997911,
-            -0.0017614,
-            -0.00112394,
+            -0.00152678,
+            -0.0006972,
+            -0.00108743,
+            -0.00102126,
+            -0.00125793,
+            0.01056768,
+            0.00998072,
+            -0.001757,
+            -0.00111942,
         ]
     )
 
@@ -1738,16 +1743,16 @@ def test_reg_coef(gpa_regression_dataset):
     # Try to get candidate solution result before running
     test_solution_bb = np.array(
         [
-            1.26219949e-04,
-            3.59203006e-04,
-            9.26674215e-04,
-            4.18683641e-04,
-            3.62709523e-04,
-            3.48171863e-05,
-            1.90106843e-03,
-            1.31441205e-03,
-            -6.56374856e-04,
-            2.12829138e-04,
+            1.26212146e-04,
+            3.59091031e-04,
+            9.26684730e-04,
+            4.18687169e-04,
+            3.62724533e-04,
+            3.47985818e-05,
+            1.90106783e-03,
+            1.31441526e-03,
+            -6.56393777e-04,
+            2.12948461e-04,
         ]
     )
     passed_safety, solution = SA_bb.run(debug=True)
@@ -2896,6 +2901,63 @@ def test_RL_gridworld_gradient_descent(RL_gridworld_dataset):
     assert primary_val_st == pytest.approx(0.43915764584186856)
 
 
+def test_RL_gridworld_columnar_episodes(RL_gridworld_dataset):
+    """Test that the RL gridworld example gives the same
+    result when the episodes are stored in columnar form
+    """
+    rseed = 99
+    np.random.seed(rseed)
+    constraint_strs = ["-10.0 - J_pi_new_IS"]
+    deltas = [0.05]
+
+    parse_trees = make_parse_trees_from_constraints(
+        constraint_strs,
+        deltas,
+        regime="reinforcement_learning",
+        sub_regime="all",
+        columns=[],
+        delta_weight_method="equal",
+    )
+    (dataset, policy, env_kwargs, primary_objective) = RL_gridworld_dataset()
+    columnar_dataset = RLDataSet(
+        episodes=EpisodeColumns.from_episodes(dataset.episodes), meta=dataset.meta
+    )
+
+    model = RL_model(policy=policy, env_kwargs=env_kwargs)
+    spec = RLSpec(
+        dataset=columnar_dataset,
+        model=model,
+        frac_data_in_safety=0.6,
+        use_builtin_primary_gradient_fn=False,
+        primary_objective=primary_objective,
+        parse_trees=parse_trees,
+        initial_solution_fn=None,
+        optimization_technique="gradient_descent",
+        optimizer="adam",
+        optimization_hyperparams={
+            "lambda_init": 0.5,
+            "alpha_theta": 0.01,
+            "alpha_lamb": 0.01,
+            "beta_velocity": 0.9,
+            "beta_rmsprop": 0.95,
+            "num_iters": 5,
+            "use_batches": False,
+            "gradient_library": "autograd",
+            "hyper_search": None,
+            "verbose": True,
+        },
+    )
+
+    SA = SeldonianAlgorithm(spec)
+    passed_safety, solution = SA.run()
+    assert passed_safety == True
+    g_vals = SA.cs_result["g_vals"]
+    assert g_vals[1][0] == pytest.approx(-9.67469087)
+
+    primary_val_st = SA.evaluate_primary_objective(theta=solution, branch="safety_test")
+    assert primary_val_st == pytest.approx(0.42407173678433796)
+
+
 def test_RL_gridworld_black_box(RL_gridworld_dataset):
     """Test that trying to run RL example with
     black box optimization gives a NotImplementedError,
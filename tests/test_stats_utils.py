@@ -1,7 +1,14 @@
 import pytest
 import autograd.numpy as np
 
-from seldonian.utils.stats_utils import stddev, tinv, weighted_sum_gamma
+from seldonian.utils.stats_utils import (
+    stddev,
+    tinv,
+    weighted_sum_gamma,
+    sample_moments,
+    merge_moments,
+    stddev_from_moments,
+)
 
 ### Begin tests
 
@@ -20,6 +27,23 @@ def test_stddev():
     assert stddev(arr3) == 1.0
 
 
+def test_merge_moments():
+    """Moments merged chunk by chunk should match
+    those of the whole sample"""
+    np.random.seed(0)
+    arr = np.random.normal(3.0, 2.0, 1001)
+    moments = (0, 0.0, 0.0)
+    for start in range(0, len(arr), 100):
+        moments = merge_moments(moments, sample_moments(arr[start : start + 100]))
+    n, mean, _ = moments
+    assert n == len(arr)
+    assert mean == pytest.approx(np.mean(arr))
+    assert stddev_from_moments(moments) == pytest.approx(stddev(arr))
+
+    # Merging with an empty sample changes nothing
+    assert merge_moments(sample_moments(np.array([])), moments) == moments
+
+
 def test_tinv():
     """Test the tinv() function"""
 
@@ -51,3 +75,39 @@ def test_weighted_sum_gamma():
 
     arr = [float("-inf"), float("inf")]
     assert np.isnan(weighted_sum_gamma(arr, gamma=0.9))
+
+
+def test_segment_sum_and_cumsum():
+    from autograd import grad
+    from seldonian.utils.stats_utils import segment_sum, segment_cumsum
+
+    # Three segments of lengths 3, 1 and 5
+    values = np.array([1.0, 2.0, 3.0, 4.0, 5.0, 6.0, 7.0, 8.0, 9.0])
+    segment_ids = np.array([0, 0, 0, 1, 2, 2, 2, 2, 2])
+    timesteps = np.array([0, 1, 2, 0, 0, 1, 2, 3, 4])
+    assert np.allclose(segment_sum(values, segment_ids, 3), [6.0, 4.0, 35.0])
+    assert np.allclose(
+        segment_cumsum(values, timesteps), [1, 3, 6, 4, 5, 11, 18, 26, 35]
+    )
+    # -inf stays within its segment
+    values_inf = np.array([1.0, float("-inf"), 3.0, 4.0, 5.0])
+    assert np.allclose(
+        segment_cumsum(values_inf, np.array([0, 1, 2, 0, 1])),
+        [1.0, float("-inf"), float("-inf"), 4.0, 9.0],
+    )
+
+    # Gradients match the same computations done per segment
+    weights = np.arange(1.0, 10.0)
+
+    def f(x):
+        return np.sum(weights[:3] * segment_sum(x, segment_ids, 3))
+
+    def f_cumsum(x):
+        return np.sum(weights * segment_cumsum(x, timesteps))
+
+    def f_cumsum_ref(x):
+        cumsums = [np.cumsum(x[0:3]), np.cumsum(x[3:4]), np.cumsum(x[4:9])]
+        return np.sum(weights * np.concatenate(cumsums))
+
+    assert np.allclose(grad(f)(values), weights[segment_ids])
+    assert np.allclose(grad(f_cumsum)(values), grad(f_cumsum_ref)(values))